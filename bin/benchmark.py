@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the speed of the hot paths of DestroyStack itself.
+
+No VMs or real Swift are needed, everything runs against stand-ins on
+localhost: an HTTP server pretending to be the Swift object servers, an
+in-memory Swift client and canned `swift-get-nodes` output. The start-up
+time of the test modules and scripts is measured by importing them in a new
+interpreter. The results are saved as JSON, by default into
+`tmp/benchmarks.json`.
+
+Usage:
+
+    $ python bin/benchmark.py
+    $ python bin/benchmark.py --compare old_results.json
+
+With `--compare`, the benchmarks that got slower by more than the threshold
+are listed and the script exits with a non-zero value.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+PROJ_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, PROJ_DIR)
+# the configuration only has to be loadable, nothing from it is used
+os.environ.setdefault('MAIN_CONFIG_FILE', 'config.json.sample')
+
+import destroystack.tools.common as common  # noqa
+import destroystack.tools.servers as server_tools  # noqa
+import destroystack.tools.swift as swift  # noqa
+
+LOG = logging.getLogger(__name__)
+RESULTS_FILE = os.path.join(PROJ_DIR, "tmp", "benchmarks.json")
+# how many times each benchmark is repeated, the best result is taken
+REPEAT = 5
+# replicas of each object in the stand-in cluster, and handoff locations
+REPLICA_COUNT = 3
+HANDOFF_COUNT = 2
+# {benchmark name: Python statement run in a new interpreter}
+IMPORT_BENCHMARKS = {
+    'import_python': "pass",
+    'import_server_manager': "import destroystack.tools.server_manager",
+    'import_tests': "import destroystack.test_swift_small_setup,"
+                    " destroystack.test_service_restarts",
+    'import_packstack_deploy': "import sys; sys.path.insert(0, 'bin');"
+                               " import packstack_deploy",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', default=RESULTS_FILE,
+                        help="where to save the results")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="results of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="relative slowdown reported as a regression")
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    object_server = FakeObjectServer()
+    object_server.start()
+    try:
+        results = run_benchmarks(object_server, args.repeat)
+    finally:
+        object_server.stop()
+
+    output = {'environment': _describe_environment(), 'results': results}
+    if not os.path.exists(os.path.dirname(args.output)):
+        os.makedirs(os.path.dirname(args.output))
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=4, sort_keys=True)
+    for name in sorted(results):
+        print("%-35s %12.1f us/op" % (name, results[name]['usec_per_op']))
+    print("Results saved into %s" % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+        if compare(previous, results, args.threshold):
+            return 1
+    return 0
+
+
+def run_benchmarks(object_server, repeat=REPEAT):
+    """Run all the benchmarks.
+
+    :returns: dict {benchmark name: {"usec_per_op": ..., "ops": ...}}
+    """
+    results = dict()
+
+    def record(name, func, number):
+        results[name] = measure(func, number, repeat)
+
+    local = server_tools.LocalServer()
+    record('local_cmd', lambda: local.cmd("true", log_cmd=False,
+                                          log_output=False), 20)
+
+    big_output = "\n".join("line %d of the output of some command" % i
+                           for i in range(100000)) + "\n"
+    record('parse_subprocess_results',
+           lambda: server_tools.CommandResult('bench', 'cmd')
+           .parse_subprocess_results(big_output, big_output, 0), 10)
+    record('parse_paramiko_results',
+           lambda: server_tools.CommandResult('bench', 'cmd')
+           .parse_paramiko_results(FakeChannelFile(big_output),
+                                   FakeChannelFile(big_output)), 10)
+
+    client = LocalSwift(object_server)
+    # the output of swift-get-nodes is canned, this measures parsing it
+    record('parse_get_nodes', lambda: client._get_replicas_direct_urls(
+        'AUTH_bench', 'container', 'object'), 100)
+
+    populated = [0]
+
+    def populate():
+        prefix = 'benchmark%d_' % populated[0]
+        populated[0] += 1
+        common.populate_swift_with_random_files(client, prefix, 10, 10)
+    try:
+        record('populate_100_files', populate, 1)
+    finally:
+        cwd = os.getcwd()
+        common.delete_testfiles('benchmark')
+        os.chdir(cwd)
+
+    # only the replicas of the last population are checked
+    client.containers = dict((c, objs) for c, objs in client.containers.items()
+                             if c.startswith('benchmark0_'))
+    record('replicas_are_ok_100_files', client.replicas_are_ok, 1)
+
+    for name, statement in IMPORT_BENCHMARKS.items():
+        record(name, lambda s=statement: run_python(s), 1)
+    return results
+
+
+def run_python(statement):
+    """Run the statement in a new Python interpreter in the project dir."""
+    subprocess.check_call([sys.executable, '-c', statement], cwd=PROJ_DIR)
+
+
+def measure(func, number, repeat=REPEAT):
+    """Call the function `number` times in `repeat` rounds.
+
+    :returns: dict with the time of one call in the fastest round
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            func()
+        elapsed = (time.time() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return {'usec_per_op': best * 1e6, 'ops': number, 'repeat': repeat}
+
+
+def compare(previous, current, threshold):
+    """Print the benchmarks that got slower by more than `threshold`.
+
+    :returns: list of names of the regressed benchmarks
+    """
+    regressions = list()
+    for name in sorted(current):
+        if name not in previous:
+            continue
+        old = previous[name]['usec_per_op']
+        new = current[name]['usec_per_op']
+        change = (new - old) / old
+        if change > threshold:
+            print("REGRESSION %s: %.1f -> %.1f us/op (+%d%%)"
+                  % (name, old, new, change * 100))
+            regressions.append(name)
+    return regressions
+
+
+class FakeChannelFile(io.StringIO):
+    """Stand-in for the stdout/stderr file of a paramiko command."""
+    def __init__(self, text, exit_code=0):
+        if not isinstance(text, type(u'')):
+            text = text.decode('utf-8')
+        super(FakeChannelFile, self).__init__(text)
+        self.channel = self
+        self._exit_code = exit_code
+
+    def recv_exit_status(self):
+        return self._exit_code
+
+
+class _ObjectRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path in self.server.stored:
+            self.send_response(200)
+        else:
+            self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeObjectServer(object):
+    """HTTP server answering like the Swift object servers do.
+
+    It has one "device" for each replica and handoff location. GET returns
+    200 for the paths in `stored` and 404 for everything else.
+    """
+    def __init__(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0),
+                                            _ObjectRequestHandler)
+        self._server.stored = set()
+        self._thread = None
+
+    @property
+    def stored(self):
+        return self._server.stored
+
+    def get_paths(self, path):
+        """Get the paths of all the locations of the path, primary first."""
+        return ["/device%d/%s" % (i, path)
+                for i in range(REPLICA_COUNT + HANDOFF_COUNT)]
+
+    def get_urls(self, path):
+        port = self._server.server_address[1]
+        return ["http://127.0.0.1:%d%s" % (port, p)
+                for p in self.get_paths(path)]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class CannedProxyServer(object):
+    """Stand-in for the Swift proxy, returns `swift-get-nodes` output."""
+    name = 'proxy'
+
+    def __init__(self, object_server):
+        self._object_server = object_server
+
+    def cmd(self, command, **kwargs):
+        path = '/'.join(command.split('|')[0].split()[3:])
+        lines = ['curl -I -XHEAD "%s" # [Handoff]' % url
+                 for url in self._object_server.get_urls(path)]
+        result = server_tools.CommandResult(self.name, command)
+        result.parse_subprocess_results("\n".join(lines), "", 0)
+        return result
+
+
+class LocalSwift(swift.Swift):
+    """In-memory Swift client, the replicas live on a `FakeObjectServer`."""
+    def __init__(self, object_server):
+        self.url = 'http://127.0.0.1/v1/AUTH_bench'
+        self.proxy_server = CannedProxyServer(object_server)
+        self.object_server = object_server
+        # {container: {object name: contents}}
+        self.containers = dict()
+
+    def put_container(self, container):
+        self.containers.setdefault(container, dict())
+        self._store(container)
+
+    def put_object(self, container, name, contents):
+        self.containers[container][name] = contents.read()
+        self._store(container, name)
+
+    def get_account(self):
+        return {}, [{'name': c} for c in sorted(self.containers)]
+
+    def get_container(self, container):
+        return {}, [{'name': o} for o in sorted(self.containers[container])]
+
+    def _store(self, container, name=None):
+        path = '/'.join(p for p in ['AUTH_bench', container, name] if p)
+        paths = self.object_server.get_paths(path)[:REPLICA_COUNT]
+        self.object_server.stored.update(paths)
+
+
+def _describe_environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=PROJ_DIR).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,10 +13,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""Deploy OpenStack on the servers from the configuration using Packstack.
+
+After a successful deployment, the state of the servers is saved as a
+"golden" snapshot (if the management type can save states), tagged by a hash
+of the answer file, the topology and the package repositories of the
+servers. If a golden snapshot with the same hash already exists, it is
+restored instead of running Packstack again. Snapshots left with the same tag
+(by `--redeploy` or by an interrupted save) are deleted before saving.
+
+With "standby_environments" in the configuration, only the main environment
+is deployed and no golden snapshots are used.
+
+Usage:
+
+    $ python bin/packstack_deploy.py [--redeploy]
+"""
+
+import argparse
 import copy
+import functools
+import hashlib
 import logging
+import re
 
+import destroystack.tools.answerfile as answerfile
 import destroystack.tools.common as common
+import destroystack.tools.parallel as parallel
 import destroystack.tools.server_manager as server_manager
 import destroystack.tools.servers as server_tools
 
@@ -28,8 +51,7 @@ logging.getLogger("paramiko").setLevel(logging.WARNING)
 LOCALHOST = None
 
 # packages that will be checked for on local host
-REQUIRED_PACKAGES = ['openstack-packstack', 'openstack-utils',
-                     'python-novaclient']
+REQUIRED_PACKAGES = ['openstack-packstack', 'python-novaclient']
 
 # password that will be set to services (like database)
 DEFAULT_SERVICE_PASS = "123456"
@@ -59,14 +81,43 @@ PACKSTACK_DEFAULT_OPTIONS = {
 # packstack answerfile that will be created locally
 ANSWERFILE = 'packstack.answer'
 
+# tag of the golden snapshots, followed by the deployment fingerprint
+GOLDEN_TAG_PREFIX = 'golden-'
+# answers randomly generated by Packstack, they don't change the deployment
+GENERATED_SECRET_RE = re.compile(r'_(PW|PASSWORD|TOKEN|HASH|SECRET)$')
+
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--redeploy', action='store_true',
+                        help="run Packstack even if there is a golden"
+                             " snapshot of the same deployment")
+    args = parser.parse_args()
+
     global LOCALHOST
     LOCALHOST = server_tools.LocalServer()
     install_packages(REQUIRED_PACKAGES)
 
-    create_configuration()
-    deploy()
+    with server_manager.ServerManager.open() as manager:
+        answer_file = create_configuration(manager)
+        if common.CONFIG.get('standby_environments'):
+            # the snapshots would be saved for the undeployed standby
+            # environments too
+            LOG.info("Not using golden snapshots with standby environments")
+            deploy(manager)
+            return
+        tag = GOLDEN_TAG_PREFIX + get_deployment_fingerprint(manager,
+                                                             answer_file)
+        if not args.redeploy and manager.has_state(tag):
+            LOG.info("Restoring the golden snapshot '%s' instead of running"
+                     " Packstack", tag)
+            manager.load_state(tag, force=True)
+        else:
+            deploy(manager)
+            # saving would reuse the old or incomplete snapshots with the tag
+            manager.delete_state(tag)
+            LOG.info("Saving the golden snapshot '%s'", tag)
+            manager.save_state(tag)
 
 
 def install_packages(packages):
@@ -74,29 +125,62 @@ def install_packages(packages):
     LOCALHOST.cmd('yum install -y %s' % packages, log_output=True)
 
 
-def create_configuration():
+def create_configuration(manager):
     """Using the server roles in the config file, create a packstack answerfile
 
+    :param manager: the open `ServerManager`
+    :returns: `answerfile.AnswerFile`
     """
     packstack_answers = copy.copy(PACKSTACK_DEFAULT_OPTIONS)
-    manager = server_manager.ServerManager()
     _configure_roles(packstack_answers, manager)
     _configure_keystone(packstack_answers, manager)
     _configure_swift(packstack_answers, manager)
-    _create_packstack_answerfile(packstack_answers)
+    return _create_packstack_answerfile(packstack_answers, manager)
+
 
+def get_deployment_fingerprint(manager, answer_file):
+    """Hash everything that decides what the deployment will be like.
 
-def deploy():
+    That is the answers (without the secrets generated by Packstack, unless
+    they are set by this script), the servers with their roles and disks and
+    the package repositories configured on them.
+
+    :param answer_file: `answerfile.AnswerFile`
+    :returns: hex digest, 16 characters
+    """
+    digest = hashlib.sha1()
+    for option in sorted(answer_file.options()):
+        if GENERATED_SECRET_RE.search(option) \
+                and option not in PACKSTACK_DEFAULT_OPTIONS:
+            continue
+        digest.update(("answer %s=%s\n" % (option, answer_file.get(option)))
+                      .encode('utf-8'))
+    servers = sorted(manager.get_all(), key=lambda server: server.ip)
+    repos = parallel.run_parallel(_get_repo_config, servers)
+    for server, repo in zip(servers, repos):
+        digest.update(("server %s roles=%s disks=%s\n%s\n"
+                       % (server.ip, ",".join(sorted(server.roles)),
+                          ",".join(server.disks or []), repo))
+                      .encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def deploy(manager):
     """Run Packstack and configure components if necessary
+
+    :param manager: the open `ServerManager`
     """
-    manager = server_manager.ServerManager()
+    if _deploys_swift(manager):
+        server_tools.prepare_swift_disks(manager.servers(role='swift_data'))
     LOG.info("Running packstack, this may take a while")
     LOCALHOST.cmd("packstack --answer-file=%s" % ANSWERFILE,
                   collect_stdout=False)
 
     data_servers = list(manager.servers(role='swift_data'))
-    _set_swift_mount_check(data_servers)
-    _set_iptables(manager)
+    tasks = _get_swift_mount_check_tasks(data_servers)
+    tasks.extend(_get_disk_init_tasks(data_servers))
+    tasks.extend(_get_iptables_tasks(manager))
+    parallel.run_tasks(tasks)
 
 
 def get_ips(host_list):
@@ -130,35 +214,43 @@ def _configure_keystone(packstack_opt, manager):
 def _configure_swift(packstack_opt, manager):
     """Add Swift proxy/data servers to packstack answerfile.
 
-    Also formats the extra disks provided to the data servers.
+    The extra disks of the data servers are not touched, they are prepared
+    by `deploy`.
     """
-
-    proxy_servers = manager.servers(role='swift_proxy')
-    data_servers = list(manager.servers(role='swift_data'))
-    if not (proxy_servers and data_servers):
+    if not _deploys_swift(manager):
         return
 
-    data_nodes = server_tools.prepare_swift_disks(data_servers)
+    proxy_servers = manager.get_all(role='swift_proxy')
+    data_servers = manager.get_all(role='swift_data')
+    data_nodes = server_tools.get_swift_devices(data_servers)
     packstack_opt["CONFIG_SWIFT_INSTALL"] = "y"
     packstack_opt["CONFIG_SWIFT_PROXY_HOSTS"] = get_ips(proxy_servers)
     packstack_opt["CONFIG_SWIFT_STORAGE_HOSTS"] = ",".join(data_nodes)
+    packstack_opt["CONFIG_SWIFT_STORAGE_FSTYPE"] = \
+        server_tools.get_disk_options()['filesystem']
+
+
+def _deploys_swift(manager):
+    """Check if there are both Swift proxy and data servers."""
+    proxy_servers = manager.get_all(role='swift_proxy')
+    data_servers = manager.get_all(role='swift_data')
+    return bool(proxy_servers and data_servers)
 
 
-def _get_default_host():
+def _get_default_host(manager):
     """Get one of the hosts that will be defaultly used by services.
 
     This is usually the host with the role 'controller' (one of them is
     selected), but if there is no such role specified, use the 'keystone' role.
     If even that is unavailable, just choose the first host provided.
     """
-    manager = server_manager.ServerManager()
     controller = manager.get(role='controller')
     keystone = manager.get(role='keystone')
 
     return controller or keystone or manager.get()
 
 
-def _set_default_host_in_answerfile():
+def _set_default_host_in_answerfile(answers, manager):
     """Set all the hosts in the answerfile to the default host (controller).
 
     Packstack by default creates an answerfile that uses localhost for all
@@ -167,54 +259,97 @@ def _set_default_host_in_answerfile():
     the servers given in the config. The exception is the server on which
     OpenStack clients should be installed, which will remain the same
     (localhost).
+
+    :param answers: `answerfile.AnswerFile`
+    """
+    default_host = _get_default_host(manager).ip
+    for option in answers.options():
+        if 'HOST' in option and option != 'CONFIG_OSCLIENT_HOST':
+            answers.set(option, default_host)
+
+
+def _create_packstack_answerfile(answers, manager):
+    """Write the answers into the answerfile, generate it if necessary.
+
+    The answerfile is edited in-process and the differences from the previous
+    version are logged.
     """
-    # save the original host to which OpenStack clients should be installed
-    res = LOCALHOST.cmd(
-        "openstack-config --get %s general CONFIG_OSCLIENT_HOST" % ANSWERFILE)
-    original_client_host = ''.join(res.out)
-    default_host = _get_default_host().ip
-    LOCALHOST.cmd("sed -ri 's/HOST(S?)\w*=.*/HOST\\1=%s/' %s"
-                  % (default_host, ANSWERFILE))
-    # restore host for client installation
-    LOCALHOST.cmd("openstack-config --set %s general CONFIG_OSCLIENT_HOST %s"
-                  % (ANSWERFILE, original_client_host))
-
-
-def _create_packstack_answerfile(answers):
     if not LOCALHOST.file_exists(ANSWERFILE):
         LOCALHOST.cmd("packstack --gen-answer-file=%s" % ANSWERFILE)
-        _set_default_host_in_answerfile()
+        answer_file = answerfile.AnswerFile(ANSWERFILE)
+        _set_default_host_in_answerfile(answer_file, manager)
     else:
         LOG.info("Reusing existing packstack answer file")
-    for question, answer in answers.iteritems():
-        LOCALHOST.cmd("openstack-config --set %s general %s %s"
-                      % (ANSWERFILE, question, answer))
+        answer_file = answerfile.AnswerFile(ANSWERFILE)
+    answer_file.update(answers)
+    answer_file.save()
+    return answer_file
 
 
-def _set_swift_mount_check(data_servers):
+def _get_swift_mount_check_tasks(data_servers):
     """Set the parameter mount_check to True in /etc/swift/*-server.conf
 
     If this is not checked True, Swift will replicate files onto the
     system disk if the disk is umounted.
+
+    :returns: list of `parallel.Task`
     """
+    tasks = list()
     for server in data_servers:
-        server.cmd("""
+        set_option = "set mount_check on %s" % server.name
+        tasks.append(parallel.Task(set_option, functools.partial(
+            server.cmd, """
             sed -i -e 's/mount_check.*=.*false/mount_check = true/' \
-            /etc/swift/*-server.conf""")
-    for server in data_servers:
-        server.cmd("swift-init account container object rest restart")
+            /etc/swift/*-server.conf""")))
+        tasks.append(parallel.Task(
+            "restart Swift on %s" % server.name,
+            functools.partial(server.cmd, "swift-init account container"
+                                          " object rest restart"),
+            requires=[set_option]))
+    return tasks
+
 
+def _get_disk_init_tasks(data_servers):
+    """Wait for the lazy initialization of the disks Packstack mounted.
 
-def _set_iptables(manager):
-    """Allow all incoming traffic to the OpenStack nodes from local IP."""
+    The golden snapshot and the tests should not start while the disks are
+    still being initialized, see `Server.wait_for_disk_init`.
+
+    :returns: list of `parallel.Task`
+    """
+    return [parallel.Task("wait for disk init on %s" % server.name,
+                          server.wait_for_disk_init)
+            for server in data_servers]
+
+
+def _get_iptables_tasks(manager):
+    """Allow all incoming traffic to the OpenStack nodes from local IP.
+
+    :returns: list of `parallel.Task`
+    """
     ip = _get_localhost_ip()
     if not ip:
         # since this functionality might not be necessary, just give up
-        return
+        return []
 
+    tasks = list()
     for server in manager.get_all():
-        server.cmd("iptables -I INPUT -s %s -j ACCEPT" % ip)
-        server.cmd("service iptables save")
+        allow = "allow %s in iptables on %s" % (ip, server.name)
+        tasks.append(parallel.Task(allow, functools.partial(
+            server.cmd, "iptables -I INPUT -s %s -j ACCEPT" % ip)))
+        tasks.append(parallel.Task(
+            "save iptables on %s" % server.name,
+            functools.partial(server.cmd, "service iptables save"),
+            requires=[allow]))
+    return tasks
+
+
+def _get_repo_config(server):
+    """Get the yum repository files of the server, without comments."""
+    result = server.cmd("grep -hEv '^[[:space:]]*(#|$)'"
+                        " /etc/yum.repos.d/*.repo",
+                        ignore_failures=True, log_cmd=False)
+    return "\n".join(line.strip() for line in result.out)
 
 
 def _get_localhost_ip():
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Report the recovery times and flag the ones that got significantly slower.
+
+The latest recovery time of each test, topology, OpenStack version and
+recovery phase is compared with the previous ones (see
+`destroystack.tools.metrics`). It is a regression if it is more than the
+threshold of standard deviations above their mean.
+
+Usage:
+
+    $ python bin/recovery_report.py [--database metrics.sqlite]
+
+Exits with a non-zero value if there is a regression.
+"""
+
+import argparse
+import os
+import sys
+
+PROJ_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, PROJ_DIR)
+
+import destroystack.tools.metrics as metrics  # noqa
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database', default=None,
+                        help="by default DESTROYSTACK_METRICS_DB or the one"
+                             " from the configuration")
+    parser.add_argument('--baseline', type=int,
+                        default=metrics.BASELINE_SIZE,
+                        help="number of previous measurements to compare with")
+    parser.add_argument('--threshold', type=float,
+                        default=metrics.Z_THRESHOLD,
+                        help="standard deviations above the mean")
+    args = parser.parse_args()
+
+    report = metrics.find_regressions(args.database, args.baseline,
+                                      args.threshold)
+    print("%-60s %-18s %8s %8s %8s %6s" % ("test / topology / version",
+                                           "phase", "latest", "mean",
+                                           "stdev", "z"))
+    for item in report:
+        name = "%s / %s / %s" % (item['test'], item['topology'],
+                                 item['openstack_version'])
+        print("%-60s %-18s %8.1f %8s %8s %6s %s" % (
+            name, item['phase'], item['seconds'],
+            _format(item['mean']), _format(item['stdev']),
+            _format(item['z']), "REGRESSION" if item['regression'] else ""))
+    if any(item['regression'] for item in report):
+        return 1
+    return 0
+
+
+def _format(value):
+    if value is None:
+        return "-"
+    return "%.1f" % value
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run the tests in parallel on multiple environments.
+
+Each environment is described by its own configuration file (see
+`etc/config.json.sample`) and gets its own `nosetests` process, which uses
+that configuration through the MAIN_CONFIG_FILE environment variable. Each
+process also has its own directory for the local copies of the test files,
+given by the TESTFILE_DIR environment variable, and its own file with the test
+IDs of nose (`tmp/noseids<number>`), so that they don't race on `.noseids`.
+The test classes are split between the processes so that each of them should
+take about the same time, according to the durations measured in the previous
+runs.
+
+Usage:
+
+    $ python bin/sharded_run.py config-env1.json config-env2.json
+
+The configuration files are searched for in the `etc/` directory, unless an
+absolute path is given. Additional arguments for nosetests can be given after
+`--`. Output of each process is saved into `tmp/shard<number>.log`.
+"""
+
+import argparse
+import ast
+import glob
+import json
+import logging
+import os
+import subprocess
+import sys
+import xml.etree.ElementTree as ElementTree
+
+PROJ_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), ".."))
+TEST_DIR = os.path.join(PROJ_DIR, "destroystack")
+TMP_DIR = os.path.join(PROJ_DIR, "tmp")
+# durations of the test classes measured in previous runs, in seconds
+DURATIONS_FILE = os.path.join(TMP_DIR, "test_durations.json")
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('configs', nargs='+', metavar='CONFIG',
+                        help="configuration file of one environment")
+    parser.add_argument('--durations', default=DURATIONS_FILE,
+                        help="file with the durations of the test classes")
+    argv = sys.argv[1:]
+    nose_args = list()
+    if '--' in argv:
+        nose_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    durations = load_durations(args.durations)
+    shards = split_tests(find_test_classes(), durations, len(args.configs))
+    processes = list()
+    for i, (config, tests) in enumerate(zip(args.configs, shards)):
+        if not tests:
+            LOG.info("Shard %d (%s) has no tests", i, config)
+            continue
+        processes.append((i, start_shard(i, config, tests, nose_args)))
+
+    failed = False
+    for i, process in processes:
+        if process.wait() != 0:
+            LOG.error("Shard %d failed, see %s", i, _log_file(i))
+            failed = True
+        else:
+            LOG.info("Shard %d finished", i)
+        durations.update(read_durations(_xunit_file(i)))
+    save_durations(args.durations, durations)
+    return 1 if failed else 0
+
+
+def find_test_classes():
+    """Get the nose IDs of all the test classes, like "path/file.py:Class".
+
+    The test modules are parsed, not imported, so that the configuration
+    isn't needed.
+    """
+    tests = list()
+    for path in sorted(glob.glob(os.path.join(TEST_DIR, "test_*.py"))):
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in tree.body:
+            if isinstance(node, ast.ClassDef) and node.name.startswith('Test'):
+                tests.append("%s:%s" % (os.path.relpath(path, PROJ_DIR),
+                                        node.name))
+    return tests
+
+
+def split_tests(tests, durations, count):
+    """Split the tests into `count` shards of about the same duration.
+
+    The longest tests are assigned first, always to the shard that has the
+    smallest total duration so far. Tests without a known duration are
+    expected to take the average time.
+
+    :returns: list of lists of tests
+    """
+    known = [durations[t] for t in tests if t in durations]
+    default = sum(known) / len(known) if known else 1.0
+    weighted = sorted(tests, key=lambda t: durations.get(t, default),
+                      reverse=True)
+    shards = [[] for _ in range(count)]
+    totals = [0.0] * count
+    for test in weighted:
+        i = totals.index(min(totals))
+        shards[i].append(test)
+        totals[i] += durations.get(test, default)
+    for i, total in enumerate(totals):
+        LOG.info("Shard %d: %d test classes, expected %d seconds",
+                 i, len(shards[i]), total)
+    return shards
+
+
+def start_shard(index, config, tests, nose_args):
+    """Start nosetests with the tests in the background."""
+    if os.path.exists(_xunit_file(index)):
+        os.remove(_xunit_file(index))
+    env = dict(os.environ)
+    env['MAIN_CONFIG_FILE'] = config
+    env['TESTFILE_DIR'] = os.path.join(TMP_DIR, "test_files%d" % index)
+    cmd = ['nosetests', '--with-xunit', '--xunit-file=%s' % _xunit_file(index),
+           '--id-file=%s' % os.path.join(TMP_DIR, "noseids%d" % index)]
+    cmd.extend(nose_args)
+    cmd.extend(tests)
+    LOG.info("Starting shard %d with %s: %s", index, config, ' '.join(cmd))
+    log = open(_log_file(index), 'w')
+    return subprocess.Popen(cmd, cwd=PROJ_DIR, env=env, stdout=log,
+                            stderr=subprocess.STDOUT)
+
+
+def read_durations(xunit_file):
+    """Sum the durations of the tests in the xunit file by test class.
+
+    :returns: dict {test class ID: seconds}
+    """
+    durations = dict()
+    if not os.path.exists(xunit_file):
+        return durations
+    for case in ElementTree.parse(xunit_file).getroot().iter('testcase'):
+        module, _, cls = case.get('classname').rpartition('.')
+        test = "%s.py:%s" % (module.replace('.', os.sep), cls)
+        durations[test] = durations.get(test, 0.0) + float(case.get('time'))
+    return durations
+
+
+def load_durations(filename):
+    if not os.path.exists(filename):
+        return dict()
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_durations(filename, durations):
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as f:
+        json.dump(durations, f, indent=4, sort_keys=True)
+
+
+def _xunit_file(index):
+    return os.path.join(TMP_DIR, "shard%d.xml" % index)
+
+
+def _log_file(index):
+    if not os.path.exists(TMP_DIR):
+        os.makedirs(TMP_DIR)
+    return os.path.join(TMP_DIR, "shard%d.log" % index)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
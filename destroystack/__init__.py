@@ -17,6 +17,6 @@ import destroystack.tools.server_manager as server_manager
 
 def teardown_package():
     """Disconnect SSH to all servers."""
-    if server_manager.ServerManager._instance:
-        manager = server_manager.ServerManager()
-        manager.disconnect()
+    manager = server_manager.ServerManager.current()
+    if manager:
+        manager.close()
@@ -16,6 +16,7 @@ import nose
 import destroystack.tools.server_manager as server_manager
 import destroystack.tools.common as common
 import destroystack.tools.tempest as tempest
+from destroystack.tools.scheduling import damages
 
 
 class TestRestarts():
@@ -23,7 +24,7 @@ class TestRestarts():
 
     @classmethod
     def setupClass(cls):
-        cls.manager = server_manager.ServerManager()
+        cls.manager = server_manager.ServerManager.open()
         if "tempest" not in common.CONFIG:
             raise nose.SkipTest("Tempest required to verify service restarts")
         cls.manager.save_state()
@@ -35,6 +36,7 @@ class TestRestarts():
         # TODO(mkollaro) also run it when a test fails
         cls.manager.load_state()
 
+    @damages('services')
     def test_nova_compute_restart(self):
         server = self.manager.get(role='compute')
         if not server:
@@ -42,6 +44,7 @@ class TestRestarts():
         server.cmd("service openstack-nova-compute restart")
         tempest.run(test_type="smoke", include="compute.servers")
 
+    @damages('none')
     def test_nova_network_restart(self):
         server = self.manager.get(role='controller')
         if not server:
@@ -52,6 +55,7 @@ class TestRestarts():
             raise nose.SkipTest("Service nova-network doesn't seem to exist")
         tempest.run(test_type="smoke", include="network")
 
+    @damages('services')
     def test_keystone_restart(self):
         server = self.manager.get(role='keystone')
         if not server:
@@ -59,6 +63,7 @@ class TestRestarts():
         server.cmd("service openstack-keystone restart")
         tempest.run(test_type="smoke", include="identity")
 
+    @damages('services')
     def test_swift_proxy_restart(self):
         server = self.manager.get(role='swift_proxy')
         if not server:
@@ -18,6 +18,7 @@ import nose
 from destroystack.tools.server_manager import ServerManager
 from destroystack.tools.swift import Swift
 import destroystack.tools.common as common
+from destroystack.tools.scheduling import damages
 
 REPLICA_COUNT = 3
 
@@ -35,18 +36,19 @@ def requirements(manager):
 
 
 class TestSwiftSmallSetup():
-    swift = None
     manager = None
 
     @classmethod
     def setupClass(cls):
-        cls.manager = ServerManager()
+        cls.manager = ServerManager.open()
         if not requirements(cls.manager):
             raise nose.SkipTest
         cls.manager.save_state()
-        cls.swift = Swift(cls.manager)
 
     def setUp(self):
+        # the servers may change after loading the state, if there is a pool
+        # of standby environments
+        self.swift = Swift(self.manager)
         self.data_servers = self.manager.get_all(role='swift_data')
         common.populate_swift_with_random_files(self.swift)
         # make sure all replicas are distributed before we start killing disks
@@ -55,15 +57,18 @@ class TestSwiftSmallSetup():
     def tearDown(self):
         self.manager.load_state()
 
+    @damages('disks', 'data')
     def test_one_disk_down(self):
         self.data_servers[0].kill_disk()
         self.swift.wait_for_replica_regeneration()
 
+    @damages('disks', 'data')
     def test_two_disks_down(self):
         self.data_servers[0].kill_disk()
         self.data_servers[1].kill_disk()
         self.swift.wait_for_replica_regeneration()
 
+    @damages('disks', 'data')
     def test_one_disk_down_restore(self):
         # kill disk, restore it with all files intact
 
@@ -75,6 +80,7 @@ class TestSwiftSmallSetup():
         # wait until the replicas on handoff nodes get deleted
         self.swift.wait_for_replica_regeneration(exact=True)
 
+    @damages('disks', 'data')
     def test_disk_replacement(self):
         # similar to 'test_one_disk_down_restore', but formats the disk
 
@@ -88,6 +94,7 @@ class TestSwiftSmallSetup():
         # wait until the replicas on handoff nodes get deleted
         self.swift.wait_for_replica_regeneration(exact=True)
 
+    @damages('disks', 'data')
     def test_two_disks_down_third_later(self):
         self.data_servers[0].kill_disk()
         self.data_servers[1].kill_disk()
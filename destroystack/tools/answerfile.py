@@ -0,0 +1,135 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Editing of Packstack answer files without running any commands.
+
+An answer file is an INI file with a single section, "general". It is edited
+line by line, so the comments and the order of the options generated by
+Packstack are kept, and only the changed lines differ when it is saved.
+"""
+
+import difflib
+import logging
+import os
+import re
+
+LOG = logging.getLogger(__name__)
+
+_SECTION_RE = re.compile(r'^\s*\[([^\]]+)\]\s*$')
+_OPTION_RE = re.compile(r'^\s*([^#;=\s][^=]*?)\s*=\s*(.*?)\s*$')
+
+
+class AnswerFile(object):
+    """Packstack answer file, see the module documentation.
+
+    :param path: the file, it doesn't have to exist yet
+    """
+    def __init__(self, path):
+        self.path = path
+        self._original = ''
+        self._lines = list()
+        # {(section, option): index of its line}
+        self._index = dict()
+        if os.path.exists(path):
+            with open(path) as f:
+                self._original = f.read()
+            self._parse(self._original)
+
+    def get(self, option, section='general'):
+        """Get the value of the option, None if it isn't set."""
+        index = self._index.get((section, option))
+        if index is None:
+            return None
+        return _OPTION_RE.match(self._lines[index]).group(2)
+
+    def set(self, option, value, section='general'):
+        """Set the option, it is added to the end of the section if new."""
+        line = "%s=%s" % (option, value)
+        index = self._index.get((section, option))
+        if index is not None:
+            self._lines[index] = line
+            return
+        end = self._section_end(section)
+        if end is None:
+            if self._lines and self._lines[-1].strip():
+                self._lines.append('')
+            self._lines.append("[%s]" % section)
+            end = len(self._lines)
+        self._lines.insert(end, line)
+        self._parse(self.text())
+
+    def update(self, answers, section='general'):
+        """Set all the options from the dict."""
+        for option, value in sorted(answers.items()):
+            self.set(option, value, section)
+
+    def options(self, section='general'):
+        """Get the names of the options in the section, in the file order."""
+        return [option for (s, option), _ in
+                sorted(self._index.items(), key=lambda x: x[1])
+                if s == section]
+
+    def text(self):
+        return "\n".join(self._lines) + "\n" if self._lines else ""
+
+    def diff(self):
+        """Get the unified diff of the changes since the file was read."""
+        return "".join(difflib.unified_diff(
+            self._original.splitlines(True), self.text().splitlines(True),
+            self.path + ".orig", self.path))
+
+    def save(self):
+        """Write the file if it changed, log the differences.
+
+        :returns: the unified diff, empty if nothing changed
+        """
+        diff = self.diff()
+        if not diff:
+            LOG.info("Answer file %s is up to date", self.path)
+            return diff
+        LOG.info("Changes of the answer file %s:\n%s", self.path, diff)
+        with open(self.path, 'w') as f:
+            f.write(self.text())
+        self._original = self.text()
+        return diff
+
+    def _parse(self, text):
+        self._lines = text.splitlines()
+        self._index = dict()
+        section = None
+        for i, line in enumerate(self._lines):
+            match = _SECTION_RE.match(line)
+            if match:
+                section = match.group(1)
+                continue
+            match = _OPTION_RE.match(line)
+            if match and section is not None:
+                self._index[(section, match.group(1))] = i
+
+    def _section_end(self, section):
+        """Index after the last option of the section, None if it's missing.
+        """
+        in_section = False
+        end = None
+        for i, line in enumerate(self._lines):
+            match = _SECTION_RE.match(line)
+            if match:
+                if in_section:
+                    break
+                in_section = match.group(1) == section
+                if in_section:
+                    end = i + 1
+            elif in_section and _OPTION_RE.match(line):
+                end = i + 1
+        return end
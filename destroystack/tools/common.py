@@ -17,16 +17,27 @@ import json
 import random
 import string
 import logging
+import threading
+
+import destroystack.tools.tracing as tracing
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
 PROJ_DIR = os.path.join(os.path.dirname(__file__), "..", "..")
 PROJ_DIR = os.path.normpath(PROJ_DIR)
 CONFIG_DIR = os.path.join(PROJ_DIR, "etc")
 BIN_DIR = os.path.join(PROJ_DIR, "bin")
-TESTFILE_DIR = os.path.join(PROJ_DIR, "tmp", "test_files")
+# local copies of the files uploaded to Swift by the tests
+TESTFILE_DIR = os.environ.get("TESTFILE_DIR",
+                              os.path.join(PROJ_DIR, "tmp", "test_files"))
 
 SUPPORTED_SETUPS = ["swift_small_setup"]
 # file in the ./etc/ direcotry
 MAIN_CONFIG_FILE = os.environ.get("MAIN_CONFIG_FILE", "config.json")
+SCHEMA_FILE = "schema.json"
 
 LOG = logging.getLogger(__name__)
 
@@ -41,7 +52,75 @@ def get_config(filename=MAIN_CONFIG_FILE):
         config = json.load(f)
     return config
 
-CONFIG = get_config()
+
+def validate_config(config, schema_filename=SCHEMA_FILE):
+    """Check the configuration against the JSON schema in CONFIG_DIR.
+
+    The validation is skipped if the `jsonschema` package isn't installed.
+
+    :raises: ConfigException listing all the problems found
+    """
+    try:
+        import jsonschema
+    except ImportError:
+        LOG.debug("jsonschema not installed, configuration not validated")
+        return
+    schema = get_config(schema_filename)
+    errors = sorted(jsonschema.Draft3Validator(schema).iter_errors(config),
+                    key=lambda e: list(e.path))
+    if errors:
+        raise ConfigException("Invalid configuration:\n%s" % "\n".join(
+            "%s: %s" % ("/".join(str(p) for p in e.path), e.message)
+            for e in errors))
+
+
+class LazyConfig(MutableMapping):
+    """The configuration, loaded and validated on the first access.
+
+    Importing the modules doesn't touch the configuration file, so it only
+    has to exist when something actually needs it.
+
+    :param filename: JSON configuration file in CONFIG_DIR
+    """
+    def __init__(self, filename=MAIN_CONFIG_FILE):
+        self.filename = filename
+        self._config = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Get the configuration dict, reading it if it wasn't yet."""
+        if self._config is None:
+            with self._lock:
+                if self._config is None:
+                    config = get_config(self.filename)
+                    validate_config(config)
+                    self._config = config
+        return self._config
+
+    def reload(self):
+        """Forget the loaded configuration, it will be read again."""
+        self._config = None
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+
+    def __delitem__(self, key):
+        del self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __repr__(self):
+        return "LazyConfig(%r)" % self.filename
+
+
+CONFIG = LazyConfig()
 
 
 def get_timeout():
@@ -49,7 +128,7 @@ def get_timeout():
     return CONFIG["timeout"]
 
 
-def get_keystone_auth():
+def get_keystone_auth(keystone_server=None):
     """Get the keystone authentication info from the configuration file.
 
     The auth_url for keystone will be found out from the servers (it will
@@ -58,6 +137,8 @@ def get_keystone_auth():
     be the same as the user name. The password is required in the
     configuration.
 
+    :param keystone_server: `Server` object on which keystone runs, if not
+        given it will be searched for in the configuration
     :returns: (auth_url, user, tenant, password)
     """
     user = CONFIG['keystone'].get('user', 'admin')
@@ -65,15 +146,17 @@ def get_keystone_auth():
     password = CONFIG['keystone']['password']
 
     # find out the auth_url
-    keystone_server = None
-    for server in CONFIG['servers']:
-        if 'roles' in server and 'keystone' in server['roles']:
-            keystone_server = server
-    if not keystone_server:
-        raise Exception("No server with 'keystone' role found")
-    host = keystone_server.get('hostname', None)
-    if not host:
-        host = keystone_server['ip']
+    if keystone_server:
+        host = keystone_server.hostname or keystone_server.ip
+    else:
+        for server in CONFIG['servers']:
+            if 'roles' in server and 'keystone' in server['roles']:
+                keystone_server = server
+        if not keystone_server:
+            raise Exception("No server with 'keystone' role found")
+        host = keystone_server.get('hostname', None)
+        if not host:
+            host = keystone_server['ip']
     auth_url = 'http://%s:5000/v2.0/' % host
     return (auth_url, user, tenant, password)
 
@@ -89,6 +172,7 @@ def upload_files(swift, container, filename_list):
         swift.put_object(container, filename, f)
 
 
+@tracing.traced('populate_swift')
 def populate_swift_with_random_files(swift, prefix='',
                                      container_count=5, files_per_container=5):
     """Create random files in test_files dir and upload them to Swift.
@@ -0,0 +1,206 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Device-mapper layer between the Swift disks and their filesystems.
+
+With "fault_layer" set in the "disks" section of the configuration, every
+Swift disk is wrapped in a device-mapper device named "ds-<disk>", which is
+what gets formatted and mounted. Normally it maps the disk linearly, so it
+behaves just like the disk itself, but its table can be replaced while the
+filesystem is mounted to inject one of the `FAULTS`:
+
+* "error" - all I/O fails
+* "flakey" - the disk works for `up` seconds and then fails all I/O (or just
+  drops the writes) for `down` seconds, periodically, see
+  https://www.kernel.org/doc/Documentation/device-mapper/dm-flakey.txt
+* "delay" - the reads and writes are delayed by `read_ms` and `write_ms`
+  milliseconds, see
+  https://www.kernel.org/doc/Documentation/device-mapper/delay.txt
+
+The throughput of the disks is limited separately, with the blkio cgroup
+controller, see `throttle`.
+
+The functions work with anything that has the `cmd` method, `LocalServer`
+too. For trying them out on a single machine, `create_loop_disks` creates
+disks backed by loop devices.
+"""
+
+import logging
+
+LOG = logging.getLogger(__name__)
+PREFIX = 'ds-'
+FAULTS = ['error', 'flakey', 'delay']
+
+
+def get_name(disk):
+    """Get the name of the device-mapper device wrapping the disk."""
+    return PREFIX + disk.replace('/', '-')
+
+
+def get_device(disk):
+    """Get the device wrapping the disk, relative to /dev/."""
+    return "mapper/" + get_name(disk)
+
+
+def wrap(server, disk):
+    """Create the device-mapper device for the disk, unless it exists.
+
+    The devices don't survive a reboot, so this has to be done again after
+    the server is restored from a snapshot.
+    """
+    name = get_name(disk)
+    result = server.cmd("dmsetup info %s" % name, ignore_failures=True,
+                        log_cmd=False)
+    if result.exit_code == 0:
+        return
+    LOG.info("[%s] Wrapping disk /dev/%s in /dev/%s", server.name, disk,
+             get_device(disk))
+    server.cmd("dmsetup create %s --table '%s'"
+               % (name, _get_table(server, disk)))
+
+
+def unwrap(server, disk):
+    """Remove the device-mapper device of the disk, if it exists.
+
+    The filesystem on it must be unmounted first.
+    """
+    name = get_name(disk)
+    result = server.cmd("dmsetup info %s" % name, ignore_failures=True,
+                        log_cmd=False)
+    if result.exit_code == 0:
+        server.cmd("dmsetup remove --retry %s" % name)
+
+
+def set_fault(server, disk, fault=None, **params):
+    """Replace the table of the device wrapping the disk.
+
+    The new table is loaded first, then the device is suspended (the I/O in
+    flight is finished) and resumed with the new table, the filesystem stays
+    mounted. If the swap fails, the device is resumed anyway.
+
+    :param fault: one of `FAULTS`, None to make the disk work normally again
+    :param params: for "flakey": `up` and `down` in seconds (1 and 1 by
+        default) and `drop_writes`, which drops the writes instead of failing
+        them during the `down` period; for "delay": `read_ms` and `write_ms`
+        (the same as `read_ms` by default)
+    """
+    name = get_name(disk)
+    table = _get_table(server, disk, fault, **params)
+    LOG.info("[%s] Setting fault '%s' on disk /dev/%s: %s", server.name,
+             fault, disk, table)
+    server.cmd("dmsetup load %s --table '%s'" % (name, table))
+    try:
+        server.cmd("dmsetup suspend %s" % name)
+    finally:
+        server.cmd("dmsetup resume %s" % name)
+
+
+def throttle(server, disk, read_bps=None, write_bps=None):
+    """Limit the throughput of the disk with the blkio cgroup controller.
+
+    The limit is set in the root cgroup, so it applies to all the processes.
+    It needs the version 1 of the cgroup hierarchy with the blkio controller
+    mounted.
+
+    :param read_bps: bytes per second, None or 0 to remove the limit
+    :param write_bps: bytes per second, None or 0 to remove the limit
+    """
+    result = server.cmd("awk '$3 == \"cgroup\" && $4 ~ /blkio/ {print $2}'"
+                        " /proc/mounts", log_cmd=False)
+    if not result.out:
+        if not (read_bps or write_bps):
+            return
+        raise Exception("The blkio cgroup controller is not mounted on %s"
+                        % server.name)
+    cgroup = result.out[0].strip()
+    numbers = server.cmd("dmsetup info -c --noheadings -o major,minor %s"
+                         % get_name(disk), log_cmd=False).out[0].strip()
+    LOG.info("[%s] Throttling disk /dev/%s to read %s B/s, write %s B/s",
+             server.name, disk, read_bps or "any", write_bps or "any")
+    for operation, bps in [('read', read_bps), ('write', write_bps)]:
+        server.cmd("echo '%s %d' > %s/blkio.throttle.%s_bps_device"
+                   % (numbers, bps or 0, cgroup, operation))
+
+
+def clear(server, disks):
+    """Make the disks work normally again, remove the throttling too.
+
+    The disks that are not wrapped (yet) are skipped.
+    """
+    for disk in disks:
+        result = server.cmd("dmsetup info %s" % get_name(disk),
+                            ignore_failures=True, log_cmd=False)
+        if result.exit_code != 0:
+            continue
+        set_fault(server, disk)
+        throttle(server, disk)
+
+
+def create_loop_disks(server, count=3, size='1G', image_dir='/var/tmp',
+                      prefix='destroystack-disk'):
+    """Create disks backed by sparse files on loop devices.
+
+    Meant for trying out the fault injection on a single machine.
+
+    :param size: size of each disk
+    :param prefix: prefix of the names of the image files
+    :returns: list of the disks, like ["loop0", "loop1", "loop2"]
+    """
+    disks = list()
+    for i in range(1, count + 1):
+        image = "%s/%s%d.img" % (image_dir, prefix, i)
+        server.cmd("truncate -s %s %s" % (size, image))
+        device = server.cmd("losetup -f --show %s" % image).out[0].strip()
+        disks.append(device[len('/dev/'):])
+    return disks
+
+
+def remove_loop_disks(server, count=3, image_dir='/var/tmp',
+                      prefix='destroystack-disk'):
+    """Remove the disks created by `create_loop_disks`, with their images.
+
+    The filesystems on them must be unmounted first.
+    """
+    for i in range(1, count + 1):
+        image = "%s/%s%d.img" % (image_dir, prefix, i)
+        result = server.cmd("losetup -j %s" % image, ignore_failures=True)
+        for line in result.out:
+            device = line.split(':')[0].strip()
+            unwrap(server, device[len('/dev/'):])
+            server.cmd("losetup -d %s" % device)
+        server.cmd("rm -f %s" % image)
+
+
+def _get_table(server, disk, fault=None, **params):
+    sectors = server.cmd("blockdev --getsz /dev/%s" % disk,
+                         log_cmd=False).out[0].strip()
+    device = "/dev/%s" % disk
+    if fault is None:
+        return "0 %s linear %s 0" % (sectors, device)
+    elif fault == 'error':
+        return "0 %s error" % sectors
+    elif fault == 'flakey':
+        table = "0 %s flakey %s 0 %d %d" % (sectors, device,
+                                            params.get('up', 1),
+                                            params.get('down', 1))
+        if params.get('drop_writes'):
+            table += " 1 drop_writes"
+        return table
+    elif fault == 'delay':
+        read_ms = params.get('read_ms', 0)
+        write_ms = params.get('write_ms', read_ms)
+        return "0 %s delay %s 0 %d %s 0 %d" % (sectors, device, read_ms,
+                                               device, write_ms)
+    raise Exception("Unknown disk fault '%s', use one of %s"
+                    % (fault, ", ".join(FAULTS)))
@@ -0,0 +1,595 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Simulated Swift cluster running inside the DestroyStack process.
+
+It is meant for working on DestroyStack itself without any VMs, not for
+testing Swift. Enable it by adding "fake_cluster" to the configuration file
+(see `etc/config.json.fake.sample`):
+
+    "fake_cluster": {
+        "data_servers": 3,
+        "disks_per_server": 3,
+        "replicas": 3,
+        "part_power": 10,
+        "replication_interval": 0.5
+    }
+
+The cluster consists of:
+    * a proxy - HTTP server on loopback with the Swift API (without
+        authentication), that stores the containers and objects on the
+        devices chosen by the ring
+    * object servers - an HTTP server on loopback for each data server,
+        answering GET and HEAD requests for the replicas on its devices the
+        same way Swift does (200, 404 or 507 if the device is unmounted)
+    * a ring - maps the containers and objects to partitions and partitions
+        to devices, on different servers if possible
+    * a replicator - a background thread that copies missing replicas to
+        the primary devices, or to handoff devices if the primary ones are
+        unmounted, and removes the replicas from handoff devices once they are
+        not needed
+    * fake servers - `Server` objects which emulate the commands DestroyStack
+        runs on them (`mount`, `umount`, `mkfs`, `swift-get-nodes`), so that
+        `kill_disk`, `restore_disk`, `format_disk` and `Swift` work unchanged
+
+The state restoration type "fake" saves and loads the whole state of the
+cluster in memory.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import struct
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlparse
+
+import destroystack.tools.servers as server_tools
+
+LOG = logging.getLogger(__name__)
+
+ACCOUNT = 'AUTH_fake'
+TOKEN = 'fake-token'
+DEFAULTS = {
+    'data_servers': 3,
+    'disks_per_server': 3,
+    'replicas': 3,
+    'part_power': 10,
+    # seconds between two replication passes
+    'replication_interval': 0.5,
+}
+
+
+class Ring(object):
+    """Maps paths to partitions and partitions to devices.
+
+    Each partition gets an ordering of all the devices by rendezvous hashing,
+    rearranged so that the first `replicas` devices (the primary ones) are on
+    different servers if possible. The rest are the handoff devices.
+
+    :param devices: list of (server name, disk) tuples
+    """
+    def __init__(self, devices, replicas=3, part_power=10):
+        self.devices = list(devices)
+        self.replicas = replicas
+        self.part_power = part_power
+        self._assignment = [self._assign(part)
+                            for part in range(2 ** part_power)]
+
+    def get_partition(self, path):
+        digest = hashlib.md5(path.encode('utf-8')).digest()
+        return struct.unpack('>I', digest[:4])[0] >> (32 - self.part_power)
+
+    def get_nodes(self, path):
+        """Get the partition and all the devices for the path.
+
+        :returns: (partition, list of devices), primary devices first
+        """
+        part = self.get_partition(path)
+        return part, self._assignment[part]
+
+    def get_nodes_by_partition(self, part):
+        return self._assignment[part]
+
+    def _assign(self, part):
+        ordered = sorted(self.devices, key=lambda d: hashlib.md5(
+            ("%d/%s/%s" % (part, d[0], d[1])).encode('utf-8')).digest())
+        primary = list()
+        used_servers = set()
+        for device in ordered:
+            if len(primary) < self.replicas and device[0] not in used_servers:
+                primary.append(device)
+                used_servers.add(device[0])
+        for device in ordered:
+            if len(primary) < self.replicas and device not in primary:
+                primary.append(device)
+        return primary + [d for d in ordered if d not in primary]
+
+
+class FakeCluster(object):
+    """The simulated Swift cluster, see the module documentation.
+
+    The replicas are stored by partition, so that the replicator can handle
+    a whole partition with a few set operations. It runs only after something
+    happened to the devices (a disk was unmounted, mounted or formatted, or
+    the state was loaded), because the proxy always stores new data in the
+    right places.
+
+    :param config: dict with the options from `DEFAULTS`
+    """
+    def __init__(self, config=None):
+        self.config = dict(DEFAULTS)
+        self.config.update(config or {})
+        self.lock = threading.RLock()
+        # {container: {object name: contents}}
+        self.containers = dict()
+        # {device: {partition: set of paths of the replicas on it}}
+        self.devices = dict()
+        self.mounted = set()
+        self.labels = dict()
+        self._saved_states = dict()
+        self._http_servers = list()
+        self._stop = threading.Event()
+        # set when the replicator has some work to do
+        self._changed = threading.Event()
+
+        self.proxy = FakeServer(self, 'fake-proxy',
+                                roles=['swift_proxy', 'keystone'])
+        self.data_servers = list()
+        for i in range(self.config['data_servers']):
+            disks = ["sd%s" % chr(ord('b') + j)
+                     for j in range(self.config['disks_per_server'])]
+            server = FakeServer(self, 'fake-data%d' % i, roles=['swift_data'],
+                                extra_disks=disks)
+            self.data_servers.append(server)
+            for disk in disks:
+                self.devices[(server.name, disk)] = dict()
+                self.mounted.add((server.name, disk))
+        self.servers = [self.proxy] + self.data_servers
+        self.ring = Ring(sorted(self.devices), self.config['replicas'],
+                         self.config['part_power'])
+        self._ports = dict()
+        self.storage_url = None
+
+    def start(self):
+        """Start the HTTP servers and the replicator."""
+        proxy = self._start_http_server(_ProxyHandler, self.proxy.name)
+        self.storage_url = "http://127.0.0.1:%d/v1/%s" % (
+            proxy.server_address[1], ACCOUNT)
+        for server in self.data_servers:
+            http = self._start_http_server(_ObjectHandler, server.name)
+            self._ports[server.name] = http.server_address[1]
+        thread = threading.Thread(target=self._replicate_forever,
+                                  name='fake-replicator')
+        thread.daemon = True
+        thread.start()
+        LOG.info("Fake Swift cluster running at %s", self.storage_url)
+
+    def stop(self):
+        self._stop.set()
+        for http in self._http_servers:
+            http.shutdown()
+            http.server_close()
+
+    def get_urls(self, path):
+        """Get the URLs of all the replica locations of the path.
+
+        :returns: list of (URL, is handoff)
+        """
+        part, devices = self.ring.get_nodes(path)
+        return [("http://127.0.0.1:%d/%s/%d%s"
+                 % (self._ports[server], disk, part, path),
+                 i >= self.ring.replicas)
+                for i, (server, disk) in enumerate(devices)]
+
+    def has_replica(self, server, disk, path):
+        """Check the replica like an object server would.
+
+        :returns: HTTP status code
+        """
+        device = (server, disk)
+        part = self.ring.get_partition(path)
+        with self.lock:
+            if device not in self.mounted:
+                return 507
+            if path in self.devices[device].get(part, ()):
+                return 200
+            return 404
+
+    def put(self, container, name=None, contents=b''):
+        """Store the container or object on its devices.
+
+        :raises KeyError: if the container of the object doesn't exist
+        """
+        with self.lock:
+            if name is None:
+                self.containers.setdefault(container, dict())
+                path = _get_path(container)
+            else:
+                self.containers[container][name] = contents
+                path = _get_path(container, name)
+            part, devices = self.ring.get_nodes(path)
+            for device in self._get_target_devices(devices):
+                self.devices[device].setdefault(part, set()).add(path)
+
+    def delete(self, container, name=None):
+        """:raises KeyError: if the container or object doesn't exist"""
+        with self.lock:
+            if name is None:
+                del self.containers[container]
+                path = _get_path(container)
+            else:
+                del self.containers[container][name]
+                path = _get_path(container, name)
+            part = self.ring.get_partition(path)
+            for partitions in self.devices.values():
+                partitions.get(part, set()).discard(path)
+
+    def populate(self, container_count, objects_per_container, size=16):
+        """Quickly create lots of objects, without going trough HTTP."""
+        contents = b'x' * size
+        for i in range(container_count):
+            container = "fake_container%d" % i
+            with self.lock:
+                self.put(container)
+                for j in range(objects_per_container):
+                    self.put(container, "fake_object%d" % j, contents)
+
+    def mount(self, server, disk):
+        with self.lock:
+            self.mounted.add((server, disk))
+        self._changed.set()
+
+    def umount(self, server, disk):
+        with self.lock:
+            self.mounted.discard((server, disk))
+        self._changed.set()
+
+    def format(self, server, disk):
+        with self.lock:
+            self.devices[(server, disk)] = dict()
+            self.labels.pop((server, disk), None)
+        self._changed.set()
+
+    def save_state(self, tag=''):
+        with self.lock:
+            self._saved_states[tag] = self._copy_state()
+        LOG.info("Saved the state of the fake cluster")
+
+    def has_state(self, tag=''):
+        with self.lock:
+            return tag in self._saved_states
+
+    def delete_state(self, tag=''):
+        with self.lock:
+            self._saved_states.pop(tag, None)
+
+    def load_state(self, tag=''):
+        with self.lock:
+            (self.containers, self.devices, self.mounted,
+             self.labels) = self._copy_state(self._saved_states[tag])
+        self._changed.set()
+        LOG.info("Loaded the state of the fake cluster")
+
+    def replicate(self):
+        """Do one replication pass over all the partitions.
+
+        In each partition, all the replicas available on the mounted devices
+        are copied to the target devices and removed from the other mounted
+        devices.
+        """
+        for part in range(2 ** self.ring.part_power):
+            with self.lock:
+                devices = self.ring.get_nodes_by_partition(part)
+                available = set()
+                for device in devices:
+                    if device in self.mounted:
+                        available.update(self.devices[device].get(part, ()))
+                if not available:
+                    continue
+                targets = self._get_target_devices(devices)
+                for device in devices:
+                    if device in targets:
+                        self.devices[device][part] = set(available)
+                    elif device in self.mounted:
+                        # handoff replicas that are not needed anymore
+                        self.devices[device].pop(part, None)
+
+    def _get_target_devices(self, devices):
+        """Get the mounted primary devices, replaced by handoffs if needed.
+
+        :param devices: all the devices of a partition, see `Ring.get_nodes`
+        """
+        replicas = self.ring.replicas
+        targets = [d for d in devices[:replicas] if d in self.mounted]
+        handoffs = (d for d in devices[replicas:] if d in self.mounted)
+        for device in handoffs:
+            if len(targets) >= replicas:
+                break
+            targets.append(device)
+        return targets
+
+    def _copy_state(self, state=None):
+        """Copy (containers, devices, mounted, labels), current by default."""
+        if state is None:
+            state = (self.containers, self.devices, self.mounted, self.labels)
+        containers, devices, mounted, labels = state
+        return (dict((c, dict(o)) for c, o in containers.items()),
+                dict((d, dict((p, set(s)) for p, s in parts.items()))
+                     for d, parts in devices.items()),
+                set(mounted), dict(labels))
+
+    def _replicate_forever(self):
+        while not self._stop.is_set():
+            self._stop.wait(self.config['replication_interval'])
+            if not self._changed.is_set():
+                continue
+            self._changed.clear()
+            start = time.time()
+            self.replicate()
+            LOG.debug("Replication pass took %.2f seconds",
+                      time.time() - start)
+
+    def _start_http_server(self, handler, server_name):
+        http = _ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        http.cluster = self
+        http.fake_server_name = server_name
+        thread = threading.Thread(target=http.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self._http_servers.append(http)
+        return http
+
+
+class FakeServer(server_tools.Server):
+    """A server of the fake cluster, emulates the commands run on servers.
+
+    Commands other than those in `_COMMANDS` succeed without doing anything.
+    """
+    _COMMANDS = [
+        (re.compile(r'swift-get-nodes\s+-a\s+\S+\s+(.*?)\s*(\||$)'),
+         '_get_nodes'),
+        (re.compile(r'\bumount\b.*?/dev/(\w+)'), '_umount'),
+        (re.compile(r'\bmount\s+(?:-o\s*\S+\s+)?/dev/(\w+)'), '_mount'),
+        (re.compile(r'\bmkfs\.\w+\b.*?/dev/(\w+)'), '_mkfs'),
+    ]
+
+    def __init__(self, cluster, name, roles=None, extra_disks=None):
+        self.cluster = cluster
+        self.hostname = name
+        self.ip = '127.0.0.1'
+        self.name = name
+        self.roles = set(roles or [])
+        self.disks = extra_disks or []
+        self.lvm_volumes = []
+        self.vm_id = None
+
+    def connect(self, timeout=None):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def cmd(self, command, ignore_failures=False, log_cmd=True,
+            log_output=False, **kwargs):
+        if log_cmd:
+            LOG.info("[%s] %s", self.name, command)
+        result = server_tools.CommandResult(self.name, command)
+        out = list()
+        for part in command.split(';'):
+            for pattern, method in self._COMMANDS:
+                for match in pattern.finditer(part):
+                    out.extend(getattr(self, method)(match) or [])
+        result.parse_subprocess_results("\n".join(out), "", 0)
+        return result
+
+    def get_mount_points(self):
+        with self.cluster.lock:
+            return dict((disk, "/srv/node/%s" % disk) for disk in self.disks
+                        if (self.name, disk) in self.cluster.mounted)
+
+    def get_disk_label(self, disk):
+        return self.cluster.labels.get((self.name, disk), '')
+
+    def set_disk_label(self, disk, label):
+        self.cluster.labels[(self.name, disk)] = label
+        return True
+
+    def wait_for_disk_init(self):
+        pass
+
+    def get_device(self, disk):
+        return disk
+
+    def set_disk_fault(self, disk, fault=None, **params):
+        LOG.warning("[%s] Disk faults are not simulated, ignoring '%s' on %s",
+                    self.name, fault, disk)
+
+    def throttle_disk(self, disk, read_bps=None, write_bps=None):
+        LOG.warning("[%s] Disk throttling is not simulated", self.name)
+
+    def clear_disk_faults(self):
+        pass
+
+    def degrade_network(self, peers, **params):
+        LOG.warning("[%s] Network faults are not simulated", self.name)
+
+    def block_network(self, peers):
+        LOG.warning("[%s] Network faults are not simulated", self.name)
+
+    def clear_network_faults(self):
+        pass
+
+    def count_replication_traffic(self, peers):
+        # the simulated cluster doesn't have any network traffic
+        return False
+
+    def stop_counting_replication_traffic(self):
+        pass
+
+    def get_replication_bytes(self):
+        return None
+
+    def _get_nodes(self, match):
+        path = '/' + '/'.join(match.group(1).split())
+        return ['curl -I -XHEAD "%s"%s' % (url, " # [Handoff]" if handoff
+                                           else "")
+                for url, handoff in self.cluster.get_urls(path)]
+
+    def _umount(self, match):
+        self.cluster.umount(self.name, match.group(1))
+
+    def _mount(self, match):
+        self.cluster.mount(self.name, match.group(1))
+
+    def _mkfs(self, match):
+        self.cluster.format(self.name, match.group(1))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '') == 'chunked':
+            chunks = list()
+            while True:
+                size = int(self.rfile.readline().strip().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+
+class _ObjectHandler(_Handler):
+    """Answers the requests for replicas: /<disk>/<partition>/<path>."""
+    def do_GET(self):
+        disk, _, path = unquote(self.path).lstrip('/').split('/', 2)
+        status = self.server.cluster.has_replica(
+            self.server.fake_server_name, disk, '/' + path)
+        self._respond(status)
+
+    do_HEAD = do_GET
+
+
+class _ProxyHandler(_Handler):
+    """Swift API: /v1/<account>[/<container>[/<object>]]."""
+    def do_GET(self):
+        cluster = self.server.cluster
+        container, name, query = self._parse_path()
+        with cluster.lock:
+            if container is None:
+                listing = [{'name': c, 'count': len(objs),
+                            'bytes': sum(len(o) for o in objs.values())}
+                           for c, objs in sorted(cluster.containers.items())]
+            elif container not in cluster.containers:
+                return self._respond(404)
+            elif name is None:
+                objects = cluster.containers[container]
+                listing = [{'name': o, 'bytes': len(objects[o]),
+                            'hash': hashlib.md5(objects[o]).hexdigest(),
+                            'content_type': 'application/octet-stream',
+                            'last_modified': '2013-01-01T00:00:00.000000'}
+                           for o in sorted(objects)]
+            elif name in cluster.containers[container]:
+                contents = cluster.containers[container][name]
+                return self._respond(200, contents, {
+                    'Etag': hashlib.md5(contents).hexdigest()})
+            else:
+                return self._respond(404)
+        marker = query.get('marker', [''])[0]
+        listing = [i for i in listing if i['name'] > marker]
+        if 'limit' in query:
+            listing = listing[:int(query['limit'][0])]
+        if not listing:
+            return self._respond(204)
+        self._respond(200, json.dumps(listing).encode('utf-8'),
+                      {'Content-Type': 'application/json; charset=utf-8'})
+
+    def do_HEAD(self):
+        cluster = self.server.cluster
+        container, name, _ = self._parse_path()
+        with cluster.lock:
+            if container is None:
+                return self._respond(204, headers={
+                    'X-Account-Container-Count': len(cluster.containers)})
+            objects = cluster.containers.get(container)
+            if objects is None or (name is not None and name not in objects):
+                return self._respond(404)
+            if name is None:
+                return self._respond(204, headers={
+                    'X-Container-Object-Count': len(objects)})
+            return self._respond(200, headers={
+                'Etag': hashlib.md5(objects[name]).hexdigest()})
+
+    def do_PUT(self):
+        cluster = self.server.cluster
+        container, name, _ = self._parse_path()
+        body = self._read_body()
+        try:
+            cluster.put(container, name, body)
+        except KeyError:
+            return self._respond(404)
+        headers = dict()
+        if name is not None:
+            headers['Etag'] = hashlib.md5(body).hexdigest()
+        self._respond(201, headers=headers)
+
+    def do_DELETE(self):
+        container, name, _ = self._parse_path()
+        try:
+            self.server.cluster.delete(container, name)
+        except KeyError:
+            return self._respond(404)
+        self._respond(204)
+
+    def _parse_path(self):
+        """:returns: (container or None, object name or None, query dict)"""
+        url = urlparse(self.path)
+        parts = url.path.lstrip('/').split('/', 3)[2:]
+        parts = [unquote(p) for p in parts if p] + [None, None]
+        return parts[0], parts[1], parse_qs(url.query)
+
+
+def _get_path(container, name=None):
+    if name is None:
+        return "/%s/%s" % (ACCOUNT, container)
+    return "/%s/%s/%s" % (ACCOUNT, container, name)
@@ -0,0 +1,267 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Store of the recovery times, for finding out if Swift heals slower.
+
+Each wait for replica regeneration is recorded into a local SQLite database
+together with the name of the test, the topology of the cluster and the
+OpenStack version. Nothing is recorded unless the database is given, by the
+environment variable DESTROYSTACK_METRICS_DB or by "metrics.database" in
+the configuration. The phases of the recovery are:
+    * replicas - until there are enough replicas of everything
+    * primary_replicas - until the primary nodes have all the replicas
+    * handoff_cleanup - until the replicas on handoff nodes get deleted
+
+If a test (or its setUp, which is recorded under its own name) waits for the
+same phase more than once, the second wait is recorded as "<phase>#2" and so
+on, so that each wait has its own series.
+
+The throughput is saved the same way, together with the network faults that
+were in place (see `tools.network_faults`). Its kinds are:
+    * replication - bytes the data servers received from each other on the
+      rsync and storage server ports while waiting for the replicas, only
+      with `measure_traffic` (see `Swift.wait_for_replica_regeneration`)
+    * upload, download - objects transferred by the client
+
+`find_regressions` compares the latest measurements with a rolling baseline
+made of the previous ones, see `bin/recovery_report.py`.
+"""
+
+import inspect
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import destroystack.tools.common as common
+
+LOG = logging.getLogger(__name__)
+
+# how many previous measurements make the baseline
+BASELINE_SIZE = 10
+# measurements needed in the baseline before anything is reported
+MIN_BASELINE_SIZE = 5
+# how many standard deviations above the baseline mean is a slowdown
+Z_THRESHOLD = 3.0
+# slowdowns smaller than this are ignored even if significant, relative
+MIN_SLOWDOWN = 0.1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS recovery (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recorded_at REAL NOT NULL,
+    test TEXT NOT NULL,
+    topology TEXT NOT NULL,
+    openstack_version TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    outcome TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS recovery_key
+    ON recovery (test, topology, openstack_version, phase, recorded_at);
+CREATE TABLE IF NOT EXISTS throughput (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recorded_at REAL NOT NULL,
+    test TEXT NOT NULL,
+    topology TEXT NOT NULL,
+    openstack_version TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    conditions TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    seconds REAL NOT NULL
+);
+"""
+
+_lock = threading.Lock()
+# how many times each (test, phase) was recorded, by the test class instance
+_phase_counts = {'instance': None, 'counts': dict()}
+
+
+def get_database():
+    """Get the path to the database file, None if the recording is off.
+
+    The environment variable DESTROYSTACK_METRICS_DB takes precedence over
+    "metrics.database" in the configuration.
+    """
+    configured = common.CONFIG.get('metrics', {}).get('database')
+    return os.environ.get('DESTROYSTACK_METRICS_DB', configured)
+
+
+def connect(database=None):
+    """Open the database and create the tables if necessary."""
+    database = database or get_database()
+    if not database:
+        raise Exception("No metrics database given, set"
+                        " DESTROYSTACK_METRICS_DB or \"metrics.database\"")
+    if not os.path.exists(os.path.dirname(os.path.abspath(database))):
+        os.makedirs(os.path.dirname(os.path.abspath(database)))
+    connection = sqlite3.connect(database)
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def record_recovery(phase, seconds, outcome, topology, openstack_version,
+                    test=None, database=None):
+    """Save one measurement, never fails the test because of the database.
+
+    :param phase: see the module documentation
+    :param outcome: "ok", "timeout" or "error"
+    :param test: name of the test, found out from the call stack by default
+    """
+    database = database or get_database()
+    if not database:
+        return
+    instance, found_test = _find_test()
+    test = test or found_test
+    phase = _number_phase(instance, test, phase)
+    LOG.info("Recovery phase '%s' of %s took %.1f seconds (%s)",
+             phase, test, seconds, outcome)
+    try:
+        with _lock:
+            connection = connect(database)
+            with connection:
+                connection.execute(
+                    "INSERT INTO recovery (recorded_at, test, topology,"
+                    " openstack_version, phase, seconds, outcome)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (time.time(), test, topology, openstack_version, phase,
+                     seconds, outcome))
+            connection.close()
+    except (sqlite3.Error, OSError) as e:
+        LOG.warning("Could not save the recovery time: %s", e)
+
+
+def record_throughput(kind, transferred, seconds, conditions, topology,
+                      openstack_version, test=None, database=None):
+    """Save one throughput measurement, never fails the test either.
+
+    :param kind: see the module documentation
+    :param transferred: number of bytes
+    :param conditions: description of the network faults, see
+        `network_faults.get_conditions`
+    :param test: name of the test, found out from the call stack by default
+    """
+    database = database or get_database()
+    if not database:
+        return
+    test = test or find_test_name()
+    LOG.info("Throughput of '%s' in %s: %.2f MB/s (%d bytes in %.1f seconds,"
+             " network faults: %s)", kind, test,
+             transferred / max(seconds, 1e-6) / 2 ** 20, transferred,
+             seconds, conditions)
+    try:
+        with _lock:
+            connection = connect(database)
+            with connection:
+                connection.execute(
+                    "INSERT INTO throughput (recorded_at, test, topology,"
+                    " openstack_version, kind, conditions, bytes, seconds)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (time.time(), test, topology, openstack_version, kind,
+                     conditions, transferred, seconds))
+            connection.close()
+    except (sqlite3.Error, OSError) as e:
+        LOG.warning("Could not save the throughput: %s", e)
+
+
+def find_regressions(database=None, baseline_size=BASELINE_SIZE,
+                     z_threshold=Z_THRESHOLD):
+    """Compare the latest successful measurement of each recovery phase with
+    the baseline made of the `baseline_size` previous ones.
+
+    :returns: list of dicts with the keys "test", "topology",
+        "openstack_version", "phase", "seconds", "mean", "stdev", "z" and
+        "regression" (bool), one for each recovery phase
+    """
+    connection = connect(database)
+    rows = connection.execute(
+        "SELECT test, topology, openstack_version, phase, seconds"
+        " FROM recovery WHERE outcome = 'ok'"
+        " ORDER BY test, topology, openstack_version, phase, recorded_at"
+    ).fetchall()
+    connection.close()
+
+    series = dict()
+    for test, topology, version, phase, seconds in rows:
+        series.setdefault((test, topology, version, phase), []).append(
+            seconds)
+    report = list()
+    for key in sorted(series):
+        values = series[key]
+        latest = values[-1]
+        baseline = values[-baseline_size - 1:-1]
+        mean, stdev = _mean_stdev(baseline)
+        z = None
+        regression = False
+        if len(baseline) >= MIN_BASELINE_SIZE:
+            # avoid division by zero for perfectly stable baselines
+            z = (latest - mean) / max(stdev, mean * 0.01, 1e-6)
+            slower = latest > mean * (1 + MIN_SLOWDOWN)
+            regression = z > z_threshold and slower
+        report.append({'test': key[0], 'topology': key[1],
+                       'openstack_version': key[2], 'phase': key[3],
+                       'seconds': latest, 'mean': mean, 'stdev': stdev,
+                       'z': z, 'regression': regression})
+    return report
+
+
+def find_test_name():
+    """Find the test method in the call stack.
+
+    :returns: "module.Class.method" of the nearest method of a test class, or
+        "unknown"
+    """
+    return _find_test()[1]
+
+
+def _find_test():
+    """Get the test class instance and `find_test_name`, (None, "unknown")."""
+    frame = inspect.currentframe()
+    while frame is not None:
+        instance = frame.f_locals.get('self')
+        if instance is not None \
+                and type(instance).__name__.startswith('Test'):
+            cls = type(instance)
+            return instance, "%s.%s.%s" % (cls.__module__, cls.__name__,
+                                           frame.f_code.co_name)
+        frame = frame.f_back
+    return None, "unknown"
+
+
+def _number_phase(instance, test, phase):
+    """Add "#<n>" to the phase if it's the n-th wait for it in the test.
+
+    The counting starts over for every test class instance (nose creates one
+    for each test).
+    """
+    with _lock:
+        if instance is not _phase_counts['instance']:
+            _phase_counts['instance'] = instance
+            _phase_counts['counts'] = dict()
+        counts = _phase_counts['counts']
+        counts[test, phase] = counts.get((test, phase), 0) + 1
+        if counts[test, phase] == 1:
+            return phase
+        return "%s#%d" % (phase, counts[test, phase])
+
+
+def _mean_stdev(values):
+    if not values:
+        return None, None
+    mean = sum(values) / len(values)
+    if len(values) < 2:
+        return mean, 0.0
+    variance = sum((v - mean) ** 2 for v in values) / (len(values) - 1)
+    return mean, math.sqrt(variance)
@@ -0,0 +1,189 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Network faults between the servers with the given roles.
+
+The faults are injected with `Server.degrade_network` (tc netem) and
+`Server.block_network` (iptables) on the servers of both roles, and removed
+when the `degraded` or `partitioned` block ends:
+
+    with network_faults.degraded(manager, 'swift_data', 'swift_data',
+                                 delay_ms=100, loss=1):
+        swift.wait_for_replica_regeneration()
+
+They are also removed every time the state of the servers is loaded, even if
+the restoration itself is skipped. The faults that are in place are described
+by `get_conditions`, which is saved with the throughput measurements (see
+`Swift.measure_throughput` and `tools.metrics`).
+
+For trying the faults out on a single machine, `create_namespaces` creates
+servers in network namespaces connected by a bridge.
+"""
+
+import contextlib
+import logging
+import destroystack.tools.parallel as parallel
+import destroystack.tools.servers as servers
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+LOG = logging.getLogger(__name__)
+
+# descriptions of the faults that are in place
+_conditions = list()
+
+
+def degrade(server_manager, role, other_role, **params):
+    """Degrade the links between the servers with the two roles.
+
+    Both directions are degraded, so the delay is added twice to the round
+    trip. Only one degradation can be in place on a server at a time, the
+    next one replaces it.
+
+    :param params: see `Server.degrade_network`
+    """
+    peers = _get_peers(server_manager, role, other_role)
+    parallel.run_parallel(
+        lambda server: server.degrade_network(peers[server], **params),
+        list(peers.keys()))
+    _conditions.append("%s<->%s %s" % (role, other_role, " ".join(
+        "%s=%s" % item for item in sorted(params.items()))))
+
+
+def partition(server_manager, role, other_role):
+    """Cut the servers with the two roles off each other."""
+    peers = _get_peers(server_manager, role, other_role)
+    parallel.run_parallel(
+        lambda server: server.block_network(peers[server]),
+        [s for s in peers if role in s.roles])
+    _conditions.append("%s</>%s" % (role, other_role))
+
+
+def clear(server_manager):
+    """Remove the network faults from all the servers."""
+    parallel.run_parallel(lambda server: server.clear_network_faults(),
+                          server_manager.get_all())
+    clear_conditions()
+
+
+def clear_conditions():
+    """Forget the faults in place, they were removed some other way."""
+    del _conditions[:]
+
+
+@contextlib.contextmanager
+def degraded(server_manager, role, other_role, **params):
+    """Degrade the links for the duration of the block, see `degrade`."""
+    try:
+        degrade(server_manager, role, other_role, **params)
+        yield
+    finally:
+        clear(server_manager)
+
+
+@contextlib.contextmanager
+def partitioned(server_manager, role, other_role):
+    """Partition the network for the duration of the block."""
+    try:
+        partition(server_manager, role, other_role)
+        yield
+    finally:
+        clear(server_manager)
+
+
+def get_conditions():
+    """Describe the network faults in place, "none" if there are none."""
+    return ", ".join(_conditions) or "none"
+
+
+def _get_peers(server_manager, role, other_role):
+    """Get dict {server: list of the servers it should be cut off from}.
+
+    A server with both roles is not cut off from itself.
+    """
+    group = server_manager.get_all(role=role)
+    others = server_manager.get_all(role=other_role)
+    peers = dict()
+    for server in group:
+        peers.setdefault(server, set()).update(others)
+    for server in others:
+        peers.setdefault(server, set()).update(group)
+    return dict((server, [p for p in peer_set if p is not server])
+                for server, peer_set in peers.items())
+
+
+class NamespaceServer(servers.Server):
+    """A "server" in a network namespace on this machine.
+
+    The commands are run locally with `ip netns exec`, so the namespace has
+    its own interfaces, qdiscs and iptables rules. It has no disks.
+    """
+    def __init__(self, namespace, ip, roles=None):
+        self.namespace = namespace
+        self.hostname = None
+        self.ip = ip
+        self.name = namespace
+        self.roles = roles or set()
+        self.disks = []
+        self.lvm_volumes = []
+        self.vm_id = None
+
+    def connect(self, timeout=None):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def cmd(self, command, **kwargs):
+        return servers.LocalServer.cmd(
+            self, "ip netns exec %s sh -c %s" % (self.namespace,
+                                                 quote(command)), **kwargs)
+
+
+def create_namespaces(count=2, prefix='ds-ns', subnet='10.199.0'):
+    """Create network namespaces connected by a bridge, needs root.
+
+    :param prefix: prefix of the names of the namespaces and the interfaces
+    :param subnet: first three numbers of the /24 subnet of the namespaces
+    :returns: list of `NamespaceServer`, their IPs are subnet.1, subnet.2, ...
+    """
+    host = servers.LocalServer()
+    bridge = "%s-br" % prefix
+    host.cmd("ip link add %s type bridge && ip link set %s up"
+             % (bridge, bridge))
+    namespaces = list()
+    for i in range(1, count + 1):
+        namespace = "%s%d" % (prefix, i)
+        outside, inside = "%s-out%d" % (prefix, i), "%s-in%d" % (prefix, i)
+        host.cmd("ip netns add %s && ip link add %s type veth peer name %s"
+                 " && ip link set %s netns %s && ip link set %s master %s"
+                 " && ip link set %s up" % (namespace, outside, inside,
+                                            inside, namespace, outside,
+                                            bridge, outside))
+        server = NamespaceServer(namespace, "%s.%d" % (subnet, i))
+        server.cmd("ip addr add %s/24 dev %s && ip link set %s up"
+                   " && ip link set lo up" % (server.ip, inside, inside))
+        namespaces.append(server)
+    return namespaces
+
+
+def remove_namespaces(count=2, prefix='ds-ns'):
+    """Remove what `create_namespaces` created."""
+    host = servers.LocalServer()
+    for i in range(1, count + 1):
+        host.cmd("ip netns del %s%d" % (prefix, i), ignore_failures=True)
+    host.cmd("ip link del %s-br" % prefix, ignore_failures=True)
@@ -0,0 +1,190 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run the same operation on multiple servers (or disks) at once.
+
+Most of the time spent by the tools is waiting on SSH commands, so plain
+threads are good enough to do the work on all servers concurrently.
+
+Work made of dependent steps, like partitioning and then formatting the
+disks of each server, can be described as `Task` objects and run by
+`run_tasks`, which starts every task as soon as the tasks it requires are
+finished. Usually the tasks on one server form a chain and the servers don't
+wait for each other, so the whole run takes as long as the slowest server.
+"""
+
+import logging
+import sys
+import threading
+import time
+import destroystack.tools.timeout as timeout_tools
+import destroystack.tools.tracing as tracing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+LOG = logging.getLogger(__name__)
+
+
+def run_parallel(func, items):
+    """Call `func(item)` for every item, each call in its own thread.
+
+    All the calls are allowed to finish, even if some of them fail.
+
+    :param func: function that takes a single argument
+    :param items: iterable of arguments for `func`, e.g. a list of servers;
+        the current `timeout.Deadline` applies to the calls too
+    :returns: list of the return values, in the same order as `items`
+    :raises: the first exception that was raised by any of the calls
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    deadline = timeout_tools.Deadline()
+
+    def worker(index, item):
+        try:
+            with deadline:
+                results[index] = func(item)
+        except Exception:
+            errors[index] = sys.exc_info()
+
+    threads = [threading.Thread(target=worker, args=(i, item))
+               for i, item in enumerate(items)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    failed = [(item, error) for item, error in zip(items, errors) if error]
+    for item, error in failed:
+        LOG.error("Parallel operation on '%s' failed", item, exc_info=error)
+    if failed:
+        raise failed[0][1][1]
+    return results
+
+
+class Task(object):
+    """A step of the work done by `run_tasks`.
+
+    :param name: unique name, used in the progress report and by `requires`
+        of the other tasks, e.g. "format disks on server1"
+    :param func: function without arguments
+    :param requires: names of the tasks that have to finish first
+    """
+    def __init__(self, name, func, requires=()):
+        self.name = name
+        self.func = func
+        self.requires = list(requires)
+
+    def __repr__(self):
+        return "Task(%r)" % self.name
+
+
+def run_tasks(tasks):
+    """Run the tasks, each in its own thread when its requirements finish.
+
+    The progress is logged as the tasks finish. If a task fails, the tasks
+    that require it (directly or not) are skipped and the others are allowed
+    to finish.
+
+    :param tasks: list of `Task`; the current `timeout.Deadline` applies to
+        them too
+    :returns: dict {task name: return value of its function}
+    :raises: the first exception raised by any of the tasks, or Exception if
+        the names are not unique or the requirements are unknown or cyclic
+    """
+    _check_requirements(tasks)
+    tasks = dict((task.name, task) for task in tasks)
+    deadline = timeout_tools.Deadline()
+    finished = queue.Queue()
+    results = dict()
+    errors = list()
+    waiting = dict(tasks)
+    running = set()
+    done = set()
+
+    def worker(task):
+        start = time.time()
+        try:
+            with deadline:
+                with tracing.span(task.name, category='task'):
+                    result = task.func()
+            finished.put((task, time.time() - start, result, None))
+        except Exception:
+            finished.put((task, time.time() - start, None, sys.exc_info()))
+
+    while waiting or running:
+        for name, task in list(waiting.items()):
+            if all(required in done for required in task.requires):
+                del waiting[name]
+                running.add(name)
+                thread = threading.Thread(target=worker, args=(task,))
+                thread.daemon = True
+                thread.start()
+        if not running:
+            # everything left requires a failed task
+            for name in sorted(waiting):
+                LOG.warning("Skipping '%s', a task it requires failed", name)
+            break
+        task, seconds, result, error = finished.get()
+        running.remove(task.name)
+        if error:
+            LOG.error("[%d/%d] '%s' failed after %.1fs",
+                      len(done) + len(errors) + 1, len(tasks), task.name,
+                      seconds, exc_info=error)
+            errors.append(error)
+            continue
+        done.add(task.name)
+        results[task.name] = result
+        LOG.info("[%d/%d] '%s' finished in %.1fs", len(done) + len(errors),
+                 len(tasks), task.name, seconds)
+    if errors:
+        raise errors[0][1]
+    return results
+
+
+def _check_requirements(tasks):
+    """Make sure the names are unique, the required tasks exist and there are
+    no cycles.
+
+    :param tasks: list of `Task`
+    """
+    names = [task.name for task in tasks]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise Exception("Tasks with duplicate names: %s"
+                        % ", ".join(duplicates))
+    tasks = dict((task.name, task) for task in tasks)
+    for task in tasks.values():
+        for required in task.requires:
+            if required not in tasks:
+                raise Exception("Task '%s' requires an unknown task '%s'"
+                                % (task.name, required))
+    resolved = set()
+    remaining = set(tasks)
+    while remaining:
+        ready = set(name for name in remaining
+                    if resolved.issuperset(tasks[name].requires))
+        if not ready:
+            raise Exception("Tasks with cyclic requirements: %s"
+                            % ", ".join(sorted(remaining)))
+        resolved.update(ready)
+        remaining.difference_update(ready)
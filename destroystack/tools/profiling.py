@@ -0,0 +1,198 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Profile the DestroyStack process itself during each test.
+
+This shows the CPU hot spots in our own code (parsing of command output,
+configuration access, HTTP requests...), not in the tested system. Enable it
+with `--with-destroystack-profile` or by setting the environment variable
+DESTROYSTACK_PROFILE_DIR. There are two modes, chosen by `--profile-mode`:
+
+    * sample (default) - a background thread periodically looks at the stacks
+        of all the other threads, which has a low overhead and covers the
+        threads of `parallel.run_parallel` too. Each stack is weighted by the
+        CPU time (in microseconds) its thread used since the previous sample,
+        so the threads waiting for SSH commands, HTTP responses or locks
+        don't show up. For each test, a `<test>.folded` file with collapsed
+        stacks is written, which can be turned into a flame graph with
+        `flamegraph.pl` or speedscope. The CPU time of the threads is read
+        from /proc and needs Python 3.8 - otherwise every sample counts as
+        one, which measures the wall-clock time including the waiting, and the
+        file is named `<test>.wall.folded` instead.
+    * cprofile - deterministic profiling of the main thread with cProfile,
+        writes a `<test>.pstats` file for each test, which can be read with
+        the `pstats` module, `snakeviz` or converted by `flameprof`.
+
+The files are written into `tmp/profiles/` by default.
+"""
+
+import cProfile
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import nose.plugins
+import destroystack.tools.common as common
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PROFILE_DIR = os.path.join(common.PROJ_DIR, "tmp", "profiles")
+# seconds between two samples of the stacks
+SAMPLING_INTERVAL = 0.005
+
+
+class StackSampler(object):
+    """Sum the CPU time of each stack seen in all the other threads.
+
+    If the CPU time of the threads is unknown, `clock` is "wall" and the
+    number of times each stack was seen is counted instead.
+    """
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        self.interval = interval
+        self.stacks = dict()
+        self.clock = 'cpu' if _get_cpu_times() else 'wall'
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.clock == 'wall':
+            LOG.warning("CPU time of the threads unknown, profiling"
+                        " wall-clock time")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='destroystack-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, filename):
+        """Write the stacks in the collapsed format, one per line."""
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("%s %d\n" % (stack, count))
+
+    def _run(self):
+        own_id = threading.current_thread().ident
+        last_times = _get_cpu_times()
+        while not self._stop.is_set():
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            if self.clock == 'cpu':
+                times = _get_cpu_times() or dict()
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                if self.clock == 'cpu':
+                    if thread_id not in times:
+                        continue
+                    # nanoseconds to microseconds, idle threads are skipped
+                    used = times[thread_id] - last_times.get(thread_id, 0)
+                    weight = used // 1000
+                    if weight <= 0:
+                        continue
+                else:
+                    weight = 1
+                stack = ";".join(reversed(_get_frame_names(frame)))
+                self.stacks[stack] = self.stacks.get(stack, 0) + weight
+            if self.clock == 'cpu':
+                last_times = times
+
+
+class ProfilerPlugin(nose.plugins.Plugin):
+    """Write a profile of the DestroyStack process for each test."""
+    name = 'destroystack-profile'
+
+    def options(self, parser, env):
+        super(ProfilerPlugin, self).options(parser, env)
+        parser.add_option('--profile-dir', dest='profile_dir',
+                          default=env.get('DESTROYSTACK_PROFILE_DIR'),
+                          help="Directory for the profiles, enables the"
+                               " profiling [DESTROYSTACK_PROFILE_DIR]")
+        parser.add_option('--profile-mode', dest='profile_mode',
+                          choices=['sample', 'cprofile'], default='sample',
+                          help="Either 'sample' or 'cprofile'")
+
+    def configure(self, options, conf):
+        super(ProfilerPlugin, self).configure(options, conf)
+        if options.profile_dir:
+            self.enabled = True
+        self.profile_dir = options.profile_dir or DEFAULT_PROFILE_DIR
+        self.mode = options.profile_mode
+        self._profiler = None
+
+    def begin(self):
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+
+    def beforeTest(self, test):
+        if self.mode == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._profiler = StackSampler()
+            self._profiler.start()
+
+    def afterTest(self, test):
+        if self._profiler is None:
+            return
+        name = re.sub(r'[^\w.-]', '_', test.id())
+        if self.mode == 'cprofile':
+            self._profiler.disable()
+            filename = os.path.join(self.profile_dir, name + ".pstats")
+            self._profiler.dump_stats(filename)
+        else:
+            self._profiler.stop()
+            if self._profiler.clock == 'wall':
+                name += ".wall"
+            filename = os.path.join(self.profile_dir, name + ".folded")
+            self._profiler.write(filename)
+        LOG.info("Profile of %s written into %s", test.id(), filename)
+        self._profiler = None
+
+
+def _get_cpu_times():
+    """Get dict {thread ident: CPU time used by the thread in nanoseconds}.
+
+    Threads that are not known to the `threading` module are not included.
+
+    :returns: None if the CPU time of the threads is not available
+    """
+    times = dict()
+    for thread in threading.enumerate():
+        native_id = getattr(thread, 'native_id', None)
+        if native_id is None:
+            return None
+        try:
+            with open("/proc/self/task/%d/schedstat" % native_id) as f:
+                times[thread.ident] = int(f.read().split()[0])
+        except (IOError, OSError):
+            # the thread has just finished, or there is no /proc
+            continue
+    return times or None
+
+
+def _get_frame_names(frame):
+    """Get "module:function" for the frame and all its callers."""
+    names = list()
+    while frame is not None:
+        code = frame.f_code
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        names.append("%s:%s" % (module, code.co_name))
+        frame = frame.f_back
+    return names
@@ -0,0 +1,129 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Order the tests so that they need as few state restorations as possible.
+
+Tests declare what they damage with the `damages` decorator:
+
+    @damages('disks', 'data')
+    def test_one_disk_down(self):
+        ...
+
+The kinds of damage are (from the least destructive) "none", "services",
+"data", "disks" and "rings". A test without the decorator is expected to
+damage everything.
+
+When the nose plugin is enabled with `--with-restore-scheduler`, the tests in
+each class are run from the least destructive ones and the restorations
+requested by `ServerManager.load_state` are deferred. The state is actually
+restored only before a test that needs it - when the damage accumulated
+since the last restoration is more than restarted services or uploaded data
+- and at the end of the test class. This way the non-destructive tests share
+a single save/load cycle.
+"""
+
+import inspect
+import logging
+import nose.plugins
+from nose.suite import ContextList
+import destroystack.tools.server_manager as server_manager
+
+LOG = logging.getLogger(__name__)
+
+DAMAGE_KINDS = ['none', 'services', 'data', 'disks', 'rings']
+
+# damage after which other tests can still run without restoring the state
+TOLERABLE_DAMAGE = frozenset(['services', 'data'])
+
+
+def damages(*kinds):
+    """Decorator declaring what the test damages, choose from `DAMAGE_KINDS`.
+    """
+    for kind in kinds:
+        assert kind in DAMAGE_KINDS, "Unknown damage kind '%s'" % kind
+
+    def decorator(func):
+        func.damages = frozenset(kinds) - frozenset(['none'])
+        return func
+
+    return decorator
+
+
+def get_damage(func):
+    """Get the set of damage kinds the test declared.
+
+    :returns: frozenset, or None if the test didn't declare anything
+    """
+    return getattr(func, 'damages', None)
+
+
+def get_severity(func):
+    """Get a number for ordering the tests, the bigger the more destructive.
+    """
+    damage = get_damage(func)
+    if damage is None:
+        return len(DAMAGE_KINDS)
+    return max([DAMAGE_KINDS.index(kind) for kind in damage] or [0])
+
+
+class RestoreScheduler(nose.plugins.Plugin):
+    """Run the least destructive tests first and restore only when needed."""
+    name = 'restore-scheduler'
+
+    def begin(self):
+        server_manager.ServerManager.deferred_restoration = True
+        # damage done since the last restoration
+        self._damage = set()
+
+    def finalize(self, result):
+        server_manager.ServerManager.deferred_restoration = False
+
+    def prepareTestLoader(self, loader):
+        suite_factory = loader.suiteClass
+
+        def ordered_suite(tests=None, **kwargs):
+            # the tests of a class come in a ContextList, see
+            # `nose.loader.TestLoader.loadTestsFromTestClass`
+            context = getattr(tests, 'context', None)
+            if isinstance(tests, ContextList) and inspect.isclass(context):
+                tests.tests.sort(key=lambda t: get_severity(
+                    getattr(t, 'method', None)))
+            return suite_factory(tests, **kwargs)
+
+        loader.suiteClass = ordered_suite
+
+    def beforeTest(self, test):
+        if not self._damage.issubset(TOLERABLE_DAMAGE):
+            self._restore()
+
+    def afterTest(self, test):
+        damage = get_damage(getattr(test.test, 'method', None))
+        if damage is None:
+            damage = DAMAGE_KINDS
+        self._damage.update(damage)
+
+    def stopContext(self, context):
+        if inspect.isclass(context):
+            if self._damage:
+                self._restore()
+            self._damage = set()
+
+    def _restore(self):
+        manager = server_manager.ServerManager.current()
+        if not manager:
+            return
+        LOG.info("Tests damaged %s since the last restoration",
+                 sorted(self._damage))
+        if manager.restore_deferred_state():
+            self._damage = set()
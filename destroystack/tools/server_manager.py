@@ -12,11 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import logging
+import threading
 import destroystack.tools.state_restoration.metaopenstack as metaopenstack
 import destroystack.tools.state_restoration.vagrant as vagrant
 import destroystack.tools.state_restoration.manual as manual_restoration
+import destroystack.tools.state_restoration.lvm as lvm
+import destroystack.tools.state_restoration.fingerprint as fingerprint
 import destroystack.tools.common as common
+import destroystack.tools.fake_cluster as fake_cluster
+import destroystack.tools.network_faults as network_faults
+import destroystack.tools.parallel as parallel
+import destroystack.tools.tracing as tracing
 import destroystack.tools.servers as server_tools
 
 # Possible roles that a server can have, depending what services are installed
@@ -24,25 +32,72 @@ import destroystack.tools.servers as server_tools
 ROLES = set(['keystone', 'swift_proxy', 'swift_data', 'controller', 'compute',
              'glance', 'cinder', 'neutron'])
 
-MANAGEMENT_TYPES = ['none', 'manual', 'metaopenstack']
+MANAGEMENT_TYPES = ['none', 'manual', 'metaopenstack', 'vagrant', 'lvm',
+                    'fake']
 
-LOG = logging.getLogger(__name__)
+# management types which restore the Swift disks too, so they don't need to
+# be checked, formatted and mounted after loading the state
+DISK_SNAPSHOTTING_TYPES = ['lvm', 'manual', 'fake']
 
+# filesystem label set on the Swift disks before loading the state; if a disk
+# still has it after the restoration, it was not part of the snapshot
+DIRTY_DISK_LABEL = 'ds-dirty'
 
-class Singleton(object):
-    _instance = None
+# state changes that are fixed just by restarting the Swift services, without
+# restoring the whole state (a stopped non-Swift service is "other_services")
+RESTARTABLE_CHANGES = set(['services'])
+# state changes for which the restoration is skipped, none by default - even
+# data uploaded through the API can hide damaged objects; can be changed by the
+# configuration option "management.tolerate_changes"
+DEFAULT_TOLERATED_CHANGES = []
 
-    def __new__(cls, *args, **kwargs):
-        if not cls._instance:
-            cls._instance = super(Singleton, cls).__new__(cls, *args, **kwargs)
-        return cls._instance
+LOG = logging.getLogger(__name__)
 
 
-class ServerManager(Singleton):
+class _SingletonMeta(type):
+    def __call__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(_SingletonMeta, cls).__call__(*args,
+                                                                **kwargs)
+        return cls._instance
 
-    def __init__(self):
-        self._servers = server_tools.create_servers(common.CONFIG['servers'])
+
+# the same as a class with `metaclass=_SingletonMeta`, in Python 2 and 3
+Singleton = _SingletonMeta('Singleton', (object,), {
+    '_instance': None,
+    '__doc__': """Base of the classes that have a single instance.
+
+    Calling the class returns the existing instance, which is created (and
+    its `__init__` run) only by the first call.
+    """})
+
+
+class Environment(object):
+    """A set of servers on which the tested system is installed.
+
+    :param config: dict with the key "servers", which has the same format as
+        the "servers" in the configuration file, and optionally "vagrant_vms",
+        the names of the Vagrant VMs that belong to this environment (by
+        default all of them), and "fake_cluster" - if given, the servers are
+        replaced by a simulated cluster, see `tools.fake_cluster`
+    :param name: used for logging
+    """
+    def __init__(self, config, name='main'):
+        self.name = name
+        self._config = config
+        self._cluster = None
+        if config.get('fake_cluster') is not None:
+            self._cluster = fake_cluster.FakeCluster(config['fake_cluster'])
+            self._cluster.start()
+            self._servers = self._cluster.servers
+        else:
+            self._servers = server_tools.create_servers(config['servers'])
         self._workaround_single_swift_disk()
+        # fingerprints of the state taken in `save_state`, by tag
+        self._fingerprints = dict()
+
+    def __str__(self):
+        return self.name
 
     def servers(self, role=None, roles=None):
         """Generator that gets a server by its parameters.
@@ -70,7 +125,7 @@ class ServerManager(Singleton):
     def get(self, role=None, roles=None):
         """Get the first server that matches the parameters.
 
-        For more info, look at the `ServerManager.servers() generator - it uses
+        For more info, look at the `Environment.servers() generator - it uses
         the same parameters.
         :returns: the server in question or None
         """
@@ -91,6 +146,10 @@ class ServerManager(Singleton):
                 databases.  Unsupported and not recommended.
             * none - Do nothing
             * metaopenstack - Create a snapshot of all the servers
+            * vagrant - Create a snapshot of all the Vagrant VMs
+            * lvm - Create LVM thin snapshots of the volumes in the
+                "lvm_volumes" of each server
+            * fake - Save the state of the simulated cluster in memory
 
         If it's being created, the name of the snapshots (if created) will be
         "config.management.snapshot_prefix" + name of the VM + tag, where the
@@ -98,11 +157,21 @@ class ServerManager(Singleton):
         unique names (at least among each other) and snapshots/images with that
         name cannot already exist.
 
+        A fingerprint of the state is taken afterwards, so that `load_state`
+        can skip the restoration if nothing relevant changed.
+
         :param tag: will be appended to the name of the snapshots
         """
-        self._choose_state_restoration_action('save', tag)
-
-    def load_state(self, tag=''):
+        man_type = common.CONFIG['management']['type']
+        with tracing.span('save_state', environment=self.name,
+                          management=man_type, tag=tag):
+            self._label_swift_disks(_get_disk_label(tag))
+            self._choose_state_restoration_action('save', tag)
+            # the fake servers don't run the fingerprint commands
+            if man_type not in ['none', 'fake']:
+                self._fingerprints[tag] = fingerprint.take(self._servers)
+
+    def load_state(self, tag='', force=False):
         """Restore all the servers from their snapshots.
 
         For more information, see the function ``save``.
@@ -115,11 +184,75 @@ class ServerManager(Singleton):
             * metaopenstack - Rebuild the VMs with the snapshot images, which
                 are going to be found by the name as described in the `save`
                 function.
+            * vagrant - Restore the Vagrant VMs to their snapshots
+            * lvm - Swap the LVM volumes for their snapshots, or merge the
+                snapshots and reboot if the volumes are in use
+            * fake - Load the saved state of the simulated cluster
+
+        The restoration is skipped if the fingerprint of the state (see
+        `tools.state_restoration.fingerprint`) is the same as when it was
+        saved, except for the changes listed in "management.tolerate_changes"
+        (none by default). If only the running Swift services changed, they
+        are just restarted. The disk and network faults injected by the tests
+        are removed in any case, the fingerprint doesn't see them.
+
+        :param force: always restore the state, don't compare fingerprints
+        """
+        man_type = common.CONFIG['management']['type']
+        with tracing.span('load_state', environment=self.name,
+                          management=man_type, tag=tag) as span:
+            self.clear_faults()
+            if not force and self._can_skip_restoration(tag):
+                span.set(skipped=True)
+                return
+            restore_disks = man_type not in DISK_SNAPSHOTTING_TYPES
+            if restore_disks:
+                self._label_swift_disks(DIRTY_DISK_LABEL)
+            self._choose_state_restoration_action('load', tag)
+            self.connect()
+            if restore_disks:
+                # workaround for the fact that the extra disk might not get
+                # snapshotted
+                self._restore_swift_disks(_get_disk_label(tag))
+
+    def has_state(self, tag=''):
+        """Check if a state with the tag was saved, e.g. by another run.
+
+        Only the snapshots of the servers are looked for, their fingerprint
+        isn't known unless they were saved by this process. The manual
+        backups are not tagged, so they are never found, and neither is
+        anything with the management type "none".
+        """
+        man_type = common.CONFIG['management']['type']
+        if man_type == 'metaopenstack':
+            return metaopenstack.snapshots_exist(tag, self._servers)
+        elif man_type == 'vagrant':
+            return vagrant.snapshots_exist(
+                tag, self._config.get('vagrant_vms', None))
+        elif man_type == 'lvm':
+            return lvm.snapshots_exist(self, tag)
+        elif man_type == 'fake':
+            return self._cluster.has_state(tag)
+        return False
+
+    def delete_state(self, tag=''):
+        """Delete the snapshots of the servers with the tag, if there are any.
+
+        Nothing is deleted for the manual backups, which are not tagged, and
+        for the management type "none".
         """
-        self._choose_state_restoration_action('load', tag)
-        self.connect()
-        # workaround for the fact that the extra disk might not get snapshotted
-        self._restore_swift_disks()
+        man_type = common.CONFIG['management']['type']
+        LOG.info("Deleting the saved state '%s' of %s", tag, self)
+        self._fingerprints.pop(tag, None)
+        if man_type == 'metaopenstack':
+            metaopenstack.delete_snapshots(tag, self._servers)
+        elif man_type == 'vagrant':
+            vagrant.delete_snapshots(
+                tag, self._config.get('vagrant_vms', None))
+        elif man_type == 'lvm':
+            lvm.delete_snapshots(self, tag)
+        elif man_type == 'fake':
+            self._cluster.delete_state(tag)
 
     def connect(self):
         """Create ssh connections to all the servers.
@@ -133,6 +266,56 @@ class ServerManager(Singleton):
         for server in self._servers:
             server.disconnect()
 
+    def clear_faults(self):
+        """Remove the disk and network faults from all the servers.
+
+        See `Server.set_disk_fault` and `tools.network_faults`.
+        """
+        def clear(server):
+            if 'swift_data' in server.roles:
+                server.clear_disk_faults()
+            server.clear_network_faults()
+        parallel.run_parallel(clear, self._servers)
+        network_faults.clear_conditions()
+
+    def close(self):
+        """Disconnect from the servers and stop the simulated cluster.
+
+        The faults injected into the servers are removed first.
+        """
+        try:
+            self.clear_faults()
+        finally:
+            self.disconnect()
+            if self._cluster:
+                self._cluster.stop()
+
+    def _can_skip_restoration(self, tag):
+        """Compare the current state fingerprint with the saved one.
+
+        Restarts the Swift services if they are the only thing that changed.
+
+        :returns: True if the full restoration is not necessary
+        """
+        if tag not in self._fingerprints:
+            return False
+        tolerated = common.CONFIG['management'].get(
+            'tolerate_changes', DEFAULT_TOLERATED_CHANGES)
+        changes = fingerprint.compare(self._fingerprints[tag],
+                                      fingerprint.take(self._servers))
+        changes.difference_update(tolerated)
+        if not changes:
+            LOG.info("State didn't change, skipping restoration")
+            return True
+        if changes.issubset(RESTARTABLE_CHANGES):
+            LOG.info("Only Swift services changed, restarting them instead"
+                     " of a full restoration")
+            manual_restoration.restart_swift_services(
+                list(self.servers(role='swift_proxy')),
+                list(self.servers(role='swift_data')))
+            return True
+        return False
+
     def _choose_state_restoration_action(self, action, tag):
         """Choose which function to use, based on "management.type" in config.
 
@@ -143,19 +326,30 @@ class ServerManager(Singleton):
 
         if man_type == 'metaopenstack':
             if action == 'save':
-                metaopenstack.create_snapshots(tag)
+                metaopenstack.create_snapshots(tag, self._servers)
             else:
-                metaopenstack.restore_snapshots(tag)
+                metaopenstack.restore_snapshots(tag, self._servers)
         elif man_type == 'vagrant':
+            vms = self._config.get('vagrant_vms', None)
+            if action == 'save':
+                vagrant.create_snapshots(tag, vms)
+            else:
+                vagrant.restore_snapshots(tag, vms)
+        elif man_type == 'lvm':
             if action == 'save':
-                vagrant.create_snapshots(tag)
+                lvm.create_snapshots(self, tag)
             else:
-                vagrant.restore_snapshots(tag)
+                lvm.restore_snapshots(self, tag)
         elif man_type == 'manual':
             if action == 'save':
                 manual_restoration.create_backup(self)
             else:
                 manual_restoration.restore_backup(self)
+        elif man_type == 'fake':
+            if action == 'save':
+                self._cluster.save_state(tag)
+            else:
+                self._cluster.load_state(tag)
         elif man_type == 'none':
             LOG.info("State save and restoration has been turned off")
         else:
@@ -163,25 +357,256 @@ class ServerManager(Singleton):
                             "supported, choose among: %s"
                             % (man_type, MANAGEMENT_TYPES))
 
-    def _restore_swift_disks(self):
+    def _restore_swift_disks(self, label):
         """These disks might not have been snapshotted.
 
         Since the extra disk is currently maybe not being snapshotted (it is
         just some ephemeral storage or cinder volume), format them and restore
-        their flags.
+        their flags. Disks which have the label that was set before saving the
+        state were restored with the snapshot and are left intact. The servers
+        are handled in parallel.
 
         Additionally, if the user provided only one disk, we create 3
         partitions on it and use them as "disks" to simplify things for the
         user.
         """
-        data_servers = list(self.servers(role='swift_data'))
-        server_tools.prepare_swift_disks(data_servers)
-        for server in data_servers:
+        parallel.run_parallel(
+            lambda server: server_tools.restore_swift_disks(server, label),
+            self.servers(role='swift_data'))
+
+    def _label_swift_disks(self, label):
+        """Set the filesystem label on all the Swift disks."""
+        def label_disks(server):
             for disk in server.disks:
-                server.restore_disk(disk)
+                server.set_disk_label(disk, label)
+
+        parallel.run_parallel(label_disks, self.servers(role='swift_data'))
 
     def _workaround_single_swift_disk(self):
         for server in list(self.servers(role='swift_data')):
             if len(server.disks) == 1:
                 disk = server.disks[0]
                 server.disks = [disk + "1", disk + "2", disk + "3"]
+
+
+class ServerManager(Singleton):
+    """Access to the servers and their state restoration.
+
+    Normally there is a single environment, described by the "servers" in the
+    configuration file. If "standby_environments" are given too (a list of
+    dicts with the same format as the `Environment` config), the manager
+    keeps a pool of identical environments: while the tests run on one of
+    them, the others are being restored in the background, and
+    `load_state` just switches to an environment that is already restored
+    (if it was restored to a different tag, it is restored again first).
+    With two environments, the restoration time is hidden almost completely
+    if the tests take longer than the restoration.
+
+    Tests using the pool should not keep references to the servers (or
+    clients connected to them) between the calls of `load_state`.
+
+    If `deferred_restoration` is set (by the restore scheduler nose plugin,
+    see `tools.scheduling`), `load_state` only remembers that the state
+    should be restored and the restoration is done when
+    `restore_deferred_state` is called.
+
+    There is one manager per process, shared by the tests, the deployment
+    script and the state restoration: `open` (or just `ServerManager()`)
+    creates it and connects to the servers only the first time, `close`
+    disconnects and the next `open` starts over.
+    """
+    deferred_restoration = False
+
+    @classmethod
+    def open(cls):
+        """Get the manager of this process, create it if necessary."""
+        return cls()
+
+    @classmethod
+    def current(cls):
+        """Get the manager if it is open, without creating it.
+
+        :returns: `ServerManager` or None
+        """
+        return cls._instance
+
+    def __init__(self):
+        configs = [{'servers': common.CONFIG['servers'],
+                    'vagrant_vms': common.CONFIG.get('vagrant_vms', None),
+                    'fake_cluster': common.CONFIG.get('fake_cluster', None)}]
+        configs.extend(common.CONFIG.get('standby_environments', []))
+        self._environments = [Environment(config, 'environment%d' % i)
+                              for i, config in enumerate(configs)]
+        self._active = self._environments[0]
+        # background restoration threads and their errors, by environment
+        self._restorations = dict()
+        self._restoration_errors = dict()
+        # (tag, force) of the last state saved or restored, by environment
+        self._restored_to = dict()
+        # arguments of the last deferred `load_state` call
+        self._deferred_load = None
+
+    def servers(self, role=None, roles=None):
+        """Generator that gets a server from the active environment.
+
+        See `Environment.servers`.
+        """
+        return self._active.servers(role, roles)
+
+    def get(self, role=None, roles=None):
+        """See `Environment.get`."""
+        return self._active.get(role, roles)
+
+    def get_all(self, role=None, roles=None):
+        """See `Environment.get_all`."""
+        return self._active.get_all(role, roles)
+
+    def has_state(self, tag=''):
+        """See `Environment.has_state`, of the active environment."""
+        return self._active.has_state(tag)
+
+    def save_state(self, tag=''):
+        """Save the state of all the environments in parallel.
+
+        See `Environment.save_state`.
+        """
+        self.wait_for_restorations()
+        self._restored_to.clear()
+        parallel.run_parallel(lambda env: env.save_state(tag),
+                              self._environments)
+        for env in self._environments:
+            self._restored_to[env] = (tag, True)
+
+    def delete_state(self, tag=''):
+        """Delete the saved state of all the environments in parallel.
+
+        See `Environment.delete_state`.
+        """
+        self.wait_for_restorations()
+        parallel.run_parallel(lambda env: env.delete_state(tag),
+                              self._environments)
+        for env, restored_to in list(self._restored_to.items()):
+            if restored_to[0] == tag:
+                del self._restored_to[env]
+
+    def load_state(self, tag='', force=False):
+        """Restore the state, see `Environment.load_state`.
+
+        If there are standby environments, restoration of the active one is
+        started in the background and the next environment in the pool
+        becomes the active one, once its own restoration is finished.
+        """
+        if self.deferred_restoration:
+            LOG.info("Deferring state restoration")
+            self._deferred_load = (tag, force)
+            return
+        self._load_state(tag, force)
+
+    def restore_deferred_state(self):
+        """Do the restoration requested by `load_state`, if any.
+
+        :returns: True if the state was restored
+        """
+        if self._deferred_load is None:
+            return False
+        tag, force = self._deferred_load
+        self._deferred_load = None
+        self._load_state(tag, force)
+        return True
+
+    def wait_for_restorations(self):
+        """Wait until all the background restorations are finished."""
+        for env in self._environments:
+            self._wait_for_restoration(env)
+
+    def connect(self):
+        """Create ssh connections to all the servers.
+
+        Will re-create them if called a second time.
+        """
+        for env in self._environments:
+            env.connect()
+
+    def disconnect(self):
+        self.wait_for_restorations()
+        for env in self._environments:
+            env.disconnect()
+
+    def close(self):
+        """Disconnect from all the environments and forget the manager.
+
+        Waits for the background restorations first.
+        """
+        try:
+            self.wait_for_restorations()
+        finally:
+            for env in self._environments:
+                env.close()
+            if ServerManager._instance is self:
+                ServerManager._instance = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _load_state(self, tag, force):
+        if len(self._environments) == 1:
+            self._active.load_state(tag, force)
+            return
+        dirty = self._active
+        self._restored_to.pop(dirty, None)
+        thread = threading.Thread(target=self._restore_in_background,
+                                  args=(dirty, tag, force))
+        thread.daemon = True
+        self._restorations[dirty] = thread
+        thread.start()
+        index = self._environments.index(dirty)
+        ready = self._environments[(index + 1) % len(self._environments)]
+        self._wait_for_restoration(ready)
+        restored_to = self._restored_to.get(ready)
+        stale = restored_to is None or restored_to[0] != tag
+        if stale or (force and not restored_to[1]):
+            LOG.info("%s was not restored to state '%s', restoring it now",
+                     ready, tag)
+            ready.load_state(tag, force)
+            self._restored_to[ready] = (tag, force)
+        LOG.info("Switching from %s to %s", dirty, ready)
+        self._active = ready
+
+    def _restore_in_background(self, env, tag, force):
+        try:
+            env.load_state(tag, force)
+            self._restored_to[env] = (tag, force)
+        except Exception as e:
+            LOG.exception("Restoration of %s failed", env)
+            self._restoration_errors[env] = e
+
+    def _wait_for_restoration(self, env):
+        """Wait for the background restoration of the environment.
+
+        :raises: the exception raised by the restoration, if it failed
+        """
+        thread = self._restorations.pop(env, None)
+        if thread is None:
+            return
+        LOG.info("Waiting for restoration of %s", env)
+        with tracing.span('wait_for_restoration', environment=env.name):
+            thread.join()
+        error = self._restoration_errors.pop(env, None)
+        if error:
+            raise error
+
+
+def _get_disk_label(tag):
+    """Get the filesystem label marking the Swift disks of a saved state.
+
+    It is the same for every saved state with the same tag, so that reused
+    snapshots are recognized too. Ext filesystem labels can have at most 16
+    characters.
+    """
+    prefix = common.CONFIG['management'].get('snapshot_prefix',
+                                             'destroystack-snapshot')
+    digest = hashlib.md5(("%s_%s" % (prefix, tag)).encode('utf-8'))
+    return "ds-" + digest.hexdigest()[:8]
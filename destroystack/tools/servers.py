@@ -14,15 +14,43 @@
 
 """SSH connection to Swift servers, helper functions."""
 
-import paramiko
+import functools
 import logging
 import subprocess
 import socket
 
 import destroystack.tools.common as common
+import destroystack.tools.disk_faults as disk_faults
+import destroystack.tools.parallel as parallel
+import destroystack.tools.timeout as timeout_tools
+import destroystack.tools.tracing as tracing
 
 LOG = logging.getLogger(__name__)
 
+# how the Swift disks are formatted and mounted, see "disks" in the
+# configuration file
+DISK_DEFAULTS = {
+    'filesystem': 'ext4',
+    'lazy_init': False,
+    'size': None,
+    'mount_options': 'noatime,nodiratime',
+    'init_timeout': 1800,
+    'fault_layer': False,
+}
+
+# handle of the root qdisc added by `Server.degrade_network` and the iptables
+# chain of `Server.block_network`, so that the faults can be removed without
+# touching the rest of the network configuration
+QDISC_HANDLE = 'd5'
+# rate of the traffic that is not degraded, more than any link has
+UNLIMITED_RATE = '10gbit'
+IPTABLES_CHAIN = 'destroystack'
+# iptables chain counting the replication traffic, see
+# `Server.count_replication_traffic`
+REPLICATION_CHAIN = 'destroystack-repl'
+# ports of rsync and of the object, container and account servers
+REPLICATION_PORTS = '873,6000:6002'
+
 
 def create_servers(configs):
     """Create Server objects out of a list of server configuration dicts."""
@@ -32,6 +60,53 @@ def create_servers(configs):
     return servers
 
 
+def get_disk_options():
+    """Get the "disks" configuration, with defaults for the missing keys."""
+    options = dict(DISK_DEFAULTS)
+    options.update(common.CONFIG.get('disks', {}))
+    return options
+
+
+def get_mkfs_command(disk):
+    """Get the command creating the Swift filesystem on the disk.
+
+    With "lazy_init", ext4 doesn't zero the inode tables and the journal
+    while formatting, the kernel does it in the background after the disk is
+    mounted (see `Server.wait_for_disk_init`). The "size" limits the size of
+    the filesystem, a small one is formatted faster and is enough for tests.
+
+    :param disk: name of the device in /dev/, like "sdb", see
+        `Server.get_device`
+    """
+    options = get_disk_options()
+    filesystem = options['filesystem']
+    size = options['size']
+    if filesystem == 'xfs':
+        # bigger inodes fit the extended attributes with Swift metadata
+        cmd = "mkfs.xfs -f -i size=1024"
+        if size:
+            cmd += " -d size=%s" % size
+        return "%s /dev/%s" % (cmd, disk)
+    elif filesystem == 'ext4':
+        cmd = "mkfs.ext4 -F"
+        if options['lazy_init']:
+            cmd += " -E lazy_itable_init=1,lazy_journal_init=1"
+        cmd += " /dev/%s" % disk
+        if size:
+            cmd += " %s" % size
+        return cmd
+    raise Exception("Unsupported filesystem for the Swift disks: %s"
+                    % filesystem)
+
+
+def get_mount_command(disk):
+    """Get the command mounting the disk to its mount point from fstab."""
+    mount_options = get_disk_options()['mount_options']
+    if mount_options:
+        return "mount -o %s /dev/%s" % (mount_options, disk)
+    return "mount /dev/%s" % disk
+
+
 class ServerException(Exception):
     """Raised when there was a problem executing an SSH command on a server.
     """
@@ -66,19 +141,27 @@ class LocalServer(object):
             real-time and not logged or returned.
         :param kwargs: append to `subprocess.Popen`
         :raises: ServerException if ignore_failures is False and the command
-            returns a non-zero value
+            returns a non-zero value; `timeout.DeadlineExceeded` if the current
+            deadline has already expired
         :returns: `CommandResult`
         """
+        deadline = timeout_tools.current_deadline()
+        if deadline:
+            deadline.check()
         if log_cmd:
             LOG.info("[%s] %s", self.name, command)
 
-        if collect_stdout:
-            p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE, **kwargs)
-        else:
-            p = subprocess.Popen(command, shell=True, stderr=subprocess.PIPE,
-                                 *kwargs)
-        stdout, stderr = p.communicate()
+        # text, not bytes, in Python 3 too
+        kwargs.setdefault('universal_newlines', True)
+        with tracing.span('cmd', host=self.name, command=command):
+            if collect_stdout:
+                p = subprocess.Popen(command, shell=True,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, **kwargs)
+            else:
+                p = subprocess.Popen(command, shell=True,
+                                     stderr=subprocess.PIPE, **kwargs)
+            stdout, stderr = p.communicate()
         result = CommandResult(self.name, command)
         result.parse_subprocess_results(stdout, stderr, p.returncode)
         if log_output and result.out:
@@ -104,7 +187,7 @@ class Server(LocalServer):
     mount points.
     """
     def __init__(self, hostname=None, ip=None, username="root", password=None,
-                 roles=None, extra_disks=None, **kwargs):
+                 roles=None, extra_disks=None, lvm_volumes=None, **kwargs):
         if not (hostname or ip):
             raise Exception("Either hostname or IP address required")
         self.hostname = hostname
@@ -115,6 +198,9 @@ class Server(LocalServer):
         self.name = self._decide_on_name()
         self.roles = roles or set()
         self.disks = extra_disks
+        self.lvm_volumes = lvm_volumes or []
+        # ID of the VM, if the server is an OpenStack VM
+        self.vm_id = kwargs.get('id', None)
         if "root_password" in kwargs and not password:
             username = "root"
             password = kwargs["root_password"]
@@ -122,13 +208,22 @@ class Server(LocalServer):
         self._password = password
 
         self._ssh = SSH(self.name)
-        self._ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self._ssh.load_system_host_keys()
         self.connect()
 
-    def connect(self):
+    def connect(self, timeout=None):
         self._ssh.connect(self.ip, username=self._username,
-                          password=self._password)
+                          password=self._password, timeout=timeout)
+
+    def try_connect(self, timeout=10):
+        """Connect if possible, for waiting until a server boots up.
+
+        :returns: True if the connection was created
+        """
+        try:
+            self.connect(timeout)
+            return True
+        except Exception:
+            return False
 
     def disconnect(self):
         self._ssh.close()
@@ -152,11 +247,13 @@ class Server(LocalServer):
             "[hostname stderr] the_error_output"
         :param kwargs: append to `paramiko.exec_command`
         :raises: ServerException if ignore_failures is False and the command
-            returns a non-zero value
+            returns a non-zero value; `timeout.DeadlineExceeded` if the
+            current deadline expires before the command finishes
         :returns: `CommandResult`
         """
-        return self._ssh(command, ignore_failures, log_cmd, log_output,
-                         **kwargs)
+        with tracing.span('cmd', host=self.name, command=command):
+            return self._ssh(command, ignore_failures, log_cmd, log_output,
+                             **kwargs)
 
     def __str__(self):
         return self.name
@@ -164,11 +261,11 @@ class Server(LocalServer):
     def kill_disk(self, disk=None):
         """Force umount one of the mounted disks.
 
+        For disks that fail without disappearing, see `set_disk_fault`.
+
         :param disk: name of disk in /dev/ on the server, for example "sda",
             use any available disk if None
         :returns: label of disk that was killed, for example "sda"
-        TODO: REALLY force it, perhaps use
-        https://www.kernel.org/doc/Documentation/device-mapper/dm-flakey.txt
         """
         available_disks = self.get_mounted_disks()
         if not available_disks:
@@ -177,7 +274,7 @@ class Server(LocalServer):
             disk = available_disks[0]
         assert disk in available_disks
         LOG.info("Killing disk /dev/%s on %s", disk, self.name)
-        self.cmd("umount --force -l /dev/" + disk)
+        self.cmd("umount --force -l /dev/" + self.get_device(disk))
         return disk
 
     def umount(self, disk):
@@ -186,20 +283,27 @@ class Server(LocalServer):
         TODO: wait a bit if the device is busy
         """
         if disk in self.get_mount_points().keys():
-            self.cmd("umount /dev/%s" % disk)
+            self.cmd("umount /dev/%s" % self.get_device(disk))
 
     def format_disk(self, disk):
         assert disk in self.disks
-        for disk in self.disks:
-            self.umount(disk)
+        self.umount(disk)
         LOG.info("Formatting disk /dev/%s on %s", disk, self.name)
-        self.cmd("mkfs.ext4 -F /dev/" + disk, log_output=True)
+        self.cmd(get_mkfs_command(self.get_device(disk)), log_output=True)
 
     def format_extra_disks(self):
-        for disk in self.disks:
+        self.format_disks(self.disks)
+
+    def format_disks(self, disks):
+        """Format the given disks in parallel, fail if any of them fails."""
+        for disk in disks:
+            assert disk in self.disks
             self.umount(disk)
-        cmd = ["(mkfs.ext4 -F /dev/%s > /dev/null)&" % d for d in self.disks]
-        cmd.append("wait")
+        # a bare "wait" would ignore the exit codes of the jobs
+        cmd = ["pids=;"]
+        cmd.extend("(%s > /dev/null)& pids=\"$pids $!\";"
+                   % get_mkfs_command(self.get_device(d)) for d in disks)
+        cmd.append("for pid in $pids; do wait $pid || exit 1; done")
         self.cmd(" ".join(cmd), log_output=True)
 
     def restore_disk(self, disk):
@@ -210,9 +314,237 @@ class Server(LocalServer):
         """
         assert disk not in self.get_mounted_disks()
         LOG.info("Restoring disk /dev/%s on %s", disk, self.name)
-        self.cmd("mount /dev/" + disk)
-        self.cmd("chown -R swift:swift /srv/node/*")
-        self.cmd("restorecon -R /srv/*")
+        self.cmd(get_mount_command(self.get_device(disk)))
+        mount_point = self.get_mount_points()[disk]
+        self.cmd("chown -R swift:swift %s" % mount_point)
+        self.cmd("restorecon -R %s" % mount_point)
+
+    def get_disk_label(self, disk):
+        """Get the filesystem label of the disk, empty string if none."""
+        result = self.cmd("blkid -o value -s LABEL /dev/%s"
+                          % self.get_device(disk),
+                          ignore_failures=True, log_cmd=False)
+        return ''.join(result.out).strip()
+
+    def set_disk_label(self, disk, label):
+        """Set the filesystem label of the disk, works even if mounted.
+
+        XFS labels can have at most 12 characters.
+
+        :returns: True if it was set, False if the disk doesn't contain an
+            ext or XFS filesystem
+        """
+        device = self.get_device(disk)
+        result = self.cmd("blkid -o value -s TYPE /dev/%s" % device,
+                          ignore_failures=True, log_cmd=False)
+        if ''.join(result.out).strip() != 'xfs':
+            cmd = "e2label /dev/%s %s" % (device, label)
+        else:
+            mount_point = self.get_mount_points().get(disk)
+            if mount_point:
+                cmd = "xfs_io -c 'label -s %s' %s" % (label, mount_point)
+            else:
+                cmd = "xfs_admin -L %s /dev/%s" % (label, device)
+        result = self.cmd(cmd, ignore_failures=True, log_cmd=False)
+        return result.exit_code == 0
+
+    def wait_for_disk_init(self):
+        """Wait until the lazy initialization of the ext4 disks finishes.
+
+        The kernel thread zeroing the inode tables of the disks formatted with
+        "lazy_init" keeps them busy, so the measurements would be skewed if
+        they were done while it runs. Nothing is waited for otherwise.
+        """
+        options = get_disk_options()
+        if options['filesystem'] != 'ext4' or not options['lazy_init']:
+            return
+        timeout_tools.wait_for(
+            "lazy disk initialization on %s" % self.name,
+            lambda result: result.exit_code != 0,
+            functools.partial(self.cmd, "pgrep -x ext4lazyinit",
+                              ignore_failures=True, log_cmd=False),
+            timeout_sec=options['init_timeout'], period=5)
+
+    def get_device(self, disk):
+        """Get the device with the filesystem of the disk, relative to /dev/.
+
+        It is the disk itself, unless "fault_layer" is set in the "disks"
+        section of the configuration, then it's the device-mapper device
+        wrapping the disk, like "mapper/ds-sdb", see `tools.disk_faults`.
+        """
+        if get_disk_options()['fault_layer']:
+            return disk_faults.get_device(disk)
+        return disk
+
+    def wrap_disks(self):
+        """Create the devices of the fault layer for the disks, if enabled."""
+        if get_disk_options()['fault_layer']:
+            for disk in self.disks:
+                disk_faults.wrap(self, disk)
+
+    def set_disk_fault(self, disk, fault=None, **params):
+        """Make the disk fail or slow, without unmounting it.
+
+        Needs "fault_layer" in the "disks" section of the configuration.
+
+        :param fault: one of `disk_faults.FAULTS`, None to make the disk work
+            normally again
+        :param params: parameters of the fault, see `disk_faults.set_fault`
+        """
+        self._check_fault_layer()
+        disk_faults.set_fault(self, disk, fault, **params)
+
+    def throttle_disk(self, disk, read_bps=None, write_bps=None):
+        """Limit the throughput of the disk, None removes the limit.
+
+        Needs "fault_layer" in the "disks" section of the configuration.
+        """
+        self._check_fault_layer()
+        disk_faults.throttle(self, disk, read_bps, write_bps)
+
+    def clear_disk_faults(self):
+        """Make all the disks work normally, remove the throttling too."""
+        if not self.disks:
+            return
+        if get_disk_options()['fault_layer']:
+            disk_faults.clear(self, self.disks)
+
+    def _check_fault_layer(self):
+        if not get_disk_options()['fault_layer']:
+            raise Exception("Disk faults need \"fault_layer\" enabled in the"
+                            " \"disks\" section of the configuration")
+
+    def degrade_network(self, peers, delay_ms=0, jitter_ms=0, loss=0,
+                        rate=None):
+        """Make the traffic sent to the peers slow or lossy.
+
+        The bandwidth is limited with a tc htb class and the rest is done by
+        tc netem. Only the packets to the peers are affected, so the SSH
+        connection keeps working (unless this machine is one of them). It
+        replaces the previous degradation of the interfaces used to reach the
+        peers.
+
+        :param peers: list of `Server`s or IP addresses
+        :param delay_ms: delay added to each packet, in milliseconds
+        :param jitter_ms: random variation of the delay, in milliseconds
+        :param loss: percentage of the packets that get lost
+        :param rate: bandwidth limit, like "10mbit"
+        """
+        netem = _get_netem_options(delay_ms, jitter_ms, loss)
+        if not (netem or rate):
+            raise Exception("No network degradation given")
+        devices = dict()
+        for peer in peers:
+            ip = getattr(peer, 'ip', peer)
+            devices.setdefault(self._get_route_device(ip), []).append(ip)
+        for device, ips in devices.items():
+            LOG.info("[%s] Degrading the network to %s: %s", self.name,
+                     ", ".join(ips), " ".join(filter(None, [
+                         netem, rate and "rate %s" % rate])))
+            # the unfiltered traffic goes to the class 1, which is not
+            # limited in practice, the traffic to the peers to the class 2
+            cmd = ["tc qdisc del dev %s root handle %s: 2>/dev/null;"
+                   % (device, QDISC_HANDLE),
+                   "tc qdisc add dev %s root handle %s: htb default 1"
+                   % (device, QDISC_HANDLE),
+                   "&& tc class add dev %s parent %s: classid %s:1 htb"
+                   " rate %s" % (device, QDISC_HANDLE, QDISC_HANDLE,
+                                 UNLIMITED_RATE),
+                   "&& tc class add dev %s parent %s: classid %s:2 htb"
+                   " rate %s" % (device, QDISC_HANDLE, QDISC_HANDLE,
+                                 rate or UNLIMITED_RATE)]
+            if netem:
+                cmd.append("&& tc qdisc add dev %s parent %s:2 netem %s"
+                           % (device, QDISC_HANDLE, netem))
+            for ip in ips:
+                cmd.append("&& tc filter add dev %s parent %s: protocol ip"
+                           " prio 1 u32 match ip dst %s/32 flowid %s:2"
+                           % (device, QDISC_HANDLE, ip, QDISC_HANDLE))
+            self.cmd(" ".join(cmd))
+
+    def block_network(self, peers):
+        """Drop all the traffic from and to the peers, with iptables.
+
+        :param peers: list of `Server`s or IP addresses
+        """
+        ips = [getattr(peer, 'ip', peer) for peer in peers]
+        LOG.info("[%s] Blocking the network to %s", self.name, ", ".join(ips))
+        # the chain is jumped to only once, even if called repeatedly
+        self.cmd("iptables -N {0} 2>/dev/null; for chain in INPUT OUTPUT; do"
+                 " iptables -D $chain -j {0} 2>/dev/null;"
+                 " iptables -I $chain -j {0} || exit 1; done"
+                 .format(IPTABLES_CHAIN))
+        rules = list()
+        for ip in ips:
+            rules.append("iptables -A %s -s %s -j DROP" % (IPTABLES_CHAIN, ip))
+            rules.append("iptables -A %s -d %s -j DROP" % (IPTABLES_CHAIN, ip))
+        self.cmd(" && ".join(rules))
+
+    def clear_network_faults(self):
+        """Remove what `degrade_network` and `block_network` did.
+
+        The counting of the replication traffic is stopped too, the iptables
+        chains are removed completely.
+        """
+        self.cmd("for dev in $(ls /sys/class/net); do tc qdisc del dev $dev"
+                 " root handle %s: 2>/dev/null; done; %s; %s; true"
+                 % (QDISC_HANDLE, _get_remove_chain_command(IPTABLES_CHAIN),
+                    _get_remove_chain_command(REPLICATION_CHAIN)),
+                 log_cmd=False)
+
+    def count_replication_traffic(self, peers):
+        """Start counting the bytes received from the peers by rsync and the
+        Swift storage servers (`REPLICATION_PORTS`), with iptables.
+
+        Only the traffic coming from the peers is counted, so the SSH
+        commands and HTTP requests of DestroyStack are left out, and so are
+        the uploads through the proxy server unless it runs on one of the
+        peers. The counting starts from zero if this is called again and
+        is stopped by `stop_counting_replication_traffic`.
+
+        :param peers: list of `Server`s or IP addresses, the other data servers
+        :returns: False if the counting could not be set up (e.g. there is
+            no iptables)
+        """
+        ips = [getattr(peer, 'ip', peer) for peer in peers]
+        commands = ["iptables -N {0} 2>/dev/null; iptables -F {0} &&"
+                    " (iptables -C INPUT -j {0} 2>/dev/null ||"
+                    " iptables -I INPUT -j {0})".format(REPLICATION_CHAIN)]
+        for ip in ips:
+            commands.append("iptables -A %s -s %s -p tcp -m multiport"
+                            " --dports %s" % (REPLICATION_CHAIN, ip,
+                                              REPLICATION_PORTS))
+        result = self.cmd(" && ".join(commands), ignore_failures=True,
+                          log_cmd=False)
+        if result.exit_code != 0:
+            LOG.warning("[%s] Cannot count the replication traffic: %s",
+                        self.name, " ".join(result.err))
+            return False
+        return True
+
+    def stop_counting_replication_traffic(self):
+        """Remove the iptables chain of `count_replication_traffic`."""
+        self.cmd("%s; true" % _get_remove_chain_command(REPLICATION_CHAIN),
+                 log_cmd=False)
+
+    def get_replication_bytes(self):
+        """Get the bytes counted since `count_replication_traffic`.
+
+        :returns: number of bytes, None if they are not being counted
+        """
+        result = self.cmd("iptables -nvxL %s" % REPLICATION_CHAIN,
+                          ignore_failures=True, log_cmd=False)
+        if result.exit_code != 0:
+            return None
+        # a line with the chain and one with the column names come first, the
+        # bytes are in the second column of each rule
+        return sum(int(line.split()[1]) for line in result.out[2:]
+                   if line.strip())
+
+    def _get_route_device(self, ip):
+        result = self.cmd("ip route get %s" % ip, log_cmd=False)
+        words = " ".join(result.out).split()
+        return words[words.index('dev') + 1]
 
     def get_mount_points(self):
         """Get dict {disk:mountpoint} of mounted and managed disks.
@@ -223,8 +555,8 @@ class Server(LocalServer):
         """
         mount_points = dict()
         for disk in self.disks:
-            result = self.cmd("mount|grep '/dev/%s '| awk '{print $3}'" % disk,
-                              log_cmd=False)
+            result = self.cmd("mount|grep '/dev/%s '| awk '{print $3}'"
+                              % self.get_device(disk), log_cmd=False)
             if result.out:
                 mount_points[disk] = result.out[0].strip()
         return mount_points
@@ -250,14 +582,25 @@ class Server(LocalServer):
         return name
 
 
-class SSH(paramiko.SSHClient):
+class SSH(object):
     """Wrapper around paramiko for better error handling and logging.
 
-    Do not create it directly - it is used by the `Server` object.
+    Do not create it directly - it is used by the `Server` object. Other
+    attributes are those of the wrapped `paramiko.SSHClient`. Paramiko is
+    imported only when the first one is created, so that runs without any
+    remote servers don't pay for importing it.
     """
     def __init__(self, name):
-        super(SSH, self).__init__()
+        import paramiko
         self.name = name
+        self.client = paramiko.SSHClient()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.client.load_system_host_keys()
+
+    def __getattr__(self, name):
+        if name == 'client':
+            raise AttributeError(name)
+        return getattr(self.client, name)
 
     def __call__(self, command, ignore_failures,
                  log_cmd, log_output, **kwargs):
@@ -269,11 +612,18 @@ class SSH(paramiko.SSHClient):
         :param ignore_failures: don't raise an exception if an error occurs
         :param log_output: always log output, both stdout and stderr
         :param log_cmd: log the command and the name of server where it is run
-        :raises: ServerException
+        :raises: ServerException, `timeout.DeadlineExceeded`
         """
         if log_cmd:
             LOG.info("[%s] %s", self.name, command)
+        deadline = timeout_tools.current_deadline()
+        if deadline:
+            kwargs.setdefault('timeout', deadline.timeout())
         _, stdout, stderr = self.exec_command(command, **kwargs)
+        if deadline and not stdout.channel.status_event.wait(
+                deadline.timeout()):
+            stdout.channel.close()
+            deadline.check()
         result = CommandResult(self.name, command)
         result.parse_paramiko_results(stdout, stderr)
 
@@ -331,6 +681,27 @@ class CommandResult(object):
                    '\n'.join(self.out), '\n'.join(self.err), self.exit_code))
 
 
+def _get_remove_chain_command(chain):
+    """Get the shell command removing the iptables chain and the jumps to it.
+
+    It doesn't fail if the chain doesn't exist, but its exit code is not 0.
+    """
+    return ("for parent in INPUT OUTPUT; do while iptables -D $parent -j {0}"
+            " 2>/dev/null; do :; done; done; iptables -F {0} 2>/dev/null;"
+            " iptables -X {0} 2>/dev/null".format(chain))
+
+
+def _get_netem_options(delay_ms=0, jitter_ms=0, loss=0):
+    options = list()
+    if delay_ms or jitter_ms:
+        options.append("delay %dms" % delay_ms)
+        if jitter_ms:
+            options.append("%dms" % jitter_ms)
+    if loss:
+        options.append("loss %s%%" % loss)
+    return " ".join(options)
+
+
 def prepare_swift_disks(servers):
     """Format and partition disks if neccessary.
 
@@ -339,29 +710,111 @@ def prepare_swift_disks(servers):
     partitioned into 3 "disks". So partition it if only one is given or if the
     partitions don't exist. Update the `server.disks` if this has been done.
 
-    The disks or partitions will be all formatted with the ext4 filesystem.
+    The disks or partitions will be all formatted as set by "disks" in the
+    configuration, with the ext4 filesystem by default.
+    The servers are prepared concurrently, see `get_swift_disk_tasks`.
 
     :param servers: should be a list of Server objects with connection to swift
         data nodes
     :returns: a list in form ["ip.address/vda", "ip.address.2/vda"] that can be
     used in the packstack answerfile.
     """
-    description = list()
+    servers = list(servers)
+    parallel.run_tasks(get_swift_disk_tasks(servers))
+    return get_swift_devices(servers)
+
+
+def get_swift_devices(servers):
+    """Get the devices of the Swift disks in the form used by packstack.
+
+    The disks are not touched, the names are the ones that
+    `prepare_swift_disks` uses, so this can be called before they are
+    prepared.
+
+    :returns: see `prepare_swift_disks`
+    """
+    return ['/'.join([server.ip, server.get_device(disk)])
+            for server in servers
+            for disk in get_swift_disk_names(server.disks)]
+
+
+def get_swift_disk_names(disks):
+    """Get the disks used by Swift - the partitions if only one is given."""
+    if len(disks) == 1:
+        return [disks[0] + "1", disks[0] + "2", disks[0] + "3"]
+    return list(disks)
+
+
+def get_swift_disk_tasks(servers):
+    """Get the `parallel.Task`s preparing the Swift disks of the servers.
+
+    For each server, the disk is partitioned if necessary, the disks are
+    wrapped in the fault layer if it's enabled (see `tools.disk_faults`) and
+    then they are formatted.
+    """
+    tasks = list()
     for server in servers:
-        partition_disk = _needs_partitioning(server)
-        if partition_disk:
-            LOG.info("Only one extra disk on %s, create partitions on it and"
-                     " use those instead" % server)
-            _partition_swift_disk(server, partition_disk)
-        if len(server.disks) == 1:
-            disk = server.disks[0]
-            server.disks = [disk + "1", disk + "2", disk + "3"]
-        LOG.info("Formatting extra disks on %s" % server)
-        server.format_extra_disks()
-        # get description of devices for packstack answerfile
-        devices = ['/'.join([server.ip, d]) for d in server.disks]
-        description.extend(devices)
-    return description
+        partition = "partition disks on %s" % server.name
+        tasks.append(parallel.Task(
+            partition, functools.partial(_partition_if_needed, server)))
+        previous = partition
+        if get_disk_options()['fault_layer']:
+            previous = "wrap disks on %s" % server.name
+            tasks.append(parallel.Task(previous, server.wrap_disks,
+                                       requires=[partition]))
+        tasks.append(parallel.Task(
+            "format disks on %s" % server.name, server.format_extra_disks,
+            requires=[previous]))
+    return tasks
+
+
+def _partition_if_needed(server):
+    """Partition the only given disk if needed, see `prepare_swift_disks`."""
+    partition_disk = _needs_partitioning(server)
+    if partition_disk:
+        LOG.info("Only one extra disk on %s, create partitions on it and"
+                 " use those instead" % server)
+        _partition_swift_disk(server, partition_disk)
+    server.disks = get_swift_disk_names(server.disks)
+
+
+def restore_swift_disks(server, label=None):
+    """Make the Swift disks of a data server usable after state restoration.
+
+    The disks might not have been restored together with the rest of the
+    server (if they are ephemeral storage or Cinder volumes, they are not
+    snapshotted), so check if the disk has the given filesystem label, which
+    should have been set before saving the state. Only the disks which don't
+    have it are formatted, all of them in parallel. Afterwards, the disks that
+    are not mounted get mounted and their permissions restored, and if any
+    were formatted lazily, it waits until their initialization finishes.
+
+    If only one disk is given and the partitions on it don't exist, it will be
+    partitioned first, see `prepare_swift_disks`. The faults injected into the
+    disks are removed, see `Server.set_disk_fault`.
+
+    :param label: filesystem label marking the disks whose content is from the
+        saved state; if None, format all the disks
+    """
+    _partition_if_needed(server)
+    server.wrap_disks()
+    server.clear_disk_faults()
+
+    damaged = [disk for disk in server.disks
+               if label is None or server.get_disk_label(disk) != label]
+    if damaged:
+        LOG.info("Formatting disks %s on %s", damaged, server)
+        server.format_disks(damaged)
+    intact = [disk for disk in server.disks if disk not in damaged]
+    if intact:
+        LOG.info("Disks %s on %s were restored, not formatting them",
+                 intact, server)
+    mounted = server.get_mounted_disks()
+    for disk in server.disks:
+        if disk not in mounted:
+            server.restore_disk(disk)
+    if damaged:
+        server.wait_for_disk_init()
 
 
 def _needs_partitioning(server):
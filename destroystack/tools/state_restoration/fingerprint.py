@@ -0,0 +1,109 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cheap fingerprint of the state of the servers.
+
+Restoring the state of the servers is slow (rebuilding a VM takes minutes), so
+it makes sense to first check if anything relevant changed at all. The
+fingerprint consists of several components, each of them being the output of
+a shell command executed on the server:
+    * mounts - the mounted Swift devices and their mount options
+    * rings - md5 sums of the Swift rings and builder files
+    * services - names of the running Swift services
+    * other_services - names of the running processes of the other OpenStack
+        services and of the services they depend on (database, message
+        broker, web server), "nova-compute" for example
+    * config - md5 sums of the Swift configuration files
+    * data - one digest for each device in /srv/node, made from the names
+        and sizes of the object files on it (.data, .ts and .meta); the files
+        that Swift's replicator, auditor and updater keep rewriting (like
+        hashes.pkl, locks, tmp/ and async_pending/) are left out
+
+All the components are gathered with a single SSH command per server and the
+servers are queried in parallel.
+"""
+
+import logging
+import destroystack.tools.parallel as parallel
+
+LOG = logging.getLogger(__name__)
+
+# prefixes of the process names of the non-Swift services
+OTHER_SERVICES = ['openstack-', 'nova-', 'glance-', 'keystone', 'cinder-',
+                  'neutron-', 'heat-', 'ceilometer-', 'httpd', 'mysqld',
+                  'mariadbd', 'qpidd', 'beam', 'rabbitmq', 'memcached']
+
+# extensions of the files of the objects, the rest of /srv/node is not stable
+OBJECT_FILES = ['data', 'ts', 'meta']
+
+COMPONENTS = [
+    ('mounts', "grep ' /srv/node' /proc/mounts | sort"),
+    ('rings', "md5sum /etc/swift/*.ring.gz /etc/swift/*.builder"),
+    ('services', "swift-init all status | grep -v '^No ' | awk '{print $1}'"
+                 " | sort"),
+    ('other_services', "ps -e -o comm= | grep -E '^(%s)' | sort -u"
+                       % "|".join(OTHER_SERVICES)),
+    ('config', "md5sum /etc/swift/*.conf /etc/swift/*/*.conf"),
+    ('data', "for d in /srv/node/*/; do"
+             " digest=$(cd $d && find . -type f \\( %s \\)"
+             " -printf '%%p %%s\\n' | LC_ALL=C sort | md5sum);"
+             " echo \"$d $digest\"; done"
+             % " -o ".join("-name '*.%s'" % ext for ext in OBJECT_FILES)),
+]
+
+# prefix of the lines separating the output of the commands
+_SEPARATOR = '### destroystack fingerprint '
+
+
+def take(servers):
+    """Get the fingerprint of the servers.
+
+    :param servers: list of `Server` objects
+    :returns: dict {server name: {component: list of output lines}}
+    """
+    return dict(parallel.run_parallel(_take_server_fingerprint, servers))
+
+
+def compare(old, new):
+    """Find out which components of the fingerprint differ.
+
+    :param old: fingerprint returned by `take`
+    :param new: fingerprint returned by `take`
+    :returns: set of names of the components that changed on any server; if
+        the servers themselves differ, all the components are returned
+    """
+    if set(old.keys()) != set(new.keys()):
+        return set(name for name, _ in COMPONENTS)
+    changed = set()
+    for server_name in old:
+        for name, _ in COMPONENTS:
+            if old[server_name].get(name) != new[server_name].get(name):
+                LOG.info("[%s] State changed: %s", server_name, name)
+                changed.add(name)
+    return changed
+
+
+def _take_server_fingerprint(server):
+    script = ["echo '%s%s'; (%s) 2>&1" % (_SEPARATOR, name, command)
+              for name, command in COMPONENTS]
+    result = server.cmd("; ".join(script), ignore_failures=True,
+                        log_cmd=False)
+    fingerprint = dict()
+    lines = None
+    for line in result.out:
+        if line.startswith(_SEPARATOR):
+            lines = fingerprint.setdefault(line[len(_SEPARATOR):], [])
+        elif lines is not None:
+            lines.append(line)
+    return server.name, fingerprint
@@ -0,0 +1,257 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Save and restore the state of bare metal servers with LVM thin snapshots.
+
+The volumes that keep the state of a server are given in the configuration
+file, in the "lvm_volumes" list of each server, in the format "vg/lv". They
+have to be thin volumes, so that the snapshots don't need any pre-allocated
+space and are created instantly. Usually these are the Swift data volumes
+and the volumes with /etc and /var (or the whole root volume).
+
+A volume that can be unmounted is restored by swapping it for a new thin
+snapshot of the saved snapshot, which keeps the saved snapshot intact for the
+next restoration and takes only a few seconds. A volume that cannot be
+unmounted (like the root volume) is restored with `lvconvert --merge`, which
+needs the server to be rebooted, after which the snapshot is created again.
+
+For trying it out on a single machine, `create_loop_volume_group` can create
+a volume group with thin volumes backed by a loop device.
+"""
+
+import logging
+import time
+import destroystack.tools.common as common
+import destroystack.tools.parallel as parallel
+import destroystack.tools.servers as server_tools
+import destroystack.tools.state_restoration.manual as manual
+from destroystack.tools.timeout import wait_for
+
+LOG = logging.getLogger(__name__)
+REBOOT_TIMEOUT = 10 * 60
+
+
+def create_snapshots(server_manager, tag=''):
+    """Create thin snapshots of the "lvm_volumes" of all servers.
+
+    Snapshots that already exist are reused. The servers are snapshotted in
+    parallel.
+
+    :param tag: appended to the name of the snapshots
+    """
+    parallel.run_parallel(lambda server: _create_server_snapshots(server, tag),
+                          _get_lvm_servers(server_manager))
+
+
+def restore_snapshots(server_manager, tag=''):
+    """Roll back the "lvm_volumes" of all servers to their snapshots.
+
+    Supposed to run after `create_snapshots`, the snapshots are found by the
+    same name. Swift services are stopped during the restoration.
+
+    :param tag: added to the end of the searched name of the snapshot
+    """
+    swift_proxy_servers = list(server_manager.servers(role='swift_proxy'))
+    swift_data_servers = list(server_manager.servers(role='swift_data'))
+    try:
+        manual.stop_swift_services(swift_proxy_servers, swift_data_servers)
+        parallel.run_parallel(
+            lambda server: _restore_server_snapshots(server, tag),
+            _get_lvm_servers(server_manager))
+    finally:
+        # rebooted servers already have them running
+        manual.restart_swift_services(swift_proxy_servers,
+                                      swift_data_servers)
+
+
+def snapshots_exist(server_manager, tag=''):
+    """Check if all the "lvm_volumes" of all servers have a snapshot."""
+    servers = _get_lvm_servers(server_manager)
+    if not servers:
+        return False
+    found = parallel.run_parallel(
+        lambda server: all(_volume_exists(server,
+                                          _get_snapshot_volume(volume, tag))
+                           for volume in server.lvm_volumes),
+        servers)
+    return all(found)
+
+
+def delete_snapshots(server_manager, tag=''):
+    """Delete the snapshots of the "lvm_volumes" of all servers.
+
+    Does not fail if some snapshot is not found.
+    """
+    for server in _get_lvm_servers(server_manager):
+        for volume in server.lvm_volumes:
+            snapshot = _get_snapshot_volume(volume, tag)
+            if _volume_exists(server, snapshot):
+                LOG.info("[%s] Deleting snapshot '%s'", server.name, snapshot)
+                server.cmd("lvremove -f %s" % snapshot)
+            else:
+                LOG.warning("[%s] Could not find snapshot '%s'",
+                            server.name, snapshot)
+
+
+def get_disk(volume):
+    """Get the device-mapper disk of the volume, like in "extra_disks".
+
+    For example "mapper/vg_swift-device1" for "vg_swift/device1".
+    """
+    return "mapper/%s" % "-".join(name.replace('-', '--')
+                                  for name in volume.split('/'))
+
+
+def create_loop_volume_group(server, vg_name, volume_count=3,
+                             volume_size='1G', image_dir='/var/tmp'):
+    """Create a volume group with thin volumes on a loop device.
+
+    Meant for testing the LVM state restoration on a single machine (it
+    works with `LocalServer` too). The volumes are formatted with ext4.
+
+    :param vg_name: name of the new volume group, also used for the name of
+        the image file
+    :param volume_count: how many thin volumes to create
+    :param volume_size: virtual size of each volume
+    :returns: list of the volumes in the "vg/lv" format
+    """
+    image = "%s/%s.img" % (image_dir, vg_name)
+    # the thin pool doesn't need to be bigger than the data actually written
+    server.cmd("truncate -s 4G %s" % image)
+    device = server.cmd("losetup -f --show %s" % image).out[0].strip()
+    server.cmd("pvcreate %s && vgcreate %s %s" % (device, vg_name, device))
+    server.cmd("lvcreate -l 90%%VG -T %s/pool" % vg_name)
+    volumes = list()
+    for i in range(1, volume_count + 1):
+        volume = "%s/device%d" % (vg_name, i)
+        server.cmd("lvcreate -V %s -T %s/pool -n device%d"
+                   % (volume_size, vg_name, i))
+        server.cmd("mkfs.ext4 -q /dev/%s" % volume)
+        volumes.append(volume)
+    return volumes
+
+
+def remove_loop_volume_group(server, vg_name, image_dir='/var/tmp'):
+    """Remove a volume group created by `create_loop_volume_group`."""
+    image = "%s/%s.img" % (image_dir, vg_name)
+    server.cmd("vgremove -f %s" % vg_name, ignore_failures=True)
+    result = server.cmd("losetup -j %s" % image, ignore_failures=True)
+    for line in result.out:
+        device = line.split(':')[0]
+        server.cmd("pvremove -f %s" % device, ignore_failures=True)
+        server.cmd("losetup -d %s" % device)
+    server.cmd("rm -f %s" % image)
+
+
+def _create_server_snapshots(server, tag):
+    server.cmd("sync")
+    for volume in server.lvm_volumes:
+        snapshot = _get_snapshot_volume(volume, tag)
+        if _volume_exists(server, snapshot):
+            LOG.info("[%s] Snapshot '%s' already exists, re-using it",
+                     server.name, snapshot)
+            continue
+        _check_thin(server, volume)
+        LOG.info("[%s] Creating snapshot '%s'", server.name, snapshot)
+        server.cmd("lvcreate -s -n %s %s"
+                   % (snapshot.split('/')[1], volume))
+
+
+def _restore_server_snapshots(server, tag):
+    merged = list()
+    for volume in server.lvm_volumes:
+        snapshot = _get_snapshot_volume(volume, tag)
+        if not _volume_exists(server, snapshot):
+            raise Exception("[%s] No snapshot with name '%s' found"
+                            % (server.name, snapshot))
+        mount_point = _get_mount_point(server, volume)
+        if mount_point:
+            umount = server.cmd("umount %s" % mount_point,
+                                ignore_failures=True)
+            if umount.exit_code != 0:
+                # in use, like the root volume - merge it on next boot
+                LOG.info("[%s] Merging snapshot '%s' into '%s' on reboot",
+                         server.name, snapshot, volume)
+                server.cmd("lvconvert --merge %s" % snapshot)
+                merged.append(volume)
+                continue
+        LOG.info("[%s] Restoring volume '%s' from snapshot '%s'",
+                 server.name, volume, snapshot)
+        server.cmd("lvremove -f %s" % volume)
+        server.cmd("lvcreate -s -kn -n %s %s"
+                   % (volume.split('/')[1], snapshot))
+        server.cmd("lvchange -ay %s" % volume)
+        if mount_point:
+            server.cmd("%s %s" % (server_tools.get_mount_command(volume),
+                                  mount_point))
+        elif get_disk(volume) in (server.disks or []):
+            # a killed Swift disk is not mounted anymore, mount it from fstab
+            server.restore_disk(get_disk(volume))
+
+    if merged:
+        _reboot(server)
+        # the merge consumed the snapshots, create them again
+        for volume in merged:
+            server.cmd("lvcreate -s -n %s %s"
+                       % (_get_snapshot_volume(volume, tag).split('/')[1],
+                          volume))
+
+
+def _reboot(server):
+    LOG.info("[%s] Rebooting", server.name)
+    server.cmd("reboot", ignore_failures=True)
+    server.disconnect()
+    # give it some time to actually go down
+    time.sleep(10)
+    wait_for("Waiting until '%s' is reachable by SSH" % server.name,
+             lambda connected: connected,
+             server.try_connect,
+             timeout_sec=REBOOT_TIMEOUT, period=5)
+
+
+def _get_lvm_servers(server_manager):
+    return [server for server in server_manager.servers()
+            if server.lvm_volumes]
+
+
+def _get_snapshot_volume(volume, tag):
+    """Get the "vg/lv" name of the snapshot of the volume."""
+    vg, lv = volume.split('/')
+    basename = common.CONFIG['management'].get('snapshot_prefix',
+                                               'destroystack-snapshot')
+    if tag:
+        tag = '_' + tag
+    return "%s/%s_%s%s" % (vg, basename, lv, tag)
+
+
+def _volume_exists(server, volume):
+    result = server.cmd("lvs %s" % volume, ignore_failures=True,
+                        log_cmd=False)
+    return result.exit_code == 0
+
+
+def _check_thin(server, volume):
+    result = server.cmd("lvs --noheadings -o pool_lv %s" % volume,
+                        log_cmd=False)
+    if not ''.join(result.out).strip():
+        raise Exception("[%s] Volume '%s' is not a thin volume, it cannot be"
+                        " used for state restoration" % (server.name, volume))
+
+
+def _get_mount_point(server, volume):
+    result = server.cmd("findmnt -n -o TARGET /dev/%s" % volume,
+                        ignore_failures=True, log_cmd=False)
+    if result.exit_code != 0 or not result.out:
+        return None
+    return result.out[0].strip()
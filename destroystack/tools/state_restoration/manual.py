@@ -31,6 +31,9 @@ run.
 """
 
 import logging
+import os
+import re
+import destroystack.tools.parallel as parallel
 import destroystack.tools.servers as servers
 
 LOG = logging.getLogger(__name__)
@@ -38,6 +41,10 @@ LOG = logging.getLogger(__name__)
 # where the openstack service files will be backed up on the remote servers
 BACKUP_DIR = '~/state_backup'
 
+# archive mode plus extended attributes, since Swift keeps the object metadata
+# in xattrs; unchanged files (same size and mtime) are skipped by rsync
+RSYNC_CMD = "rsync -aX --stats"
+
 
 def create_backup(server_manager, overwrite_old=False):
     """Create backup of configuration and files that keep state.
@@ -48,34 +55,29 @@ def create_backup(server_manager, overwrite_old=False):
     on the proxy servers, disk content of Swift disks and .recon files on the
     data servers. While doing this, all Swift services are stopped and then
     started again.
+
+    The backup is incremental - an older backup directory gets synchronized
+    with rsync, so only files that changed since then are copied. All the
+    servers and all the devices on them are backed up in parallel.
+
+    :param overwrite_old: remove the older backup first, so that everything
+        is copied again
+    :returns: tuple (bytes copied, bytes skipped because they didn't change)
     """
     swift_proxy_servers = list(server_manager.servers(role='swift_proxy'))
     swift_data_servers = list(server_manager.servers(role='swift_data'))
     LOG.info("Saving Swift state")
     try:
         stop_swift_services(swift_proxy_servers, swift_data_servers)
-        for server in server_manager.servers():
-            if not overwrite_old and server.file_exists(BACKUP_DIR):
-                LOG.info("[%s] Reusing older manual backup", server.name)
-                continue
-            server.cmd("rm -fr %s" % BACKUP_DIR, ignore_failures=True)
-            if 'swift_proxy' in server.roles:
-                server.cmd("""
-                    mkdir -p {0}/swift/etc &&
-                    cd /etc/swift && cp -rpi *.builder *.ring.gz {0}/swift/etc/
-                    """.format(BACKUP_DIR))
-            if 'swift_data' in server.roles:
-                server.cmd("mkdir -p %s/swift/{devices,cache}" % BACKUP_DIR)
-                server.cmd(
-                    "cp -pi /var/cache/swift/* %s/swift/cache/" % BACKUP_DIR,
-                    ignore_failures=True)
-                for device in server.get_mount_points().values():
-                    server.cmd("cp -rp %s %s/swift/devices/"
-                               % (device, BACKUP_DIR))
-            LOG.debug("Contents of backup directory:\n%s",
-                      server.cmd("find %s" % BACKUP_DIR, ignore_failures=True))
+        stats = parallel.run_parallel(
+            lambda server: _backup_server(server, overwrite_old),
+            server_manager.servers())
     finally:
         start_swift_services(swift_proxy_servers, swift_data_servers)
+    copied, skipped = _sum_stats(stats)
+    LOG.info("Backup finished: copied %d bytes, skipped %d unchanged bytes",
+             copied, skipped)
+    return copied, skipped
 
 
 def restore_backup(server_manager):
@@ -83,29 +85,94 @@ def restore_backup(server_manager):
 
     Only Swift is supported so far.
 
-    Symmetric function to `create_backup`. Cleans and re-mounts disks on
-    data servers. Restores rings and builder files, restarts swift services.
+    Symmetric function to `create_backup`. Re-mounts disks on data servers
+    (only the disks that cannot be mounted anymore get formatted). Restores
+    rings and builder files, restarts swift services. Only the files that
+    differ from the backup are copied back.
+
+    :returns: tuple (bytes copied, bytes skipped because they didn't change)
     """
     swift_proxy_servers = list(server_manager.servers(role='swift_proxy'))
     swift_data_servers = list(server_manager.servers(role='swift_data'))
     try:
         stop_swift_services(swift_proxy_servers, swift_data_servers)
-        for server in server_manager.servers():
-            if 'swift_proxy' in server.roles:
-                server.cmd("""
-                    service rsyslog restart && service memcached restart &&
-                    cd /etc/swift &&
-                    rm -fr *.builder *.ring.gz backups """)
-            if 'swift_data' in server.roles:
-                server.cmd("rm -f /var/cache/swift/*.recon")
-                for disk in server.disks:
-                    server.umount(disk)
-                server.cmd("rm -fr /srv/node/device*/*")
-                for disk in server.disks:
-                    server.cmd("mkfs.ext4 /dev/%s && mount /dev/%s"
-                               % (disk, disk))
+        parallel.run_parallel(_clean_server, server_manager.servers())
     finally:
-        _restore_backup_files(server_manager)
+        stats = _restore_backup_files(server_manager)
+    copied, skipped = _sum_stats(stats)
+    LOG.info("Restore finished: copied %d bytes, skipped %d unchanged bytes",
+             copied, skipped)
+    return copied, skipped
+
+
+def _backup_server(server, overwrite_old):
+    """Back up the Swift files of one server.
+
+    :returns: list of (total bytes, transferred bytes) tuples
+    """
+    if overwrite_old:
+        server.cmd("rm -fr %s" % BACKUP_DIR, ignore_failures=True)
+    stats = list()
+    if 'swift_proxy' in server.roles:
+        server.cmd("mkdir -p %s/swift/etc" % BACKUP_DIR)
+        stats.append(_rsync(server,
+                            "/etc/swift/*.builder /etc/swift/*.ring.gz",
+                            "%s/swift/etc/" % BACKUP_DIR))
+    if 'swift_data' in server.roles:
+        server.cmd("mkdir -p %s/swift/{devices,cache}" % BACKUP_DIR)
+        stats.append(_rsync(server, "/var/cache/swift/",
+                            "%s/swift/cache/" % BACKUP_DIR,
+                            delete=True, ignore_failures=True))
+
+        def backup_device(mount_point):
+            return _rsync(server, mount_point + "/",
+                          "%s/swift/devices/%s/"
+                          % (BACKUP_DIR, os.path.basename(mount_point)),
+                          delete=True)
+
+        stats.extend(parallel.run_parallel(
+            backup_device, server.get_mount_points().values()))
+    LOG.debug("Contents of backup directory:\n%s",
+              server.cmd("find %s" % BACKUP_DIR,
+                         ignore_failures=True))
+    return stats
+
+
+def _clean_server(server):
+    """Prepare the server for copying back the backed up files.
+
+    Unmounts the Swift disks, cleans whatever got written below their mount
+    points and mounts them again. Formatting is done only if the disk cannot
+    be mounted, otherwise the files on it will be synchronized with the
+    backup.
+    """
+    if 'swift_proxy' in server.roles:
+        server.cmd("""
+            service rsyslog restart && service memcached restart &&
+            cd /etc/swift &&
+            rm -fr *.builder *.ring.gz backups """)
+    if 'swift_data' in server.roles:
+        server.cmd("rm -f /var/cache/swift/*.recon")
+        server.wrap_disks()
+        server.clear_disk_faults()
+        for disk in server.disks:
+            server.umount(disk)
+        server.cmd("rm -fr /srv/node/device*/*")
+
+        def remount(disk):
+            device = server.get_device(disk)
+            mount = servers.get_mount_command(device)
+            result = server.cmd(mount, ignore_failures=True)
+            if result.exit_code != 0:
+                LOG.info("[%s] Disk /dev/%s cannot be mounted, formatting it",
+                         server.name, disk)
+                server.cmd("%s && %s"
+                           % (servers.get_mkfs_command(device), mount))
+                return True
+            return False
+
+        if any(parallel.run_parallel(remount, server.disks)):
+            server.wait_for_disk_init()
 
 
 def _restore_backup_files(server_manager):
@@ -114,46 +181,107 @@ def _restore_backup_files(server_manager):
     Symmetric method to '_backup'. Brings Swift back to the state where it
     was when making the backup. While doing this, Swift services are
     stopped and then started again.
+
+    :returns: list of lists of (total bytes, transferred bytes) tuples
     """
     swift_proxy_servers = list(server_manager.servers(role='swift_proxy'))
     swift_data_servers = list(server_manager.servers(role='swift_data'))
     LOG.info("Restoring Swift state")
     try:
         stop_swift_services(swift_proxy_servers, swift_data_servers)
-        for server in swift_proxy_servers:
-            server.cmd("cp -rp %s/swift/etc/* /etc/swift/ " % BACKUP_DIR)
-        for server in swift_data_servers:
-            for _ in server.get_mount_points().values():
-                server.cmd(
-                    "cp -rp %s/swift/devices/* /srv/node/" % BACKUP_DIR)
-            server.cmd("chown -R swift:swift /srv/node/*")
-            server.cmd("restorecon -R /srv/*")
-            server.cmd(
-                "cp -rp %s/swift/cache/* /var/cache/swift/" % BACKUP_DIR,
-                ignore_failures=True)
+        stats = parallel.run_parallel(_restore_server_files,
+                                      server_manager.servers())
     finally:
         start_swift_services(swift_proxy_servers, swift_data_servers)
+    return stats
+
+
+def _restore_server_files(server):
+    """Copy back the files that differ from the backup on one server.
+
+    :returns: list of (total bytes, transferred bytes) tuples
+    """
+    stats = list()
+    if 'swift_proxy' in server.roles:
+        stats.append(_rsync(server, "%s/swift/etc/" % BACKUP_DIR,
+                            "/etc/swift/"))
+    if 'swift_data' in server.roles:
+
+        # the ownership and SELinux labels are restored by rsync too, the
+        # mount point included
+        def restore_device(mount_point):
+            return _rsync(server,
+                          "%s/swift/devices/%s/"
+                          % (BACKUP_DIR, os.path.basename(mount_point)),
+                          mount_point + "/", delete=True)
+
+        stats.extend(parallel.run_parallel(
+            restore_device, server.get_mount_points().values()))
+        stats.append(_rsync(server, "%s/swift/cache/" % BACKUP_DIR,
+                            "/var/cache/swift/", ignore_failures=True))
+    return stats
+
+
+def _rsync(server, source, destination, delete=False, ignore_failures=False):
+    """Synchronize files on the server, copying only the changed ones.
+
+    :returns: tuple (total size of the source files in bytes, size of the
+        transferred files in bytes)
+    """
+    cmd = RSYNC_CMD
+    if delete:
+        cmd += " --delete"
+    result = server.cmd("%s %s %s" % (cmd, source, destination),
+                        ignore_failures=ignore_failures)
+    return _parse_rsync_stats(result.out)
+
+
+def _parse_rsync_stats(output):
+    """Get the (total, transferred) byte counts from `rsync --stats` output."""
+    stats = dict()
+    for line in output:
+        match = re.match(r"Total (transferred )?file size: ([\d,.]+)", line)
+        if match:
+            key = 'transferred' if match.group(1) else 'total'
+            stats[key] = int(re.sub(r"[,.]", "", match.group(2)))
+    return stats.get('total', 0), stats.get('transferred', 0)
+
+
+def _sum_stats(stats):
+    """Sum nested lists of (total, transferred) into (copied, skipped)."""
+    total = 0
+    transferred = 0
+    for server_stats in stats:
+        for server_total, server_transferred in server_stats:
+            total += server_total
+            transferred += server_transferred
+    return transferred, total - transferred
 
 
 def stop_swift_services(proxy_servers, data_servers):
-    for server in proxy_servers + data_servers:
-        try:
-            server.cmd("swift-init all stop", log_output=False)
-        except servers.ServerException:
-            # 'swift-init all stop' returns non-zero if the services are
-            # already stopped, so check if this is the case
-            services = get_running_swift_services(server)
-            if len(services) > 0:
-                raise servers.ServerException(
-                    "[%s] " % server.name,
-                    "Could not stop Swift services: %s" % services)
+    parallel.run_parallel(_stop_swift_services_on,
+                          set(proxy_servers + data_servers))
+
+
+def _stop_swift_services_on(server):
+    try:
+        server.cmd("swift-init all stop", log_output=False)
+    except servers.ServerException:
+        # 'swift-init all stop' returns non-zero if the services are
+        # already stopped, so check if this is the case
+        services = get_running_swift_services(server)
+        if len(services) > 0:
+            raise servers.ServerException(
+                "[%s] " % server.name,
+                "Could not stop Swift services: %s" % services)
 
 
 def start_swift_services(proxy_servers, data_servers):
-    for server in data_servers:
-        server.cmd("swift-init account container object rest start")
-    for server in proxy_servers:
-        server.cmd("swift-init proxy start")
+    parallel.run_parallel(
+        lambda s: s.cmd("swift-init account container object rest start"),
+        data_servers)
+    parallel.run_parallel(lambda s: s.cmd("swift-init proxy start"),
+                          proxy_servers)
 
 
 def restart_swift_services(proxy_servers, data_servers):
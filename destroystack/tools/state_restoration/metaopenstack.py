@@ -13,29 +13,43 @@
 # limitations under the License.
 
 
+import functools
 import logging
 import time
 import itertools
-import socket
-from novaclient import client
-from novaclient import exceptions
+import threading
 
-from destroystack.tools.timeout import wait_for
-import destroystack.tools.server as server_tools
+from destroystack.tools.timeout import wait_for, wait_for_all
+import destroystack.tools.parallel as parallel
+import destroystack.tools.servers as server_tools
 import destroystack.tools.common as common
 
 LOG = logging.getLogger(__name__)
 SNAPSHOT_TIMEOUT = 5 * 60
+# how long it can take for the SSH to be available after a VM gets rebuilt
+SSH_TIMEOUT = 5 * 60
 
+# novaclient is imported only when used, since it is slow to import and most
+# runs use other management types
 
-def create_snapshots(tag=''):
+# index {IP address: list of VMs which have it}, built from a single listing
+# of all the VMs and kept until some VMs get rebuilt
+_VM_INDEX = None
+_VM_INDEX_LOCK = threading.Lock()
+
+
+def create_snapshots(tag='', servers=None):
     """Create snapshots of OpenStack VMs and wait until they are active.
 
     It will reuse the snapshots that already exist, and create those that
     don't. In both cases it will wait until they are all in the active state.
+
+    :param servers: list of `Server` objects of the VMs, their SSH connections
+        will be reused; by default they are created from the "servers" in the
+        configuration file
     """
     nova = _get_nova_client()
-    vms, ssh_servers = _find_vms(nova)
+    vms, ssh_servers = _find_vms(nova, servers)
 
     snapshots = list()
     for vm_id, ssh in zip(vms, ssh_servers):
@@ -55,18 +69,21 @@ def create_snapshots(tag=''):
             s = vm.create_image(snapshot_name)
             snapshots.append(s)
 
-    for snapshot_id in snapshots:
-        snapshot = nova.images.get(snapshot_id)
-        wait_for("Waiting until snapshot '%s' is active" % snapshot.name,
-                 lambda x: x.status == 'ACTIVE',
-                 lambda: nova.images.get(snapshot_id),
+    snapshots = [nova.images.get(snapshot_id) for snapshot_id in snapshots]
+    wait_for_all([("snapshot '%s' is active" % snapshot.name,
+                   lambda x: x.status == 'ACTIVE',
+                   functools.partial(nova.images.get, snapshot.id))
+                  for snapshot in snapshots],
                  timeout_sec=SNAPSHOT_TIMEOUT)
 
 
-def restore_snapshots(tag=''):
-    """Restore snapshots of servers - find them by name."""
+def restore_snapshots(tag='', servers=None):
+    """Restore snapshots of servers - find them by name.
+
+    :param servers: see `create_snapshots`
+    """
     nova = _get_nova_client()
-    vms, _ = _find_vms(nova)
+    vms, ssh_servers = _find_vms(nova, servers)
     for vm_id in vms:
         vm = nova.servers.get(vm_id)
         snapshot_name = _get_snapshot_name(vm.name, tag)
@@ -75,33 +92,70 @@ def restore_snapshots(tag=''):
         # the same as the vm.id, check if status is active
         LOG.info("Rebuilding VM '%s' with image '%s'" % (vm.name, s.name))
         vm.rebuild(s)
+    _invalidate_vm_index()
 
-    for vm_id in vms:
-        vm = nova.servers.get(vm_id)
-        wait_for("Waiting until VM '%s' is in active state" % vm.name,
-                 lambda x: x.status == 'ACTIVE',
-                 lambda: nova.servers.get(vm_id),
+    wait_for_all([("VM '%s' is in active state" % server.name,
+                   lambda x: x.status == 'ACTIVE',
+                   functools.partial(nova.servers.get, vm_id))
+                  for vm_id, server in zip(vms, ssh_servers)],
                  timeout_sec=SNAPSHOT_TIMEOUT)
     # create new ssh connections
-    # TODO(mkollaro) wait until ssh works, not just an arbitrary sleep
-    time.sleep(3 * 60)
+    _wait_for_ssh(ssh_servers)
+
+
+def _wait_for_ssh(servers):
+    """Wait until all the servers are reachable by SSH and connect to them.
+
+    The servers that are not connected yet are probed in parallel, so that
+    one round takes at most one connection timeout, not the sum of them.
+    """
+    pending = list(servers)
+
+    def connect_pending():
+        connected = parallel.run_parallel(lambda s: s.try_connect(), pending)
+        pending[:] = [server for server, ok in zip(pending, connected)
+                      if not ok]
+        return pending
+
+    wait_for("Waiting until %s are reachable by SSH"
+             % ", ".join("'%s'" % server.name for server in servers),
+             lambda not_connected: not not_connected,
+             connect_pending,
+             timeout_sec=SSH_TIMEOUT, period=5)
 
 
-def delete_snapshots(tag=''):
+def snapshots_exist(tag='', servers=None):
+    """Check if all the VMs have an active snapshot with the tag.
+
+    :param servers: see `create_snapshots`
+    """
+    nova = _get_nova_client()
+    vms, _ = _find_vms(nova, servers)
+    for vm_id in vms:
+        vm = nova.servers.get(vm_id)
+        snapshot = _find_snapshot(nova, _get_snapshot_name(vm.name, tag))
+        if snapshot is None or snapshot.status != 'ACTIVE':
+            return False
+    return True
+
+
+def delete_snapshots(tag='', servers=None):
+    from novaclient import exceptions
     nova = _get_nova_client()
-    vms, _ = _find_vms(nova)
+    vms, _ = _find_vms(nova, servers)
     for vm_id in vms:
+        vm = nova.servers.get(vm_id)
+        snapshot_name = _get_snapshot_name(vm.name, tag)
         try:
-            vm = nova.servers.get(vm_id)
-            snapshot_name = _get_snapshot_name(vm.name, tag)
             s = nova.images.find(name=snapshot_name)
             LOG.info("Deleting snapshot '%s'", s.name)
             s.delete()
         except exceptions.NotFound:
-            LOG.warning("Could not find snapshot '%s'", s.name)
+            LOG.warning("Could not find snapshot '%s'", snapshot_name)
 
 
 def _find_snapshot(novaclient, snapshot_name):
+    from novaclient import exceptions
     try:
         snapshot = novaclient.images.find(name=snapshot_name)
         return snapshot
@@ -110,6 +164,7 @@ def _find_snapshot(novaclient, snapshot_name):
 
 
 def _get_nova_client():
+    from novaclient import client
     user = common.CONFIG['management']['user']
     tenant = common.CONFIG['management']['tenant']
     auth_url = common.CONFIG['management']['auth_url']
@@ -128,55 +183,72 @@ def _get_snapshot_name(vm_name, tag):
     return name
 
 
-def _find_vms(novaclient):
+def _find_vms(novaclient, servers=None):
     """Search for VMs by their ID or IP address
 
+    The VMs are looked up in an index of the VMs by IP address, which is
+    created by listing all the VMs only once and then reused until some VMs
+    get rebuilt.
+
+    :param servers: list of `Server` objects, see `create_snapshots`
     :returns: list of VMs and list of Server objects (which have the ssh
         connection to them), in the same order
     """
+    from novaclient import exceptions
+    if servers is None:
+        servers = server_tools.create_servers(common.CONFIG['servers'])
     vms = list()
-    ssh_servers = list()
-    for server in common.CONFIG['servers']:
-        if 'id' in server:
-            vm = novaclient.servers.get(server['id'])
+    for server in servers:
+        if server.vm_id:
+            vm = novaclient.servers.get(server.vm_id)
         else:
-            ip = server.get('ip', None)
-            if not ip:
-                ip = socket.gethostbyname(server['hostname'])
-            vm = _find_vm_by_ip(novaclient, ip)
+            vm = _find_vm_by_ip(novaclient, server.ip)
 
         if vm is None:
             raise exceptions.NotFound("Couldn't find server:\n %s" % server)
-        ssh = server_tools.Server(**server)
         vms.append(vm)
-        ssh_servers.append(ssh)
-    return vms, ssh_servers
+    return vms, servers
 
 
 def _find_vm_by_ip(novaclient, ip):
-    """Search trough all VMs and find one that has that IP on any network
-
-    Look at all the networks for each VM and see if one of them has that IP
-    address.
+    """Find the VM that has that IP on any network
 
     :raises novaclient.exceptions.NoUniqueMatch: if two VMs have the same IP
     :returns: the VM if found, None if not
     """
-    all_vms = novaclient.servers.list()
-    found = False
-    result = None
-    for vm in all_vms:
-        # ips is a list of lists of IPs for each network
-        ip_list = getattr(vm, 'networks', dict()).values()
-        # chain the ips into a single level list
-        all_ips = list(itertools.chain.from_iterable(ip_list))
-        if ip in all_ips:
-            if found is True:
-                msg = ("Found two VMs with the IP '%s'. This means it is"
-                       " possible for more VMs to have the same IP in your"
-                       " setup. To uniquely identify VMs, please provide the"
-                       " 'id' field in the configuration for each server")
-                raise exceptions.NoUniqueMatch(msg)
-            found = True
-            result = vm
-    return result
+    from novaclient import exceptions
+    found = _get_vm_index(novaclient).get(ip, [])
+    if len(found) > 1:
+        msg = ("Found two VMs with the IP '%s'. This means it is"
+               " possible for more VMs to have the same IP in your"
+               " setup. To uniquely identify VMs, please provide the"
+               " 'id' field in the configuration for each server" % ip)
+        raise exceptions.NoUniqueMatch(msg)
+    if found:
+        return found[0]
+    return None
+
+
+def _get_vm_index(novaclient):
+    """Get the index {IP address: list of VMs}, create it if necessary.
+
+    Looks at all the networks for each VM and indexes it by all its IPs.
+    """
+    global _VM_INDEX
+    with _VM_INDEX_LOCK:
+        if _VM_INDEX is None:
+            index = dict()
+            for vm in novaclient.servers.list():
+                # ips is a list of lists of IPs for each network
+                ip_list = getattr(vm, 'networks', dict()).values()
+                # chain the ips into a single level list
+                for ip in set(itertools.chain.from_iterable(ip_list)):
+                    index.setdefault(ip, []).append(vm)
+            _VM_INDEX = index
+        return _VM_INDEX
+
+
+def _invalidate_vm_index():
+    global _VM_INDEX
+    with _VM_INDEX_LOCK:
+        _VM_INDEX = None
@@ -31,7 +31,7 @@ LOG = logging.getLogger(__name__)
 VAGRANT_DIR = common.PROJ_DIR
 
 
-def create_snapshots(tag=''):
+def create_snapshots(tag='', vm_names=None):
     """Create snapshots of all Vagrant VMs found in the `VAGRANT_DIR`.
 
     The name of the snapshot will be the snapshot_prefix (defined in the
@@ -39,8 +39,9 @@ def create_snapshots(tag=''):
     Doesn't create new snapshots if the VM already has a snapshot with that
     name.
     :param tag: appended to the name of the snapshot
+    :param vm_names: snapshot only these VMs instead of all of them
     """
-    vms = _get_vagrant_vms()
+    vms = vm_names or _get_vagrant_vms()
     localhost = server_tools.LocalServer()
     for vm_name in vms:
         snapshot_name = _get_snapshot_name(vm_name, tag)
@@ -53,7 +54,7 @@ def create_snapshots(tag=''):
                      vm_name, snapshot_name)
 
 
-def restore_snapshots(tag=''):
+def restore_snapshots(tag='', vm_names=None):
     """Restore all the VMs found in `VAGRANT_DIR` to their snapshots.
 
     Supposed to run after `create_snapshots`.
@@ -61,8 +62,9 @@ def restore_snapshots(tag=''):
     `create_snapshots`.
 
     :param tag: added to the end of the searched name of the snapshot
+    :param vm_names: restore only these VMs instead of all of them
     """
-    vms = _get_vagrant_vms()
+    vms = vm_names or _get_vagrant_vms()
     localhost = server_tools.LocalServer()
     for vm_name in vms:
         snapshot_name = _get_snapshot_name(vm_name, tag)
@@ -75,7 +77,17 @@ def restore_snapshots(tag=''):
     time.sleep(3)
 
 
-def delete_snapshots(tag=''):
+def snapshots_exist(tag='', vm_names=None):
+    """Check if all the VMs have a snapshot with the tag.
+
+    :param vm_names: check only these VMs instead of all of them
+    """
+    vms = vm_names or _get_vagrant_vms()
+    return all(_snapshot_exists(vm_name, _get_snapshot_name(vm_name, tag))
+               for vm_name in vms)
+
+
+def delete_snapshots(tag='', vm_names=None):
     """Delete snapshots of VMS found in `VAGRANT_DIR`.
 
     The VMs are found by their name, same as in `create_snapshots`. Does not
@@ -83,8 +95,9 @@ def delete_snapshots(tag=''):
 
     Warning: slow operation
     :param tag: added to the end of the searched name of the snapshot
+    :param vm_names: delete snapshots only of these VMs
     """
-    vms = _get_vagrant_vms()
+    vms = vm_names or _get_vagrant_vms()
     localhost = server_tools.LocalServer()
     for vm_name in vms:
         snapshot_name = _get_snapshot_name(vm_name, tag)
@@ -14,13 +14,23 @@
 
 import swiftclient
 import logging
+import nose.tools
+import os
 import requests
 import time
 import destroystack.tools.common as common
+import destroystack.tools.fake_cluster as fake_cluster
+import destroystack.tools.metrics as metrics
+import destroystack.tools.network_faults as network_faults
+import destroystack.tools.parallel as parallel
+import destroystack.tools.tracing as tracing
+import destroystack.tools.timeout as timeout_tools
 from destroystack.tools.timeout import timeout
 
 LOG = logging.getLogger(__name__)
-TIMEOUT = common.get_timeout()
+# maximum time of a single request to an object server, in seconds
+HTTP_PROBE_TIMEOUT = 10
+THROUGHPUT_CONTAINER = 'destroystack-throughput'
 
 # workaround for some DEBUG messages that don't get captured by nose
 swiftclient.client.logger.setLevel(logging.INFO)
@@ -35,12 +45,22 @@ class Swift(swiftclient.client.Connection):
         extra function won't work
     """
     def __init__(self, server_manager):
-        auth_url, user, tenant, password = common.get_keystone_auth()
-        super(Swift, self).__init__(auth_url, user, password,
-                                    auth_version='2', tenant_name=tenant)
         self.manager = server_manager
         self.proxy_server = self.manager.get(role='swift_proxy')
+        self._openstack_version = None
+        cluster = getattr(self.proxy_server, 'cluster', None)
+        if cluster:
+            # simulated cluster without authentication, see
+            # `tools.fake_cluster`
+            super(Swift, self).__init__(preauthurl=cluster.storage_url,
+                                        preauthtoken=fake_cluster.TOKEN)
+            return
+        auth_url, user, tenant, password = common.get_keystone_auth(
+            server_manager.get(role='keystone'))
+        super(Swift, self).__init__(auth_url, user, password,
+                                    auth_version='2', tenant_name=tenant)
 
+    @tracing.traced('replicas_are_ok')
     def replicas_are_ok(self, count=3, check_nodes=None, exact=False):
         """Check if all objects and containers have enough replicas.
 
@@ -80,9 +100,10 @@ class Swift(swiftclient.client.Connection):
         LOG.info("all replicas found")
         return True
 
-    @timeout(TIMEOUT, "The replicas were not consistent within timeout.")
+    @timeout(common.get_timeout,
+             "The replicas were not consistent within timeout.")
     def wait_for_replica_regeneration(self, count=3, check_nodes=None,
-                                      exact=False):
+                                      exact=False, measure_traffic=False):
         """Wait until there are 'count' replicas of everything.
 
         :param check_nodes: Look only at first x number of nodes. Since usually
@@ -90,11 +111,121 @@ class Swift(swiftclient.client.Connection):
             'check_nodes=count', no handoff nodes will be checked out. If
             set to None, try all of them.
         :param exact: also fail if there are more than 'count' replicas
+        :param measure_traffic: save the replication throughput too - how
+            many bytes the data servers received from each other meanwhile,
+            counted by iptables rules that are removed afterwards, see
+            `Server.count_replication_traffic`
         :raises TimeoutException: after time in seconds set in the config file
+
+        The time it took is saved into the metrics database, see
+        `tools.metrics`.
         """
         LOG.info("Waiting until there is the right number of replicas")
-        while not self.replicas_are_ok(count, check_nodes, exact):
-            time.sleep(5)
+        if exact:
+            phase = 'handoff_cleanup'
+        elif check_nodes:
+            phase = 'primary_replicas'
+        else:
+            phase = 'replicas'
+        data_servers = self.manager.get_all(role='swift_data')
+        counting = [False]
+        if measure_traffic:
+            counting = parallel.run_parallel(
+                lambda server: server.count_replication_traffic(
+                    [s for s in data_servers if s is not server]),
+                data_servers)
+        received = 0
+        start = time.time()
+        outcome = 'error'
+        try:
+            with tracing.span('wait_for_replica_regeneration', count=count,
+                              check_nodes=check_nodes, exact=exact):
+                deadline = timeout_tools.current_deadline()
+                while not self.replicas_are_ok(count, check_nodes, exact):
+                    deadline.sleep(5)
+            outcome = 'ok'
+        except nose.tools.TimeExpired:
+            outcome = 'timeout'
+            raise
+        finally:
+            seconds = time.time() - start
+            metrics.record_recovery(phase, seconds, outcome,
+                                    self.get_topology(),
+                                    self.get_openstack_version())
+            if measure_traffic:
+                received = sum(s.get_replication_bytes() or 0
+                               for s in data_servers)
+                parallel.run_parallel(
+                    lambda server: server.stop_counting_replication_traffic(),
+                    data_servers)
+        if all(counting) and received > 0:
+            metrics.record_throughput('replication', received, seconds,
+                                      network_faults.get_conditions(),
+                                      self.get_topology(),
+                                      self.get_openstack_version())
+
+    def measure_throughput(self, object_size=2 ** 20, count=10):
+        """Upload and download objects and measure how fast it was.
+
+        The objects are deleted afterwards. Both measurements are saved into
+        the metrics database with the network faults currently in place, see
+        `tools.network_faults`.
+
+        :param object_size: size of each object, in bytes
+        :param count: number of objects
+        :returns: dict {"upload": bytes per second, "download": ...}
+        """
+        data = os.urandom(object_size)
+        names = ["object%d" % i for i in range(count)]
+        self.put_container(THROUGHPUT_CONTAINER)
+        throughput = dict()
+        start = time.time()
+        for name in names:
+            self.put_object(THROUGHPUT_CONTAINER, name, data)
+        throughput['upload'] = time.time() - start
+        start = time.time()
+        for name in names:
+            self.get_object(THROUGHPUT_CONTAINER, name)
+        throughput['download'] = time.time() - start
+        for name in names:
+            self.delete_object(THROUGHPUT_CONTAINER, name)
+        self.delete_container(THROUGHPUT_CONTAINER)
+        for kind, seconds in throughput.items():
+            metrics.record_throughput(kind, object_size * count, seconds,
+                                      network_faults.get_conditions(),
+                                      self.get_topology(),
+                                      self.get_openstack_version())
+            throughput[kind] = object_size * count / max(seconds, 1e-6)
+        return throughput
+
+    def get_topology(self):
+        """Describe the cluster, like "proxies=1,data_servers=2,disks=6"."""
+        proxies = self.manager.get_all(role='swift_proxy')
+        data_servers = self.manager.get_all(role='swift_data')
+        disks = sum(len(server.disks) for server in data_servers)
+        topology = "proxies=%d,data_servers=%d,disks=%d" % (
+            len(proxies), len(data_servers), disks)
+        if getattr(self.proxy_server, 'cluster', None):
+            topology += ",fake"
+        return topology
+
+    def get_openstack_version(self):
+        """Get the version of Swift on the proxy.
+
+        It can be set by "metrics.openstack_version" in the configuration,
+        otherwise the version of the installed package is used.
+        """
+        if self._openstack_version is None:
+            version = common.CONFIG.get('metrics', {}).get(
+                'openstack_version')
+            if not version:
+                result = self.proxy_server.cmd(
+                    "rpm -q --qf '%{VERSION}-%{RELEASE}' openstack-swift",
+                    ignore_failures=True, log_cmd=False)
+                if result.exit_code == 0 and result.out:
+                    version = result.out[0].strip()
+            self._openstack_version = version or 'unknown'
+        return self._openstack_version
 
     def _get_account_hash(self):
         """Gets the Swift account hash of the currently connected user.
@@ -136,6 +267,7 @@ class Swift(swiftclient.client.Connection):
         return urls
 
 
+@tracing.traced('file_urls_ok')
 def file_urls_ok(urls, name, count=3, check_url_count=None, exact=False):
     """Go trough URLs of the file and check if at least 'count' responded.
 
@@ -144,10 +276,14 @@ def file_urls_ok(urls, name, count=3, check_url_count=None, exact=False):
     :param check_url_count: try only first x number of the URLs. If set to
         None, try all.
     :param exact: also fail if there are more than 'count' replicas
+    :raises: `timeout.DeadlineExceeded` if the current deadline expires
     """
+    deadline = timeout_tools.Deadline()
     found = 0
     for url in urls[:check_url_count]:
-        r = requests.get(url)
+        with tracing.span('http_probe', category='http', url=url):
+            r = requests.get(url,
+                             timeout=deadline.timeout(HTTP_PROBE_TIMEOUT))
         if r.status_code in [200, 204]:
             found += 1
         else:
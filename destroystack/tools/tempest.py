@@ -12,24 +12,152 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""Running Tempest to check if the system is still functional.
+
+The tests are run from the virtualenv of the Tempest "all" tox environment.
+By default, they are run by a long-lived worker process (see
+`tools.tempest_worker`), which discovers and imports the tests only once, so
+that the repeated runs of a few smoke tests don't pay for starting tox and
+importing the whole Tempest every time. With "tempest_worker" set to false in
+the configuration, every run starts testr instead.
+
+The subunit output is parsed while it is being produced, so the results of
+the tests are known as soon as they finish and the memory usage doesn't grow
+with the amount of output.
+"""
+
+import atexit
 import exceptions
+import json
 import logging
+import os
+import subprocess
+import threading
 import destroystack.tools.common as common
-import destroystack.tools.servers as server_tools
 
 LOG = logging.getLogger(__name__)
-TIMEOUT = common.get_timeout()
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "tempest_worker.py")
+# the same as `tempest_worker.DONE_ID`, that module can't be imported here
+WORKER_DONE_ID = 'destroystack.tempest_worker.done'
+
+# statuses of finished tests in the subunit stream
+PASSED_STATUSES = ['success', 'xfail']
+FAILED_STATUSES = ['fail', 'uxsuccess']
+SKIPPED_STATUSES = ['skip']
+
+
+class TempestResult(object):
+    """Results of a Tempest run.
+
+    :ivar statuses: dict {test ID: subunit status, like "success"}
+    :ivar durations: dict {test ID: seconds}
+    :ivar failures: dict {test ID: traceback}
+    :ivar exit_code: exit code of testr, None if the run was aborted
+    """
+    def __init__(self):
+        self.statuses = dict()
+        self.durations = dict()
+        self.failures = dict()
+        self.exit_code = None
+
+    @property
+    def passed(self):
+        return [t for t, s in self.statuses.items() if s in PASSED_STATUSES]
+
+    @property
+    def failed(self):
+        return [t for t, s in self.statuses.items() if s in FAILED_STATUSES]
+
+    @property
+    def skipped(self):
+        return [t for t, s in self.statuses.items() if s in SKIPPED_STATUSES]
+
+    @property
+    def success(self):
+        return self.exit_code == 0 and not self.failed
+
+    def slowest(self, count=10):
+        """Get the slowest tests.
+
+        :returns: list of (test ID, seconds), the slowest first
+        """
+        return sorted(self.durations.items(), key=lambda x: x[1],
+                      reverse=True)[:count]
+
+    def __str__(self):
+        summary = ("%d passed, %d failed, %d skipped"
+                   % (len(self.passed), len(self.failed), len(self.skipped)))
+        slowest = "\n".join("    %.1fs %s" % (seconds, test)
+                            for test, seconds in self.slowest(5))
+        return "%s\nslowest tests:\n%s" % (summary, slowest)
+
+
+class _FailFast(Exception):
+    pass
+
+
+class _WorkerDone(Exception):
+    pass
+
+
+class _SubunitCollector(object):
+    """Collect the statuses and durations of the tests from subunit events.
+
+    Only the attachments of the tests that are still running are kept, and
+    only the tracebacks of the failed ones are saved. It implements just the
+    `status` method of `testtools.StreamResult`, which is all the subunit
+    parser calls, so that testtools doesn't have to be imported.
+    """
+    def __init__(self, result, fail_fast=False):
+        self.result = result
+        self.fail_fast = fail_fast
+        self._started = dict()
+        self._attachments = dict()
+
+    def status(self, test_id=None, test_status=None, test_tags=None,
+               runnable=True, file_name=None, file_bytes=None, eof=False,
+               mime_type=None, route_code=None, timestamp=None):
+        if test_id == WORKER_DONE_ID:
+            raise _WorkerDone(bytes(file_bytes).decode('utf-8'))
+        if test_id is None:
+            if file_bytes:
+                LOG.debug("[tempest] %s",
+                          bytes(file_bytes).decode('utf-8', 'replace'))
+            return
+        if file_name == 'traceback' and file_bytes:
+            self._attachments.setdefault(test_id, []).append(file_bytes)
+        if test_status == 'inprogress':
+            self._started[test_id] = timestamp
+        elif test_status in PASSED_STATUSES + FAILED_STATUSES \
+                + SKIPPED_STATUSES:
+            self._finish(test_id, test_status, timestamp)
+
+    def _finish(self, test_id, test_status, timestamp):
+        result = self.result
+        result.statuses[test_id] = test_status
+        started = self._started.pop(test_id, None)
+        if started and timestamp:
+            result.durations[test_id] = \
+                (timestamp - started).total_seconds()
+        traceback = b''.join(self._attachments.pop(test_id, []))
+        if test_status in FAILED_STATUSES:
+            result.failures[test_id] = traceback.decode('utf-8', 'replace')
+            LOG.warning("[tempest] %s ... %s\n%s", test_id, test_status,
+                        result.failures[test_id])
+            if self.fail_fast:
+                raise _FailFast(test_id)
+        else:
+            LOG.debug("[tempest] %s ... %s", test_id, test_status)
 
 
 def run(include=None, exclude=None, test_type=None, test_dir="api",
-        regexp=None, concurrency=4):
-    """Run part of Tempest using tox.
+        regexp=None, concurrency=4, fail_fast=False):
+    """Run part of Tempest using testr from its tox virtualenv.
 
     This function expects that Tempest is already configured in the directory
     given in the configuration file under "tempest_dir".
 
-    TODO: parse result, return number of test ran/succeeded/failed
-
     :param include: which tests should run (e.g. 'identity', 'compute', ..)
     :param exclude: which tests to skip, (TODO: not implemented)
     :param test_type: can be "smoke" or "gate" or other test types
@@ -37,9 +165,11 @@ def run(include=None, exclude=None, test_type=None, test_dir="api",
     :param regexp: specify your own regular expression to filter tests, this
         will overwrite the parameters `include`, `exclude`, `test_type`,
         and `test_dir`
-    :param concurrency: how many threads to use to execute the tests
+    :param concurrency: maximum number of processes executing the tests; the
+        worker uses less of them if there are less test classes selected
+    :param fail_fast: stop the run on the first failed test
 
-    :returns: `tools.servers.CommandResult` of the test run
+    :returns: `TempestResult`
     :raises: AssertionError if one of the tests fail
     """
     if exclude:
@@ -50,13 +180,140 @@ def run(include=None, exclude=None, test_type=None, test_dir="api",
 
     if not regexp:
         regexp = "(^tempest\.%s\.%s.*%s.*)" % (test_dir, include, test_type)
-    cmd = ("cd %s && tox -eall '%s' --"
-           " --concurrency=%s" % (tempest_dir, regexp, concurrency))
-
-    localhost = server_tools.LocalServer()
-    result = localhost.cmd(cmd, ignore_failures=True)
-    if result.exit_code == 0:
+    if common.CONFIG.get("tempest_worker", True):
+        result = get_worker(tempest_dir).run(regexp, concurrency, fail_fast)
+    else:
+        cmd = ("cd %s && tox -eall --notest -q && .tox/all/bin/testr run"
+               " --subunit --parallel --concurrency=%s '%s'"
+               % (tempest_dir, concurrency, regexp))
+        result = _run_subunit_command(cmd, fail_fast)
+    LOG.info("Tempest finished: %s", result)
+    if result.success:
         return result
     else:
         raise exceptions.AssertionError("Some of the Tempest tests failed,"
-                                        " system is not functional")
+                                        " system is not functional: %s"
+                                        % ", ".join(sorted(result.failed)))
+
+
+def _run_subunit_command(cmd, fail_fast=False):
+    """Run the command and parse its subunit output while it runs.
+
+    :returns: `TempestResult`
+    """
+    # subunit (and testtools with it) take a while to import
+    import subunit
+    LOG.info("[localhost] %s", cmd)
+    result = TempestResult()
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    collector = _SubunitCollector(result, fail_fast)
+    try:
+        subunit.ByteStreamToStreamResult(
+            process.stdout, non_subunit_name='stdout').run(collector)
+    except _FailFast as e:
+        LOG.warning("Stopping Tempest after the first failure: %s", e)
+        process.kill()
+        process.wait()
+        return result
+    result.exit_code = process.wait()
+    return result
+
+
+class TempestWorker(object):
+    """Long-lived process running Tempest tests, see `tools.tempest_worker`.
+
+    The tox virtualenv is prepared and the tests are discovered only when the
+    worker starts. It is restarted if it dies or if a run is aborted.
+
+    :param tempest_dir: directory with configured Tempest
+    """
+    def __init__(self, tempest_dir):
+        self.tempest_dir = tempest_dir
+        self.process = None
+        self._lock = threading.Lock()
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        cmd = "cd %s && tox -eall --notest -q" % self.tempest_dir
+        LOG.info("[localhost] %s", cmd)
+        subprocess.check_call(cmd, shell=True)
+        python = os.path.join(self.tempest_dir, ".tox", "all", "bin",
+                              "python")
+        LOG.info("Starting the Tempest worker")
+        self.process = subprocess.Popen([python, WORKER_SCRIPT],
+                                        cwd=self.tempest_dir, bufsize=-1,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.alive:
+            LOG.info("Stopping the Tempest worker")
+            self.process.stdin.close()
+            self.process.kill()
+        self.process.wait()
+        self.process = None
+
+    def run(self, regexp, concurrency=4, fail_fast=False):
+        """Run the tests with IDs matching the regular expression.
+
+        :param concurrency: maximum number of processes executing the tests
+        :returns: `TempestResult`, its `exit_code` is None if the run was
+            aborted or the worker died
+        """
+        import subunit
+        with self._lock:
+            if not self.alive:
+                self.start()
+            LOG.info("[tempest worker] running '%s'", regexp)
+            request = json.dumps({'regexp': regexp,
+                                  'concurrency': concurrency})
+            self.process.stdin.write(request.encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+
+            result = TempestResult()
+            collector = _SubunitCollector(result, fail_fast)
+            try:
+                subunit.ByteStreamToStreamResult(
+                    self.process.stdout,
+                    non_subunit_name='stdout').run(collector)
+            except _FailFast as e:
+                LOG.warning("Stopping Tempest after the first failure: %s", e)
+                self.stop()
+                return result
+            except _WorkerDone as e:
+                summary = json.loads(str(e))
+                LOG.info("Tempest worker ran %d tests in %d processes",
+                         summary['selected'], summary['concurrency'])
+                result.exit_code = 0
+                return result
+            LOG.warning("The Tempest worker died with exit code %s",
+                        self.process.wait())
+            self.process = None
+            return result
+
+
+_worker = None
+
+
+def get_worker(tempest_dir):
+    """Get the worker for the Tempest directory, it is created only once."""
+    global _worker
+    if _worker is None or _worker.tempest_dir != tempest_dir:
+        stop_worker()
+        _worker = TempestWorker(tempest_dir)
+    return _worker
+
+
+def stop_worker():
+    """Stop the Tempest worker, if there is one running."""
+    if _worker is not None:
+        _worker.stop()
+
+
+atexit.register(stop_worker)
@@ -0,0 +1,164 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Long-lived process running Tempest tests, see `tools.tempest`.
+
+It is started with the Python of the Tempest virtualenv, in the Tempest
+directory, so it must not import anything from DestroyStack. The tests are
+discovered (and their modules imported) only once, when the worker starts.
+
+Each line on stdin is a JSON request:
+
+    {"regexp": "^tempest\\.api\\.identity.*smoke", "concurrency": 4}
+
+The selected tests are split by test class into partitions, each of them is
+run in a forked child process (which already has all the modules imported)
+and the results are written to stdout as a subunit v2 stream. When all the
+partitions are finished, a packet with the test ID `DONE_ID` and a JSON
+summary attached is written.
+"""
+
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import unittest
+
+import subunit
+import testtools
+
+DONE_ID = 'destroystack.tempest_worker.done'
+
+
+class _LockedWriter(object):
+    """Writes whole subunit packets to a file descriptor shared by processes.
+    """
+    def __init__(self, fd, lock):
+        self.fd = fd
+        self.lock = lock
+
+    def read(self, size=-1):
+        # tells subunit that this is a binary stream
+        raise io.UnsupportedOperation("write only")
+
+    def write(self, data):
+        with self.lock:
+            while data:
+                written = os.write(self.fd, data)
+                data = data[written:]
+
+    def flush(self):
+        pass
+
+
+def main():
+    # the protocol uses the original stdout, anything printed by the tests
+    # goes to stderr
+    out_fd = os.dup(1)
+    os.dup2(2, 1)
+    lock = multiprocessing.Lock()
+    writer = _LockedWriter(out_fd, lock)
+
+    start = time.time()
+    tests = discover()
+    discovery_time = time.time() - start
+    sys.stderr.write("Discovered %d tests in %.1f seconds\n"
+                     % (len(tests), discovery_time))
+
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        pattern = re.compile(request['regexp'])
+        selected = [t for t in tests if pattern.search(t.id())]
+        partitions = partition(selected, request.get('concurrency', 4))
+        run_partitions(partitions, out_fd, lock)
+        summary = {'selected': len(selected),
+                   'concurrency': len(partitions),
+                   'discovery_time': discovery_time}
+        subunit.StreamResultToBytes(writer).status(
+            test_id=DONE_ID, file_name='summary',
+            file_bytes=json.dumps(summary).encode('utf-8'),
+            mime_type='application/json', eof=True)
+
+
+def discover():
+    """Find and import all the tests, the same way testr would."""
+    test_path = './tempest'
+    if os.path.exists('.testr.conf'):
+        with open('.testr.conf') as f:
+            match = re.search(r'OS_TEST_PATH:-([^}\s]+)', f.read())
+        if match:
+            test_path = match.group(1)
+    test_path = os.environ.get('OS_TEST_PATH', test_path)
+    suite = unittest.TestLoader().discover(test_path, top_level_dir='./')
+    return list(_flatten(suite))
+
+
+def partition(tests, max_concurrency):
+    """Split the tests by class into at most `max_concurrency` partitions.
+
+    The tests of a class stay together, so that the class fixtures are set
+    up only once. There are never more partitions than classes, so a small
+    selection doesn't pay for starting idle processes.
+    """
+    classes = dict()
+    for test in tests:
+        classes.setdefault(type(test), []).append(test)
+    groups = sorted(classes.values(), key=len, reverse=True)
+    count = max(1, min(max_concurrency, len(groups)))
+    partitions = [[] for _ in range(count)]
+    for group in groups:
+        min(partitions, key=len).extend(group)
+    return [p for p in partitions if p]
+
+
+def run_partitions(partitions, out_fd, lock):
+    children = list()
+    for tests in partitions:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_tests(tests, _LockedWriter(out_fd, lock))
+            finally:
+                os._exit(0)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+def _run_tests(tests, writer):
+    result = testtools.ExtendedToStreamDecorator(
+        subunit.StreamResultToBytes(writer))
+    result.startTestRun()
+    try:
+        unittest.TestSuite(tests).run(result)
+    finally:
+        result.stopTestRun()
+
+
+def _flatten(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for t in _flatten(test):
+                yield t
+        else:
+            yield test
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from destroystack.tools.state_restoration import fingerprint
+
+SEPARATOR = '### destroystack fingerprint '
+
+
+class CannedResult(object):
+    def __init__(self, out):
+        self.out = out
+
+
+class CannedServer(object):
+    """Returns the same output for every command, like a fingerprint run."""
+    def __init__(self, name, out):
+        self.name = name
+        self.out = out
+        self.commands = list()
+
+    def cmd(self, command, **kwargs):
+        self.commands.append(command)
+        return CannedResult(self.out)
+
+
+def make_fingerprint(**components):
+    full = dict((name, ['%s ok' % name]) for name, _ in fingerprint.COMPONENTS)
+    full.update(components)
+    return full
+
+
+class TestCompare():
+
+    def test_same(self):
+        old = {'server1': make_fingerprint(), 'server2': make_fingerprint()}
+        new = {'server1': make_fingerprint(), 'server2': make_fingerprint()}
+        assert fingerprint.compare(old, new) == set()
+
+    def test_changed_components(self):
+        old = {'server1': make_fingerprint(), 'server2': make_fingerprint()}
+        new = {'server1': make_fingerprint(data=['/srv/node/d1/ other']),
+               'server2': make_fingerprint(services=[])}
+        assert fingerprint.compare(old, new) == set(['data', 'services'])
+
+    def test_missing_component(self):
+        old = {'server1': make_fingerprint()}
+        new = {'server1': make_fingerprint()}
+        del new['server1']['rings']
+        assert fingerprint.compare(old, new) == set(['rings'])
+
+    def test_different_servers(self):
+        old = {'server1': make_fingerprint()}
+        new = {'server2': make_fingerprint()}
+        assert fingerprint.compare(old, new) == \
+            set(name for name, _ in fingerprint.COMPONENTS)
+
+
+class TestTakeServerFingerprint():
+
+    def test_sections(self):
+        server = CannedServer('server1', [
+            'noise before the first section',
+            SEPARATOR + 'mounts',
+            '/dev/sdb /srv/node/device1 ext4 rw 0 0',
+            '/dev/sdc /srv/node/device2 ext4 rw 0 0',
+            SEPARATOR + 'services',
+            SEPARATOR + 'data',
+            '/srv/node/device1/ d41d8cd98f00b204e9800998ecf8427e  -',
+        ])
+        name, result = fingerprint._take_server_fingerprint(server)
+        assert name == 'server1'
+        assert result == {
+            'mounts': ['/dev/sdb /srv/node/device1 ext4 rw 0 0',
+                       '/dev/sdc /srv/node/device2 ext4 rw 0 0'],
+            'services': [],
+            'data': ['/srv/node/device1/ d41d8cd98f00b204e9800998ecf8427e  -'],
+        }
+
+    def test_single_command(self):
+        server = CannedServer('server1', [])
+        fingerprint._take_server_fingerprint(server)
+        assert len(server.commands) == 1
+        for name, command in fingerprint.COMPONENTS:
+            assert "echo '%s%s'" % (SEPARATOR, name) in server.commands[0]
+            assert command in server.commands[0]
@@ -0,0 +1,140 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""LVM state restoration on a volume group backed by a loop device.
+
+Needs root and the LVM tools with thin provisioning, skipped otherwise.
+"""
+
+import os
+import tempfile
+import nose
+import destroystack.tools.common as common
+import destroystack.tools.servers as servers
+import destroystack.tools.state_restoration.lvm as lvm
+
+VG_NAME = 'destroystack-test'
+FSTAB_MARK = '# destroystack-test'
+TAG = 'test'
+# used instead of the configuration file, with the default disk options
+TEST_CONFIG = {
+    'management': {'type': 'lvm'},
+    'disks': dict(servers.DISK_DEFAULTS),
+}
+
+
+class LoopServer(servers.Server):
+    """This machine, with the volumes of the loop volume group.
+
+    The commands are run locally, there is no SSH connection.
+    """
+    def __init__(self, volumes, disks):
+        self.hostname = None
+        self.ip = '127.0.0.1'
+        self.name = 'localhost'
+        self.roles = set(['swift_data'])
+        self.disks = disks
+        self.lvm_volumes = volumes
+        self.vm_id = None
+        self._ssh = None
+
+    def connect(self, timeout=None):
+        pass
+
+    def try_connect(self, timeout=10):
+        return True
+
+    def disconnect(self):
+        pass
+
+    def cmd(self, command, **kwargs):
+        return servers.LocalServer.cmd(self, command, **kwargs)
+
+
+class TestLoopVolumeGroup():
+    local = servers.LocalServer()
+    volumes = None
+    mount_points = None
+    config = None
+
+    @classmethod
+    def setupClass(cls):
+        if os.geteuid() != 0:
+            raise nose.SkipTest("Root required for loop devices and LVM")
+        if cls.local.cmd("which lvcreate", ignore_failures=True,
+                         log_cmd=False).exit_code != 0:
+            raise nose.SkipTest("LVM tools not installed")
+        cls.volumes = lvm.create_loop_volume_group(cls.local, VG_NAME,
+                                                   volume_count=2,
+                                                   volume_size='64M')
+        cls.mount_points = dict((volume, tempfile.mkdtemp())
+                                for volume in cls.volumes)
+        cls.config = common.CONFIG
+        common.CONFIG = TEST_CONFIG
+
+    @classmethod
+    def teardownClass(cls):
+        if cls.config is not None:
+            common.CONFIG = cls.config
+        if cls.volumes is None:
+            return
+        for volume, mount_point in cls.mount_points.items():
+            cls.local.cmd("umount %s" % mount_point, ignore_failures=True)
+            os.rmdir(mount_point)
+        cls.local.cmd("sed -i '/%s$/d' /etc/fstab" % FSTAB_MARK)
+        lvm.remove_loop_volume_group(cls.local, VG_NAME)
+        assert VG_NAME not in cls.local.cmd("vgs -o vg_name").out
+
+    def setUp(self):
+        for volume, mount_point in self.mount_points.items():
+            self.local.cmd("mountpoint -q %s || mount /dev/%s %s"
+                           % (mount_point, volume, mount_point))
+
+    def test_volumes_created(self):
+        assert self.volumes == ["%s/device1" % VG_NAME,
+                                "%s/device2" % VG_NAME]
+        for volume in self.volumes:
+            assert self.local.cmd("lvs -o pool_lv --noheadings %s" % volume
+                                  ).out[0].strip() == 'pool'
+
+    def test_restore_mounted_volume(self):
+        volume = self.volumes[0]
+        mount_point = self.mount_points[volume]
+        server = LoopServer([volume], [])
+        lvm._create_server_snapshots(server, TAG)
+        self.local.cmd("touch %s/damage" % mount_point)
+        lvm._restore_server_snapshots(server, TAG)
+        assert self._is_mounted(mount_point)
+        assert not os.path.exists("%s/damage" % mount_point)
+
+    def test_restore_killed_disk(self):
+        if self.local.cmd("id swift", ignore_failures=True,
+                          log_cmd=False).exit_code != 0:
+            raise nose.SkipTest("The swift user is needed to restore disks")
+        volume = self.volumes[1]
+        mount_point = self.mount_points[volume]
+        self.local.cmd("echo '/dev/%s %s ext4 defaults 0 0 %s' >> /etc/fstab"
+                       % (lvm.get_disk(volume), mount_point, FSTAB_MARK))
+        disk = lvm.get_disk(volume)
+        server = LoopServer([volume], [disk])
+        lvm._create_server_snapshots(server, TAG)
+        self.local.cmd("touch %s/damage" % mount_point)
+        server.kill_disk(disk)
+        lvm._restore_server_snapshots(server, TAG)
+        assert self._is_mounted(mount_point)
+        assert not os.path.exists("%s/damage" % mount_point)
+
+    def _is_mounted(self, mount_point):
+        return self.local.cmd("mountpoint -q %s" % mount_point,
+                              ignore_failures=True).exit_code == 0
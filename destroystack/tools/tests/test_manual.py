@@ -0,0 +1,58 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from destroystack.tools.state_restoration import manual
+
+RSYNC_STATS = """
+Number of files: 1,042 (reg: 1,000, dir: 42)
+Number of created files: 3 (reg: 3)
+Number of deleted files: 0
+Number of regular files transferred: 3
+Total file size: 104,857,600 bytes
+Total transferred file size: 3,145,728 bytes
+Literal data: 3,145,728 bytes
+Matched data: 0 bytes
+File list size: 0
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 3,148,512
+Total bytes received: 95
+
+sent 3,148,512 bytes  received 95 bytes  6,297,214.00 bytes/sec
+total size is 104,857,600  speedup is 33.30
+""".strip().split("\n")
+
+# rsync before 3.1 doesn't group the digits
+OLD_RSYNC_STATS = """
+Number of files: 12
+Number of files transferred: 0
+Total file size: 4096 bytes
+Total transferred file size: 0 bytes
+""".strip().split("\n")
+
+
+class TestRsyncStats():
+
+    def test_parse(self):
+        assert manual._parse_rsync_stats(RSYNC_STATS) == (104857600, 3145728)
+
+    def test_parse_without_grouping(self):
+        assert manual._parse_rsync_stats(OLD_RSYNC_STATS) == (4096, 0)
+
+    def test_parse_no_stats(self):
+        assert manual._parse_rsync_stats(["rsync: some error"]) == (0, 0)
+
+    def test_sum(self):
+        stats = [[(100, 10), (50, 0)], [], [(1000, 1000)]]
+        assert manual._sum_stats(stats) == (1010, 140)
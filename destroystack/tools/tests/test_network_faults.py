@@ -0,0 +1,105 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Network faults between servers in network namespaces on this machine.
+
+Needs root, skipped otherwise.
+"""
+
+import os
+import nose
+import destroystack.tools.network_faults as network_faults
+import destroystack.tools.servers as servers
+
+PREFIX = 'ds-test'
+
+
+class NamespaceManager(object):
+    """The part of `ServerManager` used by `network_faults`."""
+    def __init__(self, namespaces):
+        self.namespaces = namespaces
+
+    def get_all(self, role=None):
+        return [s for s in self.namespaces if role is None or role in s.roles]
+
+
+class TestNetworkFaults():
+    manager = None
+
+    @classmethod
+    def setupClass(cls):
+        if os.geteuid() != 0:
+            raise nose.SkipTest("Root required for network namespaces")
+        proxy, data = network_faults.create_namespaces(2, prefix=PREFIX,
+                                                       subnet='10.198.0')
+        proxy.roles = set(['swift_proxy'])
+        data.roles = set(['swift_data'])
+        cls.manager = NamespaceManager([proxy, data])
+
+    @classmethod
+    def teardownClass(cls):
+        if cls.manager is not None:
+            network_faults.remove_namespaces(2, prefix=PREFIX)
+
+    def test_degraded(self):
+        self._require("tc qdisc add dev lo root netem delay 1ms"
+                      " && tc qdisc del dev lo root", "tc netem")
+        with network_faults.degraded(self.manager, 'swift_proxy',
+                                     'swift_data', delay_ms=100, loss=1):
+            assert network_faults.get_conditions() == \
+                "swift_proxy<->swift_data delay_ms=100 loss=1"
+            for server in self.manager.get_all():
+                qdiscs = "\n".join(server.cmd("tc qdisc show").out)
+                assert "netem" in qdiscs and "delay 100" in qdiscs, qdiscs
+        self._check_cleared()
+
+    def test_rate_limited(self):
+        with network_faults.degraded(self.manager, 'swift_proxy',
+                                     'swift_data', rate='1mbit'):
+            for server in self.manager.get_all():
+                classes = "\n".join(server.cmd("tc class show dev %s-in%d"
+                                               % (PREFIX, self._index(server))
+                                               ).out)
+                assert "rate 1Mbit" in classes, classes
+        self._check_cleared()
+
+    def test_partitioned(self):
+        self._require("iptables -nL", "iptables")
+        proxy = self.manager.get_all('swift_proxy')[0]
+        data = self.manager.get_all('swift_data')[0]
+        with network_faults.partitioned(self.manager, 'swift_proxy',
+                                        'swift_data'):
+            assert network_faults.get_conditions() == \
+                "swift_proxy</>swift_data"
+            rules = "\n".join(proxy.cmd("iptables -nL %s"
+                                        % servers.IPTABLES_CHAIN).out)
+            assert rules.count(data.ip) == 2, rules
+        self._check_cleared()
+
+    def _index(self, server):
+        return self.manager.get_all().index(server) + 1
+
+    def _require(self, command, name):
+        namespace = self.manager.get_all()[0]
+        if namespace.cmd(command, ignore_failures=True).exit_code != 0:
+            raise nose.SkipTest("%s not available" % name)
+
+    def _check_cleared(self):
+        assert network_faults.get_conditions() == "none"
+        for server in self.manager.get_all():
+            qdiscs = "\n".join(server.cmd("tc qdisc show").out)
+            assert "%s:" % servers.QDISC_HANDLE not in qdiscs, qdiscs
+            rules = server.cmd("iptables -S %s" % servers.IPTABLES_CHAIN,
+                               ignore_failures=True).out
+            assert not [r for r in rules if 'DROP' in r], rules
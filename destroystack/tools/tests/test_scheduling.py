@@ -0,0 +1,64 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import nose.loader
+from destroystack.tools.scheduling import damages, RestoreScheduler
+
+# names of the `Damaging` tests, in the order they were run
+executed = list()
+
+
+class Damaging():
+    """Not collected by nose itself, only loaded by the test below."""
+    def test_a_everything(self):
+        executed.append('everything')
+
+    @damages('rings')
+    def test_b_rings(self):
+        executed.append('rings')
+
+    @damages('disks', 'data')
+    def test_c_disks(self):
+        executed.append('disks')
+
+    @damages('none')
+    def test_d_none(self):
+        executed.append('none')
+
+    @damages('services')
+    def test_e_services(self):
+        executed.append('services')
+
+
+class TestRestoreScheduler():
+
+    def setUp(self):
+        del executed[:]
+
+    def test_least_destructive_first(self):
+        loader = nose.loader.TestLoader()
+        RestoreScheduler().prepareTestLoader(loader)
+        suite = loader.loadTestsFromTestClass(Damaging)
+        result = unittest.TestResult()
+        suite(result)
+        assert result.wasSuccessful(), result.errors + result.failures
+        assert executed == ['none', 'services', 'disks', 'rings',
+                            'everything'], executed
+
+    def test_order_kept_without_plugin(self):
+        suite = nose.loader.TestLoader().loadTestsFromTestClass(Damaging)
+        suite(unittest.TestResult())
+        assert executed == ['everything', 'rings', 'disks', 'none',
+                            'services'], executed
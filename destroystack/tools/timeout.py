@@ -12,49 +12,170 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Timeout decorator.
+"""Deadlines and the timeout decorator.
 
-Source: http://stackoverflow.com/q/56011
-The nose.tools.timed decorator is not good for our purposes because it only
-checks if the time was exceeded after the function finishes, it doesn't
-interrupt it.
+A `Deadline` is a point in time by which an operation has to finish, which
+can also be cancelled from another thread. It uses a monotonic clock where
+available, so it has sub-second precision and isn't affected by changes of
+the system time. Used as a context manager, it becomes the current deadline
+of the thread, which is respected by `wait_for`, `Server.cmd` (as the
+timeout of the SSH channel) and the HTTP probes in `tools.swift`:
+
+    with Deadline(60, "Swift didn't recover"):
+        swift.wait_for_replica_regeneration()
+
+Deadlines can be nested, the inner one never lasts longer than the outer one.
+`parallel.run_parallel` passes the current deadline to its worker threads.
+With asyncio, use `deadline.remaining()` as the timeout of
+`asyncio.wait_for`.
+
+Unlike the original SIGALRM based implementation (http://stackoverflow.com/q/
+56011), the timeout decorator works in any thread and can be nested, but it
+is cooperative - it cannot interrupt code that doesn't check the deadline.
 """
 
 import functools
 import errno
+import heapq
 import os
-import signal
 import logging
+import random
+import threading
 import time
-import datetime
 import nose.tools
+import destroystack.tools.tracing as tracing
 
 LOG = logging.getLogger(__name__)
 
 # workaround: get rid of unnecessary log messages
 logging.getLogger("iso8601").setLevel(logging.WARNING)
 
+# monotonic clock is available since Python 3.3
+_clock = getattr(time, 'monotonic', time.time)
+# stack of the current deadlines of each thread
+_local = threading.local()
+
+
+class DeadlineExceeded(nose.tools.TimeExpired):
+    pass
+
+
+class Cancelled(Exception):
+    """Raised when the operation was cancelled by `Deadline.cancel`."""
+    pass
+
+
+class Deadline(object):
+    """Time limit of an operation, which can be cancelled.
+
+    :param seconds: time limit, None means unlimited (it can still be
+        cancelled or limited by the parent)
+    :param message: used in the exception when the deadline expires
+    :param parent: enclosing deadline, by default the current deadline of the
+        thread
+    """
+    def __init__(self, seconds=None, message=None, parent=None):
+        self.message = message or os.strerror(errno.ETIME)
+        self.expires_at = None
+        if seconds is not None:
+            self.expires_at = _clock() + seconds
+        self.parent = parent if parent is not None else current_deadline()
+        self._cancelled = threading.Event()
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = list()
+        _local.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.stack.remove(self)
+        return False
+
+    def remaining(self):
+        """Get the number of seconds left, None if unlimited."""
+        remaining = None
+        if self.expires_at is not None:
+            remaining = max(0.0, self.expires_at - _clock())
+        if self.parent is not None:
+            parent_remaining = self.parent.remaining()
+            if remaining is None:
+                remaining = parent_remaining
+            elif parent_remaining is not None:
+                remaining = min(remaining, parent_remaining)
+        return remaining
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def cancel(self):
+        """Make the operation fail with `Cancelled` at the next check."""
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set() \
+            or (self.parent is not None and self.parent.cancelled())
+
+    def check(self):
+        """:raises: `Cancelled` or `DeadlineExceeded`"""
+        if self.parent is not None:
+            self.parent.check()
+        if self._cancelled.is_set():
+            raise Cancelled(self.message)
+        if self.expires_at is not None and _clock() >= self.expires_at:
+            raise DeadlineExceeded(self.message)
+
+    def timeout(self, maximum=None):
+        """Get a timeout for a blocking call, like a socket operation.
+
+        :param maximum: return at most this, useful if the deadline is
+            unlimited
+        :raises: see `check`
+        :returns: seconds, None if both the deadline and maximum are unlimited
+        """
+        self.check()
+        remaining = self.remaining()
+        if remaining is None or (maximum is not None and maximum < remaining):
+            return maximum
+        return remaining
+
+    def sleep(self, seconds):
+        """Sleep, but wake up early if the deadline expires or is cancelled.
+
+        :raises: see `check`
+        """
+        self._cancelled.wait(self.timeout(seconds))
+        self.check()
+
+
+def current_deadline():
+    """Get the innermost deadline of this thread, or None."""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
 
 def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
-    def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise nose.tools.TimeExpired(error_message)
+    """Decorator running the function with a `Deadline` of `seconds`.
 
+    :param seconds: number, or a function returning it which is called
+        every time the decorated function is, e.g. `common.get_timeout`
+    """
+    def decorator(func):
         def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
+            limit = seconds() if callable(seconds) else seconds
+            with Deadline(limit, error_message):
+                return func(*args, **kwargs)
 
         return functools.wraps(func)(wrapper)
 
     return decorator
 
 
-def wait_for(label, condition, obj_getter, timeout_sec=120, period=1):
+def wait_for(label, condition, obj_getter, timeout_sec=120, period=1,
+             deadline=None):
     """Wait for condition to be true until timeout.
 
     :param label: used for logging
@@ -64,19 +185,116 @@ def wait_for(label, condition, obj_getter, timeout_sec=120, period=1):
         is tested
     :param timeout_sec: how many seconds to wait until a TimeoutError
     :param period: how many seconds to wait between testing the condition
-    :raises: TimeoutError when timeout_sec is exceeded
+    :param deadline: `Deadline` of the whole operation, by default the current
+        one; the wait never lasts longer than that
+    :raises: DeadlineExceeded when timeout_sec is exceeded
              and condition isn't true
     """
-    obj = obj_getter()
-    timeout_ = datetime.timedelta(seconds=timeout_sec)
-    start = datetime.datetime.now()
-    LOG.info('%s - START' % label)
-    while not condition(obj):
-        if (datetime.datetime.now() - start) > timeout_:
-            raise nose.tools.TimeExpired("waiting for '%s' expired after"
-                                         " %d seconds"
-                                         % (label, timeout_sec))
-        time.sleep(period)
+    deadline = Deadline(timeout_sec, "waiting for '%s' expired after %s"
+                        " seconds" % (label, timeout_sec), parent=deadline)
+    with tracing.span('wait_for', label=label):
         obj = obj_getter()
-    LOG.info('%s - DONE' % label)
+        LOG.info('%s - START' % label)
+        while not condition(obj):
+            deadline.sleep(period)
+            obj = obj_getter()
+        LOG.info('%s - DONE' % label)
     return obj
+
+
+class WaitResult(object):
+    """Result of `wait_for_all` or `wait_for_any`.
+
+    :ivar finished: dict {label: seconds from the start until the condition
+        was true}
+    :ivar values: dict {label: the last object returned by its obj_getter}
+    :ivar pending: set of labels of the conditions that were not true
+    """
+    def __init__(self, labels):
+        self.finished = dict()
+        self.values = dict()
+        self.pending = set(labels)
+
+    def __repr__(self):
+        done = ", ".join("%s: %.1fs" % (label, seconds) for label, seconds
+                         in sorted(self.finished.items(), key=lambda x: x[1]))
+        return "<WaitResult finished: %s; pending: %s>" \
+            % (done, ", ".join(sorted(self.pending)))
+
+
+def wait_for_all(conditions, timeout_sec=120, period=1, max_period=30,
+                 deadline=None):
+    """Wait until all the conditions are true, checking them concurrently.
+
+    The conditions are polled by a single scheduler, each of them with its
+    own exponential backoff - the time between two checks starts at `period`
+    and doubles (with a random jitter of +-20%) up to `max_period`. The whole
+    wait takes as long as the slowest condition, not the sum of them.
+
+    :param conditions: list of (label, condition, obj_getter) tuples, see
+        `wait_for`; labels have to be unique
+    :param timeout_sec: time limit of the whole wait
+    :param deadline: `Deadline` of the whole operation, by default the current
+        one
+    :raises: DeadlineExceeded if some conditions are not true within timeout,
+        the message lists them
+    :returns: `WaitResult`
+    """
+    return _wait_for_conditions(conditions, 'all', timeout_sec, period,
+                                max_period, deadline)
+
+
+def wait_for_any(conditions, timeout_sec=120, period=1, max_period=30,
+                 deadline=None):
+    """Wait until at least one of the conditions is true.
+
+    Same as `wait_for_all`, but it returns as soon as one condition is true.
+    The other conditions might also be in `WaitResult.finished`, if they were
+    checked in the same round.
+    """
+    return _wait_for_conditions(conditions, 'any', timeout_sec, period,
+                                max_period, deadline)
+
+
+def _wait_for_conditions(conditions, mode, timeout_sec, period, max_period,
+                         deadline):
+    labels = [label for label, _, _ in conditions]
+    assert len(set(labels)) == len(labels), "Labels have to be unique"
+    result = WaitResult(labels)
+    deadline = Deadline(timeout_sec, None, parent=deadline)
+    start = _clock()
+    # heap of (time of the next check, index of the condition, period)
+    schedule = [(start, i, period) for i in range(len(conditions))]
+    heapq.heapify(schedule)
+    LOG.info("Waiting for %s of: %s - START", mode, ", ".join(labels))
+    with tracing.span('wait_for_%s' % mode, labels=labels):
+        while schedule:
+            next_check, index, current_period = schedule[0]
+            now = _clock()
+            if next_check > now:
+                try:
+                    deadline.sleep(next_check - now)
+                except DeadlineExceeded:
+                    raise DeadlineExceeded(
+                        "waiting for %s of the conditions expired after %s"
+                        " seconds, not finished: %s"
+                        % (mode, timeout_sec, ", ".join(sorted(
+                            result.pending))))
+                continue
+            heapq.heappop(schedule)
+            label, condition, obj_getter = conditions[index]
+            obj = obj_getter()
+            result.values[label] = obj
+            if condition(obj):
+                result.finished[label] = _clock() - start
+                result.pending.discard(label)
+                LOG.info("%s - DONE after %.1f seconds", label,
+                         result.finished[label])
+                if mode == 'any':
+                    break
+                continue
+            jitter = random.uniform(0.8, 1.2)
+            heapq.heappush(schedule, (_clock() + current_period * jitter,
+                                      index,
+                                      min(current_period * 2, max_period)))
+    return result
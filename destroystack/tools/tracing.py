@@ -0,0 +1,194 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#           http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Timed spans showing where the time of the tests is spent.
+
+Commands, HTTP probes, waits, state restoration and so on are wrapped in
+spans, which record when they started, how long they took, on which host and
+in which test. Spans started while another one is running in the same thread
+are nested in it.
+
+Tracing is turned on by setting the environment variable DESTROYSTACK_TRACE
+to the name of the output file. When the process ends, the spans are written
+into it in the Chrome trace format, which can be opened in chrome://tracing or
+https://ui.perfetto.dev. When tracing is off, `span` returns a shared dummy
+object, so the overhead is just a function call.
+
+Usage:
+
+    with tracing.span('upload', host=server.name):
+        ...
+"""
+
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+import nose.plugins
+
+TRACE_FILE = os.environ.get('DESTROYSTACK_TRACE', None)
+ENABLED = bool(TRACE_FILE)
+
+_events = list()
+_events_lock = threading.Lock()
+# {thread ID: thread name}, for the trace viewer
+_threads = dict()
+# name of the test that is currently running
+_current_test = None
+
+
+class Span(object):
+    """A timed operation, use it as a context manager."""
+    def __init__(self, name, category, attrs):
+        self.name = name
+        self.category = category
+        self.attrs = attrs
+        self._start = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.attrs['error'] = repr(exc_value)
+        self.finish()
+        return False
+
+    def start(self):
+        self._start = time.time()
+
+    def finish(self):
+        end = time.time()
+        thread = threading.current_thread()
+        if _current_test:
+            self.attrs.setdefault('test', _current_test)
+        event = {
+            'name': self.name,
+            'cat': self.category,
+            'ph': 'X',
+            'ts': self._start * 1e6,
+            'dur': (end - self._start) * 1e6,
+            'pid': os.getpid(),
+            'tid': thread.ident,
+            'args': dict((k, str(v)) for k, v in self.attrs.items()),
+        }
+        with _events_lock:
+            _events.append(event)
+            _threads[thread.ident] = thread.name
+
+    def set(self, **attrs):
+        """Add attributes to the span."""
+        self.attrs.update(attrs)
+
+
+class _NullSpan(object):
+    """Returned by `span` when tracing is off."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def start(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, category='destroystack', **attrs):
+    """Create a span, use it as a context manager.
+
+    :param name: name of the operation, e.g. "cmd"
+    :param category: used for filtering in the trace viewer
+    :param attrs: additional information shown with the span, like the host
+    """
+    if not ENABLED:
+        return _NULL_SPAN
+    return Span(name, category, attrs)
+
+
+def traced(name, category='destroystack'):
+    """Decorator wrapping every call of the function in a span.
+
+    If tracing is off, the function is returned unchanged.
+    """
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(name, category, dict()):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def set_current_test(name):
+    """Set the name of the test that will be added to the spans."""
+    global _current_test
+    _current_test = name
+
+
+def export(filename=None):
+    """Write the recorded spans into a file in the Chrome trace format."""
+    filename = filename or TRACE_FILE
+    with _events_lock:
+        events = list(_events)
+        for tid, name in _threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': os.getpid(), 'tid': tid,
+                           'args': {'name': name}})
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+if ENABLED:
+    atexit.register(export)
+
+
+class TracingPlugin(nose.plugins.Plugin):
+    """Add the name of the test to the spans and a span for each test.
+
+    Enabled automatically if DESTROYSTACK_TRACE is set.
+    """
+    name = 'destroystack-tracing'
+
+    def configure(self, options, conf):
+        super(TracingPlugin, self).configure(options, conf)
+        self.enabled = ENABLED
+        self._span = None
+
+    def beforeTest(self, test):
+        set_current_test(str(test))
+        self._span = span('test', category='test')
+        self._span.start()
+
+    def afterTest(self, test):
+        if self._span:
+            self._span.finish()
+            self._span = None
+        set_current_test(None)
@@ -29,4 +29,14 @@ setuptools.setup(
         'nose >= 1.1.2',
         'python-swiftclient >= 1.4.0',
     ],
+    entry_points={
+        'nose.plugins.0.10': [
+            'restore-scheduler = destroystack.tools.scheduling:'
+            'RestoreScheduler',
+            'destroystack-tracing = destroystack.tools.tracing:'
+            'TracingPlugin',
+            'destroystack-profile = destroystack.tools.profiling:'
+            'ProfilerPlugin',
+        ],
+    },
 )